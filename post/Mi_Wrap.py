@@ -9,6 +9,7 @@ import os
 import configparser
 import utils
 import get
+import groups
 #from repo.download import get
 import pandas as pd
 import requests
@@ -64,9 +65,9 @@ class HR(object):
             df.loc[df[col] == 'tel:+52', col] = ''
 
         df = df.loc[df['date'] == date, :]
-        print "*"*50
-        print "Hay %d contactos a actualizar" %(df['phone'].count())
-        print "*"*50 + "\n"
+        print("*"*50)
+        print("Hay %d contactos a actualizar" %(df['phone'].count()))
+        print("*"*50 + "\n")
 
         #1.1
         clinics = utils.io(root+clinicDb , ['clues','cl_treatmentArm'])
@@ -75,8 +76,9 @@ class HR(object):
                                           'ext_cl_treatmentarm'})
         df = pd.merge(df, clinics, how='left', on=['ext_clues'])
 
-        #2
-        utils.update_fields(df, ['rp_name',
+        #2 Only fields that changed since the last sync are sent
+        get.GetContacts().sync_contacts(path=root+last_contacts)
+        updated = utils.update_fields(df, ['rp_name',
                                  'rp_duedate',
                                  'rp_ispregnant',
                                  'rp_isaux_decl',
@@ -84,7 +86,8 @@ class HR(object):
                                  'rp_prosperapal',
                                  'rp_apptdate',
                                  'ext_clues',
-                                 'ext_cl_treatmentarm'], date)
+                                 'ext_cl_treatmentarm'], date,
+                            diff=True, contacts_path=root+last_contacts)
 
         #3 Get uuid
         df['phone']=df['phone'].str[4:]
@@ -98,53 +101,51 @@ class HR(object):
 
 
 
-        inst = get.GetContacts()
         #inst.export_contacts(parameters={'before': (aux+lond) , 'after':
         #                                 (mi_date+lond)},
         #                     path=root+last_contacts)
-        print "*"*50
-        print "Descargando los contactos de rapidpro para exportarlos a csv en: \n%s" %(root+last_contacts)
-        inst.export_contacts(path=root+last_contacts)
-        print "*"*50 + "\n"
-
-        contacts = utils.io(root + last_contacts, ['phone', 'uuid'])
-        print "*"*50
-        print "Los contactos leidos de %s son %d" %(root + last_contacts, contacts.size)
-        print "\n Primeros 5 \n%s" %(contacts.head(5))
-        print "\n Ultimos 5  \n%s \n\n " %(contacts.tail(5))
-        df = pd.merge(df, contacts, how='left', on=['phone'] )
+        # The sync before the update is enough: contacts it created come
+        # with the uuids RapidPro answered
+        df['uuid'] = utils.lookup_uuids(df['phone'], root + last_contacts, updated).values
+        print("*"*50)
+        print("Contactos encontrados en %s: %d de %d" %(root + last_contacts,
+                                                      (df['uuid'] != '').sum(), len(df)))
+        print("\n Primeros 5 \n%s" %(df[['phone', 'uuid']].head(5)))
+        print("\n Ultimos 5  \n%s \n\n " %(df[['phone', 'uuid']].tail(5)))
 
         #3
         uuids_all = list(df['uuid'])
-        print "Contactos a modificar: "
+        print("Contactos a modificar: ")
         print(df['rp_name'])
-        print "*"*50 + "\n"
+        print("*"*50 + "\n")
 
-        print "*"*50
+        print("*"*50)
 
         # Register contacts to altas remotas
         #utils.add_groups(uuids_all, 'ALTAREMOTA')
 
         uuids_pregnant = list(df.loc[(df['rp_ispregnant'] == '1'), 'uuid'])
-        utils.add_groups(uuids_pregnant, 'PREGNANT')
 
         uuids_spill = list(df.loc[ (df['rp_prosperapal'] == '0') &
                                    (df['rp_isaux_decl'] == '0') &
                                    (df['rp_isvocal_decl'] == '0') &
                                    (df['rp_ispregnant']=='1') ,
                                    'uuid' ])
-        utils.add_groups(uuids_spill, 'spillovers')
 
         uuids_NotT3 = list(df.loc[(df['ext_cl_treatmentarm']=='1') |
                                   (df['ext_cl_treatmentarm']=='2') ,'uuid' ])
-        utils.add_groups(uuids_NotT3, 'NOT3')
 
         uuids_T1 = list(df.loc[(df['ext_cl_treatmentarm']=='1'), 'uuid'])
-        utils.add_groups(uuids_T1, 'T1')
         uuids_T2 = list(df.loc[(df['ext_cl_treatmentarm']=='2'), 'uuid'])
-        utils.add_groups(uuids_T2, 'T2')
         uuids_T3 = list(df.loc[(df['ext_cl_treatmentarm']=='3'), 'uuid'])
-        utils.add_groups(uuids_T3, 'T3')
+        # Only contacts not yet in their groups are added
+        utils.reconcile_groups(groups.by_contact({'PREGNANT': uuids_pregnant,
+                                                  'spillovers': uuids_spill,
+                                                  'NOT3': uuids_NotT3,
+                                                  'T1': uuids_T1,
+                                                  'T2': uuids_T2,
+                                                  'T3': uuids_T3}),
+                               contacts_path=root+last_contacts)
 
         ###4
         #utils.start_run(uuids_pregnant, 'setApptDate_hr')
@@ -177,26 +178,26 @@ class PD2(object):
         df = pd.merge(df, clinics, how='left', on=['ext_clues'])
         print(df)
 
-        #2
-        utils.update_fields(df, ['rp_name',
+        #2 Only fields that changed since the last sync are sent
+        get.GetContacts().sync_contacts(path=root+last_contacts)
+        updated = utils.update_fields(df, ['rp_name',
                                  'ext_clues',
                                  'ext_folio',
-                                 'ext_cl_treatmentarm'], date)
-
-        # Place contacts in its treatment arm
-        inst = get.GetContacts()
-        inst.export_contacts(path=root+last_contacts)
+                                 'ext_cl_treatmentarm'], date,
+                            diff=True, contacts_path=root+last_contacts)
 
-        contacts = utils.io(root + last_contacts, ['phone', 'uuid'])
-        print(contacts)
-        df = pd.merge(df, contacts, how='left', on=['phone'] )
+        # Place contacts in its treatment arm, the sync before the update is
+        # enough: contacts it created come with the uuids RapidPro answered
+        df['uuid'] = utils.lookup_uuids(df['phone'], root + last_contacts, updated).values
+        print(df[['phone', 'uuid']])
 
         uuids_T1 = list(df.loc[(df['ext_cl_treatmentarm']=='1'), 'uuid'])
-        utils.add_groups(uuids_T1, 'T1')
         uuids_T2 = list(df.loc[(df['ext_cl_treatmentarm']=='2'), 'uuid'])
-        utils.add_groups(uuids_T2, 'T2')
         uuids_T3 = list(df.loc[(df['ext_cl_treatmentarm']=='3'), 'uuid'])
-        utils.add_groups(uuids_T3, 'T3')
+        utils.reconcile_groups(groups.by_contact({'T1': uuids_T1,
+                                                  'T2': uuids_T2,
+                                                  'T3': uuids_T3}),
+                               contacts_path=root+last_contacts)
 
 
 class FANTASMA(object):
@@ -219,9 +220,8 @@ class FANTASMA(object):
         #2 merge with contacts
         #inst = get.GetContacts()
         #inst.export_contacts(path=root+last_contacts)
-        contacts = utils.io(root + last_contacts, ['phone', 'uuid'])
-        print(contacts)
-        df = pd.merge(df, contacts, how='left', on=['phone'] )
+        df['uuid'] = utils.lookup_uuids(df['phone'], root + last_contacts).values
+        print(df[['phone', 'uuid']])
         print(df)
 
         #3 updating fields
@@ -262,9 +262,10 @@ class RESCATE_T3(object):
         #2 merge with contacts
         #inst = get.GetContacts()
         #inst.export_contacts(path=root+last_contacts)
-        contacts = utils.io(root + last_contacts, ['phone', 'uuid'])
-        print(contacts)
-        df = pd.merge(df, contacts, how='left', on=['phone'] )
+        # Group memberships are compared with last_contacts: bring it up to date
+        get.GetContacts().sync_contacts(path=root+last_contacts)
+        df['uuid'] = utils.lookup_uuids(df['phone'], root + last_contacts).values
+        print(df[['phone', 'uuid']])
         print(df)
 
         #3 updating fields
@@ -278,7 +279,6 @@ class RESCATE_T3(object):
         print(uuids_all)
         #utils.start_run(uuids_all, 'IncentivesCollectBabies')
         utils.start_run(uuids_all, 'incentivesCollect5')
-        utils.add_groups(uuids_all, 'T3')
-        utils.remove_groups(uuids_all,'NOT3')
-        utils.remove_groups(uuids_all,'T2')
-        utils.remove_groups(uuids_all,'T1')
+        # Into T3 and out of the other arms, only where needed
+        utils.reconcile_groups(groups.by_contact({'T3': uuids_all}),
+                               ['T3', 'NOT3', 'T2', 'T1'], root+last_contacts)
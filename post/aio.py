@@ -0,0 +1,126 @@
+# coding=utf-8
+'''
+asyncio fetch path for the v2 cursor endpoints (contacts, runs, messages,
+flows, groups, fields).
+
+Pages are requested with the temba_client query of the Get subclass, so
+parameters, deserialization, errors and the retry on rate limit are the same
+as in the synchronous path; the blocking requests run in a thread pool that
+shares session.py's connections. While a page is flattened and written the
+next one is already downloading, and several exports can run on the one
+event loop of the process:
+
+     In [1]: run get.py
+     In [2]: import aio
+     In [3]: aio.export_tables([(GetContacts(), lazy.path('raw_contacts'), {}),
+                                (GetGroups(), lazy.path('raw_groups'), {}),
+                                (GetFields(), lazy.path('raw_fields'), {})])
+
+'''
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import session
+
+# Threads doing the blocking downloads and page processing of the loop,
+# None: the pool size of the session
+FETCH_THREADS = None
+
+_loop = None
+_executor = None
+_lock = threading.Lock()
+
+
+def get_loop():
+    '''
+        The event loop shared by every export of the process.
+    '''
+    global _loop
+    if _loop is None or _loop.is_closed():
+        _loop = asyncio.new_event_loop()
+    return _loop
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        threads = FETCH_THREADS or session.option('pool_size')
+        _executor = ThreadPoolExecutor(max_workers=threads)
+    return _executor
+
+
+def in_thread(function, *args):
+    '''
+        Awaitable of function(*args) run in the fetch threads.
+    '''
+    return asyncio.get_event_loop().run_in_executor(get_executor(), function, *args)
+
+
+def next_page(pages):
+    try:
+        return next(pages)
+    except StopIteration:
+        return None
+
+
+async def iter_pages(query):
+    '''
+        Yields the pages of a temba_client query, requesting the next page
+        before the current one is handed over.
+    '''
+    pages = query.iterfetches(retry_on_rate_exceed=True)
+    pending = in_thread(next_page, pages)
+    while True:
+        page = await pending
+        if page is None:
+            return
+        pending = in_thread(next_page, pages)
+        yield page
+
+
+async def fetch_all(query):
+    '''
+        Every result of query, like query.all(retry_on_rate_exceed=True).
+    '''
+    results = []
+    async for page in iter_pages(query):
+        results += page
+    return results
+
+
+async def stream_table(getter, path, parameters={}, fmt='csv'):
+    '''
+        Same as Get.stream_table: every page is flattened with getter.to_df
+        and written to path while the next one downloads.
+        Returns the number of records written.
+    '''
+    writer = getter.open_writer(path, fmt)
+    try:
+        async for page in iter_pages(getter.get_query(parameters)):
+            await in_thread(lambda page=page: writer.write(getter.to_df(page)))
+    except BaseException:
+        # Keep the previous export rather than a truncated one
+        writer.abort()
+        raise
+    return writer.close()
+
+
+def run(*awaitables):
+    '''
+        Runs awaitables concurrently on the shared event loop and returns
+        their results in order. Calls from several threads take turns.
+    '''
+    with _lock:
+        loop = get_loop()
+        asyncio.set_event_loop(loop)
+        return loop.run_until_complete(asyncio.gather(*awaitables))
+
+
+def export_tables(jobs, fmt='csv'):
+    '''
+        Exports every (getter, path, parameters) of jobs at the same time.
+        Returns the number of records written by each one.
+    '''
+    return run(*[stream_table(getter, path, parameters, fmt)
+                 for getter, path, parameters in jobs])
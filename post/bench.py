@@ -0,0 +1,452 @@
+# coding=utf-8
+'''
+Microbenchmarks for the hot spots of get.py, on synthetic records so that
+they never hit RapidPro, and end to end export benchmarks against the
+stand-in server of standin.py. Run them from the directory that holds
+keys.ini:
+
+     In [1]: run bench.py
+     In [2]: bench_flatten()
+     In [3]: bench_sanitize()
+     In [4]: bench_run_transform(processes=16)
+     In [5]: bench_exports(runs=100000, rate_limit=10, output='bench_exports.json')
+     In [6]: check_client_fields()
+
+'''
+
+import os
+import copy
+import json
+import time
+import random
+import shutil
+import tempfile
+import resource
+import tracemalloc
+import get
+import lazy
+import sanitize
+import session
+import standin
+
+
+def legacy_flatten_dict(d, result = None):
+    '''
+        Recursive Get.flatten_dict as it was before flattening plans,
+        kept as the baseline of bench_flatten.
+    '''
+
+    if result is None:
+        result = {}
+
+    for key in d:
+        value = d[key]
+
+        if isinstance(value, dict):
+            value1 = {}
+            for keyIn in value:
+                value1["_".join([key,keyIn])]=value[keyIn]
+            legacy_flatten_dict(value1, result)
+
+        elif isinstance(value, (list, tuple)):
+            for indexB, element in enumerate(value):
+
+                if isinstance(element, dict):
+                    value1 = {}
+
+                    for keyIn in element:
+                        newkey = "_".join([key, str(indexB),keyIn])
+                        value1[newkey]=value[indexB][keyIn]
+
+                    for keyA in value1:
+                        legacy_flatten_dict(value1, result)
+
+                elif isinstance(element, (list, tuple)):
+                    pass
+
+                else:
+                    newkey = "_".join([key,str(indexB)])
+                    result[newkey] = element
+
+        else:
+            result[key]=value
+
+    return result
+
+
+def synthetic_contact(i):
+    '''
+        A serialized v2 contact shaped like ours: urns, groups and fields.
+    '''
+    groups = [{'uuid': 'group-%d' % g, 'name': 'GROUP %d' % g}
+              for g in random.sample(range(30), random.randint(1, 4))]
+    fields = dict(('rp_field%02d' % f, random.choice([None, 'valor %d' % i, i]))
+                  for f in range(25))
+    return {'uuid': 'contact-%d' % i,
+            'name': 'Contacto %d' % i,
+            'language': random.choice([None, 'spa']),
+            'urns': ['tel:+5255%08d' % i],
+            'groups': groups,
+            'fields': fields,
+            'blocked': False,
+            'stopped': random.random() < 0.05,
+            'created_on': '2016-05-01T12:00:00.000000Z',
+            'modified_on': '2017-01-01T12:00:00.000000Z'}
+
+
+def records_per_second(function, records, repeat):
+    best = None
+    for r in range(repeat):
+        start = time.time()
+        for record in records:
+            function(record)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(records) / max(best, 1e-9)
+
+
+def bench_flatten(n=20000, repeat=3):
+    '''
+        records/second of the recursive flatten_dict against the compiled
+        FlattenPlan, checking that both produce the same columns.
+    '''
+    records = [synthetic_contact(i) for i in range(n)]
+    getter = get.GetContacts()
+    for record in records:
+        if list(getter.flatten_dict(record).items()) != list(legacy_flatten_dict(record).items()):
+            raise AssertionError("Flattening differs for %s" % record['uuid'])
+
+    before = records_per_second(legacy_flatten_dict, records, repeat)
+    after = records_per_second(getter.flatten_dict, records, repeat)
+    print ("flatten_dict antes:   %10.0f registros/s" % before)
+    print ("flatten_dict despues: %10.0f registros/s (x%.1f)" % (after, after / before))
+    return before, after
+
+
+def legacy_select_data(run, flow_manager):
+    '''
+        GetRuns.select_data as it was before the per-flow node index,
+        kept as the baseline of bench_select_data.
+    '''
+    run_result = {}
+    keys = list(run.keys())
+    for el in ['path', 'values']:
+        keys.remove(el)
+    for key in keys:
+        run_result[key] = run[key]
+
+    run_result['entries'] = []
+    value_nodes = {}
+    mistake_nodes = {}
+    for key in run['values']:
+        value_entry = run['values'][key]
+        value_nodes[value_entry['node']] = value_entry
+        value_nodes[value_entry['node']]['label'] = key
+        mistake_nodes[value_entry['node']] = 0
+
+    flow_def = flow_manager.search_flow(run['flow']['uuid'])
+    path_nodes = set([path['node'] for path in run['path']])
+
+    for idx in range(len(run['path'])-2):
+        if run['path'][idx]['node'] in mistake_nodes:
+            if run['path'][idx]['node'] == run['path'][idx+2]['node']:
+                mistake_nodes[run['path'][idx]['node']] += 1
+
+    for node in path_nodes:
+        entry = {}
+        if node in value_nodes.keys():
+            entry = value_nodes[node]
+            entry['origin'] = 'values'
+            entry['type'] = None
+            entry['mistakes'] = mistake_nodes[node]
+            run_result['entries'].append(entry)
+        else:
+            entry = sorted([path for path in run['path']if path["node"]== node],
+            key =lambda x : x['time'])[0]
+            entry['origin'] = 'steps'
+            entry['category'] = None
+            entry['label'] = 0
+            entry['mistakes'] = 0
+            entry['value'] = None
+            if not flow_def:
+                entry['text'] = "unknown flow"
+                entry['type'] = "unknown flow"
+            else:
+                action_def =[act['actions'] for act in flow_def['action_sets'] if act['uuid']== node]
+                if action_def:
+                    action_def = action_def[0][0]
+                    if "msg" in action_def:
+                        if 'spa' in action_def['msg']:
+                            entry['text'] = action_def['msg']['spa']
+                        else:
+                            entry['text'] = action_def['msg']
+                    entry['type'] = action_def['type']
+                run_result['entries'].append(entry)
+    return run_result
+
+
+def synthetic_flow(uuid, action_sets=300, rulesets=100):
+    '''
+        A legacy (action_sets) flow definition with message actions.
+    '''
+    return {'metadata': {'uuid': uuid},
+            'action_sets': [{'uuid': 'action-%d' % a,
+                             'actions': [{'type': 'reply',
+                                          'msg': {'spa': 'Mensaje %d' % a}}]}
+                            for a in range(action_sets)],
+            'rule_sets': [{'uuid': 'rule-%d' % r} for r in range(rulesets)]}
+
+
+def synthetic_run(i, flow, steps=400, action_sets=300, rulesets=100):
+    '''
+        A serialized v2 run whose path alternates action sets and rulesets,
+        revisiting nodes like contacts who answer wrong do.
+    '''
+    path = []
+    values = {}
+    for step in range(steps):
+        if step % 2:
+            node = 'rule-%d' % random.randrange(rulesets)
+            values['result_%s' % node] = {'node': node, 'value': 'si',
+                                          'category': 'Si',
+                                          'time': '2017-01-01T00:%02d:%02d.000Z' % (step // 60 % 60, step % 60)}
+        else:
+            node = 'action-%d' % random.randrange(action_sets)
+        path.append({'node': node,
+                     'time': '2017-01-01T%02d:%02d:%02d.000Z' % (step // 3600, step // 60 % 60, step % 60)})
+    return {'id': i, 'flow': {'uuid': flow, 'name': 'flujo'},
+            'contact': {'uuid': 'contact-%d' % i}, 'responded': True,
+            'path': path, 'values': values,
+            'created_on': '2017-01-01T00:00:00.000Z',
+            'modified_on': '2017-01-01T01:00:00.000Z',
+            'exited_on': None, 'exit_type': None}
+
+
+def bench_select_data(n=200, steps=400, repeat=3):
+    '''
+        runs/second of select_data with linear scans against the per-flow
+        node index, on synthetic long-path runs of a large flow.
+    '''
+    flow_manager = get.GetFlowDefinition(None, cache_path=':memory:')
+    flow_manager.add_flow('flow-1', synthetic_flow('flow-1'))
+    runs = [synthetic_run(i, 'flow-1', steps) for i in range(n)]
+    getter = get.GetRuns()
+
+    key = lambda entry: (entry['time'], entry['node'])
+    for run in runs:
+        new = sorted(getter.select_data(copy.deepcopy(run), flow_manager)['entries'], key=key)
+        old = sorted(legacy_select_data(copy.deepcopy(run), flow_manager)['entries'], key=key)
+        if new != old:
+            raise AssertionError("select_data differs for run %d" % run['id'])
+
+    before = records_per_second(lambda run: legacy_select_data(run, flow_manager), runs, repeat)
+    after = records_per_second(lambda run: getter.select_data(run, flow_manager), runs, repeat)
+    print ("select_data antes:   %10.0f runs/s" % before)
+    print ("select_data despues: %10.0f runs/s (x%.1f)" % (after, after / before))
+    return before, after
+
+
+# Characters the message exports removed before sanitize.py
+LEGACY_TEXT_CHARS = ['"', "'", ";", ",", '\u2013', '\u2026']
+
+
+def legacy_clean_text(texts):
+    '''
+        Message text cleaning as it was before sanitize.py, one
+        str.replace per character and message, kept as the baseline of
+        bench_sanitize.
+    '''
+    cleaned = []
+    for text in texts:
+        for char in LEGACY_TEXT_CHARS + ['\r\n']:
+            text = text.replace(char, '')
+        cleaned.append(text)
+    return cleaned
+
+
+def synthetic_texts(n, distinct=5000):
+    '''
+        n message texts drawn from `distinct` random ones, with the quotes,
+        separators and line breaks contacts actually send.
+    '''
+    words = ['hola', 'si', 'no', 'bebe', 'cita', 'gracias', 'doctora', '"ok"',
+             "d'accord", 'fecha;', 'uno,', 'dos', '–', '…', '\r\n', 'ñ']
+    texts = [' '.join(random.choice(words) for w in range(random.randint(1, 30)))
+             for t in range(distinct)]
+    return [random.choice(texts) for t in range(n)]
+
+
+def bench_sanitize(n=2000000, distinct=200000, repeat=3):
+    '''
+        messages/second of the per-message replace loop against
+        sanitize.clean_column on a column of n message texts with
+        `distinct` different ones, checking that both give the same text.
+    '''
+    texts = synthetic_texts(n, distinct)
+    column = get.pd.Series(texts)
+    if list(sanitize.clean_column(column, sanitize.compile_table(['\r\n'] + LEGACY_TEXT_CHARS))) != legacy_clean_text(texts):
+        raise AssertionError("Sanitization differs")
+
+    before = records_per_second(legacy_clean_text, [texts], repeat) * n
+    after = records_per_second(sanitize.clean_column, [column], repeat) * n
+    print ("limpieza de texto antes:   %10.0f mensajes/s" % before)
+    print ("limpieza de texto despues: %10.0f mensajes/s (x%.1f)" % (after, after / before))
+    return before, after
+
+
+class SerializedRun(object):
+    '''
+        Stand-in for a temba_client Run, serialize returns a fresh copy
+        because select_data modifies it.
+    '''
+    def __init__(self, run):
+        self.run = run
+
+    def serialize(self):
+        return copy.deepcopy(self.run)
+
+
+def bench_run_transform(n=20000, steps=100, processes=None, repeat=1):
+    '''
+        runs/second of ExportRuns.to_df in the exporting process against
+        the process pool (get.run_processes() processes by default, at
+        least 2), checking that both give the same entries.
+    '''
+    exporter = get.ExportRuns()
+    exporter.flow_manager = get.GetFlowDefinition(None, cache_path=':memory:')
+    exporter.flow_manager.add_flow('flow-1', synthetic_flow('flow-1'))
+    runs = [SerializedRun(synthetic_run(i, 'flow-1', steps)) for i in range(n)]
+    processes = processes or max(get.run_processes(), 2)
+    try:
+        exporter.processes = 1
+        old = exporter.to_df(runs)
+        exporter.processes = processes
+        new = exporter.to_df(runs)
+        if not old.equals(new):
+            raise AssertionError("Process pool entries differ")
+
+        exporter.processes = 1
+        before = records_per_second(exporter.to_df, [runs], repeat) * n
+        exporter.processes = processes
+        after = records_per_second(exporter.to_df, [runs], repeat) * n
+    finally:
+        exporter.close()
+    print ("to_df en un proceso:    %10.0f runs/s" % before)
+    print ("to_df con %2d procesos:  %10.0f runs/s (x%.1f)" % (processes, after, after / before))
+    return before, after
+
+
+def check_client_fields(workspace=None):
+    '''
+        Raises AssertionError when temba_client drops a field of the
+        stand-in runs or messages, or lacks one the exporters rely on (v2
+        messages and runs, for one, have no id), so the end to end
+        benchmarks run against the records the client really returns.
+    '''
+    from temba_client.v2 import types
+    workspace = workspace or standin.Workspace(contacts=10, runs=10, messages=10)
+    checks = [('mensajes', types.Message, workspace.message(0), get.GetMessages.CURSOR_COLUMNS),
+              ('runs', types.Run, workspace.run(0), get.RunTransformer.COMMON_KEYS)]
+    for kind, client_type, record, needed in checks:
+        returned = client_type.deserialize(record).serialize()
+        missing = (set(record) | set(needed)) - set(returned)
+        if missing:
+            raise AssertionError("temba_client no devuelve %s de los %s"
+                                 % (sorted(missing), kind))
+
+
+def measure(function, server, trace_memory=True):
+    '''
+        Runs function() and returns its wall time, the requests the stand-in
+        server answered meanwhile and the peak memory: Python allocations
+        traced by tracemalloc (slower), or the peak RSS of the process so far.
+    '''
+    requests_before = dict(server.stats)
+    if trace_memory:
+        tracemalloc.start()
+    start = time.time()
+    try:
+        function()
+    finally:
+        elapsed = time.time() - start
+        if trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        else:
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    stats = dict((key, server.stats[key] - requests_before[key]) for key in server.stats)
+    return elapsed, stats, peak
+
+
+def bench_exports(contacts=5000, runs=20000, run_length=20, messages=20000,
+                  rate_limit=None, fmt='csv', trace_memory=True, output=None):
+    '''
+        Times export_contacts, export_runs, GetMessages.export_messages and
+        GetFailedMessages.export_messages end to end against a synthetic
+        workspace served by standin.StandIn (rate_limit requests/second, None
+        for no limit). Exports are written to a temporary directory.
+        Records rows/s, requests/s and peak memory of every export, prints
+        them and returns them (also saved to output, a .json, if given).
+    '''
+    workspace = standin.Workspace(contacts=contacts, runs=runs, run_length=run_length,
+                                  messages=messages)
+    check_client_fields(workspace)
+    server = standin.StandIn(workspace, rate_limit=rate_limit).start()
+    host = session.option('host')
+    directory = tempfile.mkdtemp(prefix='bench_exports_')
+    session.configure(rapidpro_host=server.url)
+    lazy.override('paths', 'root', directory + os.sep)
+    for folder in set(os.path.dirname(lazy.path(key)) for key in
+                      ('raw_flows', 'raw_runs', 'raw_contacts', 'raw_messages',
+                       'raw_failed_messages')):
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+    def rows(path):
+        path = path if fmt == 'csv' else get.columnar.output_path(path, fmt)
+        return len(get.columnar.read_table(path).index) if os.path.isfile(path) else 0
+
+    exports = [
+        ('export_flows', lambda: get.GetFlows().export_flows(fmt=fmt),
+         lambda: rows(lazy.path('raw_flows'))),
+        ('export_contacts', lambda: get.GetContacts().export_contacts(
+            path=lazy.path('raw_contacts'), fmt=fmt),
+         lambda: rows(lazy.path('raw_contacts'))),
+        ('export_runs', lambda: get.ExportRuns().export_runs(fmt=fmt),
+         lambda: sum(s['rows'] for s in get.ExportRuns().store.segments)),
+        ('export_messages', lambda: get.GetMessages().export_messages(fmt=fmt, incremental=False),
+         lambda: rows(get.GetMessages().messages_path())),
+        ('export_failed_messages', lambda: get.GetFailedMessages().export_messages(
+            fmt=fmt, incremental=False),
+         lambda: rows(lazy.path('raw_failed_messages'))),
+    ]
+    results = []
+    try:
+        for name, export, count in exports:
+            elapsed, stats, peak = measure(export, server, trace_memory)
+            n = count()
+            results.append({'export': name, 'rows': n, 'seconds': elapsed,
+                            'rows_per_second': n / max(elapsed, 1e-9),
+                            'requests': stats['requests'],
+                            'requests_per_second': stats['requests'] / max(elapsed, 1e-9),
+                            'rate_limited': stats['rate_limited'],
+                            'bytes': stats['bytes'], 'peak_memory': peak})
+    finally:
+        server.stop()
+        session.configure(rapidpro_host=host)
+        lazy.override('paths', 'root', None)
+        shutil.rmtree(directory, ignore_errors=True)
+
+    print ("%-24s %9s %9s %10s %9s %6s %10s" % ('export', 'filas', 'seg', 'filas/s',
+                                                'req/s', '429', 'memoria MB'))
+    for r in results:
+        print ("%-24s %9d %9.2f %10.0f %9.1f %6d %10.1f"
+               % (r['export'], r['rows'], r['seconds'], r['rows_per_second'],
+                  r['requests_per_second'], r['rate_limited'], r['peak_memory'] / 2.0 ** 20))
+    if output:
+        with open(output, 'w') as f:
+            json.dump({'workspace': {'contacts': contacts, 'runs': runs,
+                                     'run_length': run_length, 'messages': messages,
+                                     'rate_limit': rate_limit, 'fmt': fmt},
+                       'results': results}, f, indent=2)
+    return results
@@ -0,0 +1,219 @@
+# coding=utf-8
+'''
+Columnar (Parquet / Feather) storage for the datasets exported by get.py.
+
+Exports are written page by page to part files and merged on close into a
+single file whose schema is the union of the columns of every page, with
+proper dtypes for dates, integers and booleans. read_table loads them with
+column projection and falls back to the .csv when there is no columnar copy.
+pyarrow is only needed when a columnar format is actually used.
+'''
+
+import os
+import shutil
+import pandas as pd
+import metrics
+
+# Output format -> file extension
+FORMATS = {'csv': '.csv', 'parquet': '.parquet', 'feather': '.feather'}
+
+
+def arrow():
+    '''
+        Imports pyarrow on demand, it is only needed for columnar formats.
+    '''
+    try:
+        import pyarrow
+        import pyarrow.parquet
+        import pyarrow.ipc
+        import pyarrow.feather
+    except ImportError:
+        raise ImportError("Parquet/Feather exports need pyarrow: pip install pyarrow")
+    return pyarrow
+
+
+def output_path(path, fmt):
+    '''
+        path with the extension of fmt, e.g. contacts.csv -> contacts.parquet
+    '''
+    if fmt not in FORMATS:
+        raise ValueError("Unknown format %s, expected one of %s" % (fmt, sorted(FORMATS)))
+    return os.path.splitext(path)[0] + FORMATS[fmt]
+
+
+def locate(path):
+    '''
+        Returns the file to read for path: path itself if it is columnar,
+        otherwise its .parquet/.feather copy when it exists and is not older
+        than the .csv, otherwise path.
+    '''
+    base, ext = os.path.splitext(path)
+    if ext != '.csv':
+        return path
+    csv_time = os.path.getmtime(path) if os.path.isfile(path) else None
+    for fmt in ('parquet', 'feather'):
+        candidate = base + FORMATS[fmt]
+        if os.path.isfile(candidate) and (csv_time is None or
+                                          os.path.getmtime(candidate) >= csv_time):
+            return candidate
+    return path
+
+
+def read_table(path, columns=None, **csv_kwargs):
+    '''
+        Reads the dataset in path (see locate) keeping only columns.
+        csv_kwargs are passed to pd.read_csv when there is no columnar copy.
+    '''
+    path = locate(path)
+    if path.endswith(FORMATS['parquet']):
+        table = arrow().parquet.read_table(path, columns=columns)
+    elif path.endswith(FORMATS['feather']):
+        table = arrow().feather.read_table(path, columns=columns)
+    else:
+        return pd.read_csv(path, usecols=columns, **csv_kwargs)
+    # Keep integers and booleans with missing values as such
+    pa = arrow()
+    nullable = {pa.int64(): pd.Int64Dtype(), pa.bool_(): pd.BooleanDtype()}
+    return table.to_pandas(types_mapper=nullable.get)
+
+
+def is_date_column(name):
+    '''
+        RapidPro timestamps: created_on, modified_on, exited_on, time...
+    '''
+    name = str(name)
+    return name.endswith('_on') or name == 'time' or name.endswith('_time')
+
+
+def typed(df):
+    '''
+        Gives df's columns proper dtypes: ISO timestamps in date columns,
+        integers that pandas upcasted to float because of missing values and
+        booleans. Any other mixed column is turned into strings so that
+        every column has a single type.
+    '''
+    df = df.copy()
+    for col in df:
+        series = df[col]
+        values = series.dropna()
+        if len(values) == 0:
+            continue
+        if pd.api.types.is_float_dtype(series):
+            if (values == values.round()).all():
+                df[col] = series.astype('Int64')
+            continue
+        if not (pd.api.types.is_object_dtype(series) or
+                pd.api.types.is_string_dtype(series)):
+            continue
+        kinds = set(type(v) for v in values)
+        if kinds == set([bool]):
+            df[col] = series.astype('boolean')
+        elif kinds <= set([int]):
+            df[col] = series.astype('Int64')
+        elif kinds <= set([int, float]):
+            df[col] = series.astype(float)
+        elif kinds <= set([str]) and is_date_column(col):
+            dates = pd.to_datetime(series, utc=True, errors='coerce')
+            if dates.notnull().sum() == len(values):
+                df[col] = dates
+            else:
+                df[col] = series
+        elif kinds != set([str]):
+            df[col] = series.where(series.isnull(), series.astype(str))
+    return df
+
+
+class ColumnarWriter(object):
+    '''
+        Same interface as get.CsvStreamWriter for Parquet and Feather: every
+        write stores one part file, close merges the parts in path with the
+        union of their columns. A column whose type differs between parts
+        is widened to float (ints and floats) or to string. abort drops the
+        parts and leaves path as it was.
+    '''
+    def __init__(self, path, fmt):
+        self.pa = arrow()
+        self.path = path
+        self.fmt = fmt
+        self.parts = path + '.parts'
+        self.columns = []
+        self.types = {}
+        self.records = 0
+        self.n_parts = 0
+        if os.path.isdir(self.parts):
+            shutil.rmtree(self.parts)
+        os.makedirs(self.parts)
+
+    def merge_type(self, old, new):
+        pa = self.pa
+        if old is None or pa.types.is_null(old):
+            return new
+        if pa.types.is_null(new) or old == new:
+            return old
+        numeric = (pa.types.is_integer, pa.types.is_floating)
+        if any(t(old) for t in numeric) and any(t(new) for t in numeric):
+            return pa.float64()
+        return pa.string()
+
+    def write(self, df):
+        if df is None:
+            return
+        if len(df.index) == 0:
+            # No part, but the columns are kept (e.g. the header of an empty export)
+            for col in df.columns:
+                if str(col) not in self.types:
+                    self.columns.append(str(col))
+                    self.types[str(col)] = self.pa.null()
+            return
+        with metrics.stage('write') as s:
+            pa = self.pa
+            table = pa.Table.from_pandas(typed(df), preserve_index=False)
+            for field in table.schema:
+                if field.name not in self.types:
+                    self.columns.append(field.name)
+                self.types[field.name] = self.merge_type(self.types.get(field.name), field.type)
+            part = os.path.join(self.parts, '%06d.parquet' % self.n_parts)
+            pa.parquet.write_table(table, part)
+            self.n_parts += 1
+            self.records += len(df.index)
+            s.records = len(df.index)
+            s.bytes = os.path.getsize(part)
+
+    @metrics.timed('write')
+    def close(self):
+        pa = self.pa
+        try:
+            schema = pa.schema([(c, pa.string() if pa.types.is_null(self.types[c])
+                                 else self.types[c]) for c in self.columns])
+            tmp = self.path + '.tmp'
+            if self.fmt == 'parquet':
+                writer = pa.parquet.ParquetWriter(tmp, schema)
+            else:
+                # Feather V2 is the Arrow IPC file format
+                writer = pa.ipc.new_file(tmp, schema)
+            try:
+                for n in range(self.n_parts):
+                    part = pa.parquet.read_table(os.path.join(self.parts, '%06d.parquet' % n))
+                    arrays = []
+                    for field in schema:
+                        if field.name in part.column_names:
+                            arrays.append(part[field.name].cast(field.type))
+                        else:
+                            arrays.append(pa.nulls(part.num_rows, field.type))
+                    writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            finally:
+                writer.close()
+            os.replace(tmp, self.path)
+        finally:
+            self.abort()
+        return self.records
+
+    def abort(self):
+        '''
+            Removes the part files and the partial merge, path is left
+            untouched.
+        '''
+        if os.path.isdir(self.parts):
+            shutil.rmtree(self.parts)
+        if os.path.isfile(self.path + '.tmp'):
+            os.remove(self.path + '.tmp')
@@ -0,0 +1,195 @@
+# coding=utf-8
+'''
+Bulk updates of RapidPro contact fields from a DataFrame, used by
+utils.update_fields.
+
+The payloads of all rows are built in one pass over the columns to update
+and sent through dispatch.py (concurrent, retried, rate-aware). With diff,
+they are first compared with a snapshot of the contacts (the contacts
+export): only fields whose value changed are sent and unchanged contacts are
+skipped. The result is a table with one row per contact instead of prints:
+
+     phone   uuid   fields   unchanged   status   http_status   attempts   error
+
+where uuid is the one RapidPro answered (also for contacts the update
+created), fields are the fields sent, unchanged those left out because the
+contact already has them and status is 'ok', 'failed' or 'unchanged'.
+'''
+
+import numpy as np
+import pandas as pd
+import dispatch
+import phone_index
+import session
+
+# Contact field with the date of the update, when one is given
+DATE_FIELD = 'rp_datemodified'
+# Columns of the contact fields in the contacts export (see get.flatten_value)
+FIELD_PREFIX = 'fields_'
+RESULT_COLUMNS = ['phone', 'uuid', 'fields', 'unchanged', 'status', 'http_status', 'attempts',
+                  'error']
+
+
+def field_map(variables):
+    '''
+        {column: contact field} from update_fields' variables, a dict or a
+        list of columns named like their fields.
+    '''
+    if isinstance(variables, dict):
+        return dict(variables)
+    return dict((field, field) for field in variables)
+
+
+def plain(value):
+    '''
+        numpy scalars as python values, so that they serialize to json.
+    '''
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def build_payloads(df, variables, date=None):
+    '''
+        DataFrame with the phone and the {field: value} to send of every
+        contact of df that has something to update. Missing and empty
+        values are left out. Rows of the same phone are merged, later rows
+        winning, as if they were sent in order.
+    '''
+    mapping = field_map(variables)
+    columns = list(mapping)
+    values = df[columns]
+    keep = (values.notnull() & (values != '')).to_numpy()
+    cells = values.to_numpy(dtype=object)
+    names = [mapping[c] for c in columns]
+    phones = df['phone'].to_numpy(dtype=object)
+
+    payloads = {}
+    rows, cols = np.nonzero(keep)
+    for row, col in zip(rows, cols):
+        payloads.setdefault(phones[row], {})[names[col]] = plain(cells[row, col])
+    # Phones in the order of their first row
+    order = pd.unique(phones[rows]) if len(rows) else []
+    fields = [payloads[phone] for phone in order]
+    add_date(fields, date)
+    return pd.DataFrame({'phone': list(order), 'fields': fields}, columns=['phone', 'fields'])
+
+
+def add_date(fields, date):
+    if date:
+        for to_update in fields:
+            to_update[DATE_FIELD] = date
+
+
+def read_snapshot(contacts_path, fields):
+    '''
+        {normalized phone: {field: current value}} of the contacts export in
+        contacts_path (see phone_index.py), only for fields.
+    '''
+    columns = [FIELD_PREFIX + field for field in fields]
+    df = phone_index.read_contacts(contacts_path, columns)
+    values = df.reindex(columns=['uuid'] + columns).drop_duplicates('uuid')
+    values.columns = ['uuid'] + list(fields)
+    snapshot = phone_index.contact_phones(df).merge(values, on='uuid', how='left')
+    snapshot = snapshot.drop_duplicates('phone', keep='last').set_index('phone')
+    return snapshot[list(fields)].to_dict('index')
+
+
+def text(value):
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return u''
+    return (u'%s' % value).strip()
+
+
+def same_value(new, current):
+    '''
+        Whether a contact with the value current needs no update to new.
+        Numbers are compared as such ('12' and '12.0' are the same).
+    '''
+    new, current = text(new), text(current)
+    if new == current:
+        return True
+    try:
+        return float(new) == float(current)
+    except ValueError:
+        return False
+
+
+def diff_payloads(payloads, snapshot):
+    '''
+        payloads (see build_payloads, without date) keeping only the fields
+        that differ from snapshot (see read_snapshot). unchanged counts the
+        fields left out of every contact. Contacts missing in the snapshot
+        keep all their fields.
+    '''
+    fields = []
+    unchanged = []
+    keys = phone_index.normalize(payloads['phone'])
+    for key, to_update in zip(keys, payloads['fields']):
+        current = snapshot.get(key)
+        if current is None:
+            fields.append(to_update)
+            unchanged.append(0)
+            continue
+        changed = dict((field, value) for field, value in to_update.items()
+                       if not same_value(value, current.get(field)))
+        fields.append(changed)
+        unchanged.append(len(to_update) - len(changed))
+    return pd.DataFrame({'phone': payloads['phone'].values, 'fields': fields,
+                         'unchanged': unchanged}, columns=['phone', 'fields', 'unchanged'])
+
+
+def send_payloads(payloads, workers=dispatch.WORKERS, rate=dispatch.RATE):
+    '''
+        Posts every payload with fields to the v1 contacts endpoint and
+        returns the result table. Payloads without fields are 'unchanged'.
+    '''
+    table = pd.DataFrame({'phone': payloads['phone'].values, 'uuid': None,
+                          'fields': [len(fields) for fields in payloads['fields']],
+                          'unchanged': payloads['unchanged'].values if 'unchanged' in payloads else 0,
+                          'status': 'unchanged', 'http_status': None, 'attempts': 0, 'error': None},
+                         columns=RESULT_COLUMNS)
+    url = session.url('v1', 'contacts')
+    send = (table['fields'] > 0).values
+    jobs = [('post', url, {'urns': [phone], 'fields': fields})
+            for phone, fields in zip(payloads['phone'][send], payloads['fields'][send])]
+    results = pd.DataFrame(dispatch.dispatch(jobs, workers, rate))
+    if len(results.index):
+        results['uuid'] = [answer.get('uuid') if isinstance(answer, dict) else None
+                           for answer in results['response']]
+        for col in ['uuid', 'status', 'http_status', 'attempts', 'error']:
+            table.loc[send, col] = results[col].values
+    return table
+
+
+def fill_uuids(uuids, phones, table):
+    '''
+        uuids (see phone_index.PhoneIndex.lookup) of phones, with the unknown
+        ones ('') taken from the uuids answered in table (see update_fields).
+    '''
+    known = table[table['uuid'].notnull()]
+    answered = dict(zip(phone_index.normalize(known['phone']), known['uuid']))
+    found = phone_index.normalize(phones).map(lambda k: answered.get(k, ''))
+    return uuids.where(uuids != '', found)
+
+
+def update_fields(df, variables, date=None, diff=False, contacts_path=None,
+                  workers=dispatch.WORKERS, rate=dispatch.RATE):
+    '''
+        Updates the contact fields of df (see utils.update_fields) and
+        returns the result table. diff only sends the fields that differ
+        from the contacts export in contacts_path, which should be synced
+        first (see get.GetContacts.sync_contacts); the date field is only
+        sent to contacts with changes.
+    '''
+    payloads = build_payloads(df, variables)
+    if diff:
+        fields = sorted(set(field_map(variables).values()))
+        payloads = diff_payloads(payloads, read_snapshot(contacts_path, fields))
+    add_date([f for f in payloads['fields'] if f], date)
+    table = send_payloads(payloads, workers, rate)
+    sent = table['status'] != 'unchanged'
+    failed = (table['status'] == 'failed').sum()
+    print("Contactos actualizados: %d, con error: %d" % (sent.sum() - failed, failed))
+    if diff:
+        print("Solicitudes evitadas: %d, campos evitados: %d"
+              % ((~sent).sum(), table['unchanged'].sum()))
+    return table
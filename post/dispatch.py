@@ -0,0 +1,137 @@
+# coding=utf-8
+'''
+Concurrent, rate-aware sending of RapidPro write requests (contact field
+updates, group actions, flow starts) and of the status checks that follow
+them, through the shared session of session.py.
+
+Requests are sent by a bounded pool of threads. A RateLimiter shared by the
+threads keeps them under `rate` requests per second (None: as fast as the
+server accepts) and, when RapidPro answers 429, every thread waits the
+Retry-After it asked for, so a long job settles at the sustained rate limit
+of the workspace. Server errors and dropped connections are retried with
+exponential backoff; other errors (400, 403, 404...) are not. Requests that
+must not run twice (idempotent=False, e.g. flow starts) are only retried
+when they surely did nothing (429, connection not established): after a
+server error or a read timeout they end as 'unknown', the caller has to
+check whether they took effect.
+'''
+
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+import session
+
+# Threads sending requests at the same time, None: the pool size of the
+# session
+WORKERS = None
+# Requests per second, None leaves the pace to the 429 answers of RapidPro
+RATE = None
+# Retries of a request answered with 429, 5xx or without answer
+MAX_RETRIES = 5
+# Seconds before the first retry of a 5xx or dropped connection, doubled
+# on every retry
+BACKOFF = 1.0
+RETRY_STATUS = [429, 500, 502, 503, 504]
+
+
+class RateLimiter(object):
+    '''
+        Hands out send slots at most rate per second and holds every
+        thread while the server asked to wait.
+    '''
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next_slot = 0.0
+        self.paused_until = 0.0
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.time() + seconds)
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            start = max(now, self.paused_until, self.next_slot)
+            if self.rate:
+                self.next_slot = start + 1.0 / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+def result(status, http_status, attempts, error=None, response=None):
+    return {'status': status, 'http_status': http_status, 'attempts': attempts,
+            'error': error, 'response': response}
+
+
+def ambiguous(ex):
+    '''
+        Whether the request that raised ex may have reached the server.
+    '''
+    from requests.exceptions import ConnectTimeout
+    return not isinstance(ex, ConnectTimeout)
+
+
+def send(method, url, body, limiter, max_retries=MAX_RETRIES, idempotent=True):
+    '''
+        Sends body (json, the query parameters of a get) to url, retrying as
+        described above. Returns a result: status 'ok', 'failed' or (not
+        idempotent) 'unknown', the last http status (None without answer),
+        the attempts made, the error and the json answer.
+    '''
+    if method == 'get':
+        kwargs = {'params': body}
+    else:
+        kwargs = {'data': json.dumps(body)}
+    attempts = 0
+    while True:
+        limiter.wait()
+        attempts += 1
+        response = None
+        try:
+            response = session.request(method, url, **kwargs)
+        except IOError as ex:
+            # requests' connection errors and timeouts
+            http_status, error = None, str(ex)
+            if not idempotent and ambiguous(ex):
+                return result('unknown', http_status, attempts, error)
+        else:
+            http_status = response.status_code
+            if response.ok:
+                try:
+                    answer = response.json() if response.content else None
+                except ValueError:
+                    answer = None
+                return result('ok', http_status, attempts, response=answer)
+            error = response.text[:500]
+            if not idempotent and http_status >= 500:
+                return result('unknown', http_status, attempts, error)
+        if attempts > max_retries or (http_status is not None and
+                                      http_status not in RETRY_STATUS):
+            return result('failed', http_status, attempts, error)
+        metrics.count('retries')
+        if http_status == 429:
+            retry_after = response.headers.get('retry-after')
+            wait = float(retry_after) if retry_after else BACKOFF
+            metrics.count('rate_limit_waits')
+            metrics.count('rate_limit_wait_seconds', wait)
+            limiter.pause(wait)
+        else:
+            time.sleep(BACKOFF * 2 ** (attempts - 1))
+
+
+def dispatch(jobs, workers=WORKERS, rate=RATE, max_retries=MAX_RETRIES, idempotent=True):
+    '''
+        Sends every (method, url, body) of jobs with `workers` threads and
+        returns their results (see send) in the same order.
+    '''
+    jobs = list(jobs)
+    if not jobs:
+        return []
+    workers = workers or session.option('pool_size')
+    limiter = RateLimiter(rate)
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(jobs)))) as pool:
+        return list(pool.map(lambda job: send(job[0], job[1], job[2], limiter, max_retries,
+                                              idempotent), jobs))
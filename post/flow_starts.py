@@ -0,0 +1,188 @@
+# coding=utf-8
+'''
+Flow start dispatcher, used by utils.start_run.
+
+Contacts are started in a flow, given by uuid (names.py finds it by name),
+through the v2 flow_starts endpoint in batches of BATCH_SIZE, the most it
+accepts, sent concurrently through dispatch.py. Every accepted batch is a flow start
+whose status (pending, starting, complete, failed) is then polled in the
+background. A post is never retried blindly, it could start the contacts
+twice: when its answer is lost (server error, timeout) the starts created
+since the submission are searched for the batch, and it is only sent again
+if it is not there. Batches still unknown after that are left as 'unknown':
+
+     In [1]: starts = utils.start_run(uuids, 'incentivesCollect5')
+     In [2]: starts.wait()
+     In [3]: starts.failed()
+
+'''
+
+import time
+import threading
+from datetime import datetime
+from collections import OrderedDict
+import pandas as pd
+import dispatch
+import session
+
+# RapidPro takes at most 100 contacts per flow start
+BATCH_SIZE = 100
+# Seconds between two checks of the status of the starts
+POLL_INTERVAL = 5
+# Seconds after which starts still running are no longer checked
+POLL_TIMEOUT = 30 * 60
+# Statuses of a flow start that no longer change
+FINAL_STATUS = ['complete', 'failed']
+RESULT_COLUMNS = ['batch', 'contacts', 'start_uuid', 'status', 'http_status', 'attempts',
+                  'error']
+
+class FlowStart(object):
+    '''
+        Start of contact_uuids in the flow flow_uuid. Batches are sent when
+        it is created; their status is checked by a background thread until
+        they are all complete or failed, or for timeout seconds.
+    '''
+    def __init__(self, flow_uuid, contact_uuids, restart_participants=True,
+                 workers=dispatch.WORKERS, rate=dispatch.RATE,
+                 poll_interval=POLL_INTERVAL, timeout=POLL_TIMEOUT):
+        self.flow_uuid = flow_uuid
+        self.workers = workers
+        self.rate = rate
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+        contacts = list(OrderedDict.fromkeys(uuid for uuid in contact_uuids if uuid))
+        self.batches = [contacts[start:start + BATCH_SIZE]
+                        for start in range(0, len(contacts), BATCH_SIZE)]
+        self.results = self.submit(restart_participants)
+        self.thread = threading.Thread(target=self.track)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def post(self, batches, restart_participants):
+        url = session.url('v2', 'flow_starts')
+        jobs = [('post', url, {'flow': self.flow_uuid, 'contacts': self.batches[n],
+                               'restart_participants': restart_participants})
+                for n in batches]
+        results = dispatch.dispatch(jobs, self.workers, self.rate, idempotent=False)
+        for result in results:
+            answer = result.pop('response') or {}
+            result['start_uuid'] = answer.get('uuid')
+            if result['status'] == 'ok':
+                result['status'] = answer.get('status') or 'pending'
+        return results
+
+    def find(self, batches, after):
+        '''
+            {batch: start} of the batches that have a start of the flow with
+            exactly their contacts, among the starts modified after `after`.
+        '''
+        wanted = dict((frozenset(self.batches[n]), n) for n in batches)
+        found = {}
+        limiter = dispatch.RateLimiter(self.rate)
+        url, params = session.url('v2', 'flow_starts'), {'after': after}
+        while url:
+            result = dispatch.send('get', url, params, limiter)
+            if result['status'] != 'ok':
+                raise IOError(result['error'])
+            page = result['response']
+            for start in page['results']:
+                contacts = frozenset(c['uuid'] for c in start.get('contacts') or [])
+                if (start.get('flow') or {}).get('uuid') == self.flow_uuid and contacts in wanted:
+                    found.setdefault(wanted[contacts], start)
+            url, params = page.get('next'), None
+        return found
+
+    def recover(self, results, after, restart_participants):
+        '''
+            Looks for the starts of the batches whose post got no answer and
+            sends again, once, the ones that were not created.
+        '''
+        unknown = [n for n, result in enumerate(results) if result['status'] == 'unknown']
+        if not unknown:
+            return
+        try:
+            found = self.find(unknown, after)
+        except (IOError, ValueError) as ex:
+            print("---> No se pudieron comprobar los inicios sin respuesta: %s" % ex)
+            return
+        for n, start in found.items():
+            results[n].update(status=start.get('status') or 'pending',
+                              start_uuid=start.get('uuid'), error=None)
+        missing = [n for n in unknown if n not in found]
+        for n, result in zip(missing, self.post(missing, restart_participants)):
+            result['attempts'] += results[n]['attempts']
+            results[n] = result
+
+    def submit(self, restart_participants):
+        after = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+        results = self.post(range(len(self.batches)), restart_participants)
+        self.recover(results, after, restart_participants)
+        return results
+
+    def pending(self):
+        with self.lock:
+            return [n for n, result in enumerate(self.results)
+                    if result['start_uuid'] and result['status'] not in FINAL_STATUS]
+
+    def track(self):
+        url = session.url('v2', 'flow_starts')
+        deadline = time.time() + self.timeout
+        try:
+            while self.pending() and time.time() < deadline:
+                time.sleep(self.poll_interval)
+                pending = self.pending()
+                checks = dispatch.dispatch([('get', url, {'uuid': self.results[n]['start_uuid']})
+                                            for n in pending], self.workers, self.rate)
+                with self.lock:
+                    for n, check in zip(pending, checks):
+                        starts = (check['response'] or {}).get('results') or []
+                        if starts:
+                            self.results[n]['status'] = starts[0]['status']
+        finally:
+            self.finished.set()
+
+    def done(self):
+        return self.finished.is_set()
+
+    def wait(self, timeout=None):
+        '''
+            Waits for the status of every start to be known and returns the
+            table.
+        '''
+        self.finished.wait(timeout)
+        return self.table()
+
+    def table(self):
+        '''
+            batch, contacts, start_uuid, status (failed when RapidPro did not
+            accept the batch, unknown when it is not known whether it did),
+            http_status, attempts and error of every batch.
+        '''
+        with self.lock:
+            rows = [dict(result, batch=n, contacts=len(self.batches[n]))
+                    for n, result in enumerate(self.results)]
+        return pd.DataFrame(rows, columns=RESULT_COLUMNS)
+
+    def failed(self):
+        '''
+            Table of the batches that failed or may not have started
+            (unknown), to check before starting them again.
+        '''
+        table = self.table()
+        return table[table['status'].isin(['failed', 'unknown'])]
+
+
+def start(flow_uuid, contact_uuids, restart_participants=True, workers=dispatch.WORKERS,
+          rate=dispatch.RATE):
+    '''
+        Starts contact_uuids in flow_uuid and returns the FlowStart that
+        tracks them.
+    '''
+    starts = FlowStart(flow_uuid, contact_uuids, restart_participants, workers, rate)
+    table = starts.table()
+    print("Inicios del flujo %s: %d contactos en %d lotes, rechazados: %d"
+          % (flow_uuid, table['contacts'].sum(), len(table.index),
+             table['status'].isin(['failed', 'unknown']).sum()))
+    return starts
@@ -6,45 +6,284 @@ RapidPro's Application Programming Interface.
 '''
 
 import os
-import configparser
 import json
-import requests
-import csv
-import pandas as pd
-from operator import itemgetter
-import pprint
-import sys
+import hashlib
+import re
+import sqlite3
 from datetime import datetime, timedelta
-import copy
 import time
 ############ rapidpro client ############
-import dateutil.parser
-from io import StringIO
+# temba_client, tailer, asyncio (aio.py) and the transform processes are
+# imported on first use
+from io import StringIO, BytesIO
 import os.path
-from temba_client.v2 import TembaClient
-import sys
-import tailer
+import session
+import shutil
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from six import string_types
+import dispatch
+import lazy
+import metrics
+# pandas and the modules built on it are imported on first use
+pd = lazy.module('pandas')
+columnar = lazy.module('columnar')
+phone_index = lazy.module('phone_index')
+names = lazy.module('names')
+segments = lazy.module('segments')
+sanitize = lazy.module('sanitize')
 
 #configuration
-config = configparser.ConfigParser()
-config.read('keys.ini')
-## Paths
-#processed_runs = config['paths']['processed_runs']
-root = config['paths']['root']
-raw_flows = config['paths']['raw_flows']
-raw_runs = config['paths']['raw_runs']
-raw_contacts = config['paths']['raw_contacts']
-raw_messages = config['paths']['raw_messages']
-raw_failed_messages = config['paths']['raw_failed_messages']
-raw_fields = config['paths']['raw_fields']
-raw_groups = config['paths']['raw_groups']
-## Rapidpro
-rp_api = config['rapidpro']['rp_api']
+## Paths: lazy.path('raw_flows'), 'raw_runs', 'raw_contacts', 'raw_messages',
+## 'raw_failed_messages', 'raw_fields' and 'raw_groups' (root + the path of
+## keys.ini), read on first use
 
 PRINT_PAGE = 100
 MAX_RETRY_ALL = 10
-PARTITION_NUMBER = 1000
+# Number of run partitions downloaded at the same time by export_runs
+RUN_WORKERS = 4
+# Partition sizing for export_runs (see RunPartitioner)
+RUN_TARGET_ROWS = 20000
+RUN_TARGET_BYTES = 64 * 1024 * 1024
+RUN_MIN_WINDOW = timedelta(hours=1)
+RUN_MAX_WINDOW = timedelta(days=92)
+RUN_HISTORY = 5
+# Processes that transform the runs of large partitions (see RunTransformer),
+# None for one per core. 1, or a machine with a single core, transforms them
+# in the exporting process (see run_processes)
+RUN_PROCESSES = None
+# Smaller partitions are transformed in the exporting process
+RUN_PROCESS_MIN = 2000
+# Runs shipped to a transform process at once
+RUN_PROCESS_BATCH = 500
+# Nothing was ever run in RapidPro before this date
+RUNS_EPOCH = datetime(2013, 1, 1)
+# Sidecar of runs.csv with the partitions already committed
+RUNS_MANIFEST = 'runs_manifest.json'
+# Directory of the runs segments (see segments.py), next to runs.csv
+RUNS_SEGMENTS = 'runs_segments'
+# Also append every new partition to runs.csv, for the scripts that read it
+RUNS_CSV = True
+# Write exports page by page instead of holding them in memory
+STREAM_EXPORTS = False
+# Output format of the exports: 'csv', 'parquet' or 'feather'
+EXPORT_FORMAT = 'csv'
+# Persistent cache of flow definitions (see FlowDefinitionCache)
+FLOW_CACHE = 'flow_definitions.sqlite'
+FLOW_CACHE_SIZE = 2000
+# Seconds before a flow without definition is asked for again
+FLOW_NEGATIVE_TTL = 24 * 60 * 60
+# Failed messages export (see GetFailedMessages)
+FAILED_WORKERS = 8
+FAILED_FOLDERS = ['failed', 'outbox']
+FAILED_STATUS = ['failed', 'errored']
+# Messages created this long before the last export are checked again,
+# they may have failed after it
+FAILED_OVERLAP = timedelta(days=2)
+# Filters that select a time range instead of a set of messages, exports
+# using them are never incremental (see GetMessages.export_messages)
+MESSAGES_RANGE = ['after', 'before']
+
+
+class PartitionTooLarge(Exception):
+    '''
+        Raised by ExportRuns.fetch_window when a partition holds more runs than
+        it is allowed to, so that it gets split before filling the memory.
+    '''
+    pass
+
+
+NESTED = (dict, list, tuple)
+
+
+def flatten_value(name, value, result):
+    '''
+        Generic flattening of value under the column name: dicts add
+        _key, lists add _index, lists directly within lists are dropped.
+    '''
+    if isinstance(value, dict):
+        for key in value:
+            flatten_value(name + '_' + key, value[key], result)
+    elif isinstance(value, (list, tuple)):
+        for index, element in enumerate(value):
+            if isinstance(element, dict):
+                prefix = name + '_' + str(index) + '_'
+                for key in element:
+                    flatten_value(prefix + key, element[key], result)
+            elif not isinstance(element, (list, tuple)):
+                result[name + '_' + str(index)] = element
+    else:
+        result[name] = value
+
+
+class DictPlan(object):
+    '''
+        Flattens dicts with the same keys, in the same order, as the sample
+        the plan was compiled from. Column names are computed once. Anything
+        else under this node goes through flatten_value.
+    '''
+    def __init__(self, name, sample):
+        self.name = name
+        self.keys = tuple(sample)
+        self.steps = []
+        for key in self.keys:
+            col = key if name is None else name + '_' + key
+            self.steps.append((key, col, compile_plan(col, sample[key])))
+
+    def apply(self, value, result):
+        if type(value) is not dict or tuple(value) != self.keys:
+            if self.name is None:
+                for key in value:
+                    flatten_value(key, value[key], result)
+            else:
+                flatten_value(self.name, value, result)
+            return
+        for key, col, plan in self.steps:
+            item = value[key]
+            if plan is not None:
+                plan.apply(item, result)
+            elif isinstance(item, NESTED):
+                flatten_value(col, item, result)
+            else:
+                result[col] = item
+
+
+class ListPlan(object):
+    '''
+        Flattens lists whose dict elements share the keys of the first dict
+        element of the sample. Column names are cached per index.
+    '''
+    def __init__(self, name, sample):
+        self.name = name
+        self.keys = None
+        for element in sample:
+            if type(element) is dict:
+                self.keys = tuple(element)
+                break
+        self.columns = []
+
+    def element_columns(self, index):
+        while len(self.columns) <= index:
+            prefix = self.name + '_' + str(len(self.columns))
+            self.columns.append((prefix, [(key, prefix + '_' + key)
+                                          for key in self.keys or ()]))
+        return self.columns[index]
+
+    def apply(self, value, result):
+        if not isinstance(value, (list, tuple)):
+            flatten_value(self.name, value, result)
+            return
+        for index, element in enumerate(value):
+            if self.keys is None and type(element) is dict:
+                # The sample had no dict elements, learn them from this one
+                self.keys = tuple(element)
+                self.columns = []
+            prefix, cols = self.element_columns(index)
+            if type(element) is dict and tuple(element) == self.keys:
+                for key, col in cols:
+                    item = element[key]
+                    if isinstance(item, NESTED):
+                        flatten_value(col, item, result)
+                    else:
+                        result[col] = item
+            elif isinstance(element, dict):
+                for key in element:
+                    flatten_value(prefix + '_' + key, element[key], result)
+            elif not isinstance(element, (list, tuple)):
+                result[prefix] = element
+
+
+def compile_plan(name, sample):
+    if type(sample) is dict:
+        return DictPlan(name, sample)
+    if isinstance(sample, (list, tuple)):
+        return ListPlan(name, sample)
+    return None
+
+
+class FlattenPlan(DictPlan):
+    '''
+        Flattening plan of a whole record, derived from a sample record.
+        Records (or parts of them) with a different shape fall back to the
+        generic flatten_value, so the columns are always the same as with
+        the recursive flattening.
+    '''
+    def __init__(self, sample):
+        super(FlattenPlan, self).__init__(None, sample)
+
+
+class CsvStreamWriter(object):
+    '''
+        Appends DataFrames (e.g. one per page) to a .csv without keeping them
+        in memory. Pages may bring new columns: they are added at the end and
+        the header is written on close, once all columns are known. Rows of
+        earlier pages just lack the trailing fields, which read as missing.
+        path is only replaced on close; abort drops what was written and
+        leaves the previous export as it was.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.body = path + '.part'
+        self.columns = []
+        self.records = 0
+        self.f = open(self.body, 'w', encoding='utf-8', newline='')
+
+    def write(self, df):
+        if df is None or len(df.index) == 0:
+            return
+        with metrics.stage('write') as s:
+            known = set(self.columns)
+            self.columns += [c for c in df.columns if c not in known]
+            start = self.f.tell()
+            df.reindex(columns=self.columns).to_csv(self.f, header=False, index=False)
+            self.records += len(df.index)
+            s.records = len(df.index)
+            s.bytes = self.f.tell() - start
+
+    @metrics.timed('write')
+    def close(self):
+        self.f.close()
+        tmp = self.path + '.tmp'
+        try:
+            with open(tmp, 'w', encoding='utf-8', newline='') as out:
+                if self.columns:
+                    pd.DataFrame(columns=self.columns).to_csv(out, index=False)
+                with open(self.body, encoding='utf-8', newline='') as body:
+                    shutil.copyfileobj(body, out)
+            os.replace(tmp, self.path)
+        finally:
+            self.abort()
+        return self.records
+
+    def abort(self):
+        '''
+            Removes the partial files, path is left untouched.
+        '''
+        self.f.close()
+        for partial in (self.body, self.path + '.tmp'):
+            if os.path.isfile(partial):
+                os.remove(partial)
+
+
+_flows = {}
+_flows_lock = threading.Lock()
+
+
+def flows_table():
+    '''
+        The flows export (root + raw_flows, or its columnar copy), read on
+        first use and again only when the file changes. Shared by every
+        instance, so it must not be modified.
+    '''
+    path = columnar.locate(lazy.path('raw_flows'))
+    mtime = os.path.getmtime(path)
+    with _flows_lock:
+        cached = _flows.get(path)
+        if cached is None or cached[0] != mtime:
+            _flows[path] = (mtime, columnar.read_table(path))
+        return _flows[path][1]
+
 
 class Get(object):
 
@@ -52,17 +291,23 @@ class Get(object):
         Encompasses all functions related to getting RapidPro messages and
         incorporating them to our master dataset.
     '''
-    def __init__(self):
-        super(Get, self).__init__()
-        #We dont need all flows updates in this moment
-        try:
-            self.df_raw_flows = pd.read_csv(root + raw_flows)
-        except Exception:
-            pass
-        ############ rapidpro client ############d
-        # rp_api format: 'Token value', TembaClient use value
-        token = rp_api.split(' ')[1]
-        self.client_io = TembaClient('rapidpro.io',token)
+    # Columns cleaned by clean (see sanitize.py), None for every text column
+    TEXT_COLUMNS = []
+
+    @property
+    def df_raw_flows(self):
+        '''
+            The flows export, loaded on first use (see flows_table).
+        '''
+        return flows_table()
+
+    ############ rapidpro client ############
+    @property
+    def client_io(self):
+        '''
+            Shared by all instances and created on first use, see session.py
+        '''
+        return session.temba_client()
 
     def get_client_request(self,before=None, after = None):
         '''
@@ -74,53 +319,25 @@ class Get(object):
 
     def flatten_dict(self, d, result = None):
         '''
-            Recursively flattens a dictionary. The only requirement is that
+            Flattens a dictionary. The only requirement is that
             the dictionary does not have a list within directly contained
             in another list, e.g. {'a':1, 'b':2, 'c':[3, 2, [1, 2, 3]]} no.
             Yes: {'antes':{'a':{'i':11, 'ii':13, 'iii':{'qwer':21}}},
                     'b':2, 'c':[3, 2, {'q':21, 'r':222, 'k':[1, 2, 3]}]}
+            The first record compiles a FlattenPlan that is reused for every
+            record of this resource type.
         '''
 
         if result is None:
             result = {}
-
-        for key in d:
-            value = d[key]
-
-            if isinstance(value, dict):
-                value1 = {}
-                for keyIn in value:
-                    value1["_".join([key,keyIn])]=value[keyIn]
-                self.flatten_dict(value1, result)
-
-            elif isinstance(value, (list, tuple)):
-                for indexB, element in enumerate(value):
-
-                    if isinstance(element, dict):
-                        value1 = {}
-                        index = 0
-
-                        for keyIn in element:
-                            newkey = "_".join([key, str(indexB),keyIn])
-                            value1[newkey]=value[indexB][keyIn]
-                            index += 1
-
-                        for keyA in value1:
-                            self.flatten_dict(value1, result)
-
-                    elif isinstance(element, (list, tuple)):
-                        pass
-
-                    else:
-                        newkey = "_".join([key,str(indexB)])
-                        result[newkey] = element
-
-            else:
-                result[key]=value
-
+        plan = getattr(self, 'flatten_plan', None)
+        if plan is None:
+            plan = self.flatten_plan = FlattenPlan(d)
+        plan.apply(d, result)
         return result
 
 
+    @metrics.timed('to_df', records=metrics.rows)
     def to_df(self,result_list):
         '''
             Runs a request, extracts messages and assembles them.
@@ -129,9 +346,32 @@ class Get(object):
         for dic in result_list:
             flatDicts.append(self.flatten_dict(dic.serialize()))
         print ("Procesados %d registros"% len(result_list))
-        return pd.DataFrame.from_records(flatDicts)
+        return self.clean(pd.DataFrame.from_records(flatDicts))
+
+    def clean(self, df):
+        '''
+            Removes from TEXT_COLUMNS the characters that break our .csv
+            imports, a whole column at a time.
+        '''
+        if self.TEXT_COLUMNS is None or self.TEXT_COLUMNS:
+            sanitize.clean_frame(df, self.TEXT_COLUMNS)
+        return df
 
 
+    def get_query(self, parameters = {}):
+        '''
+            Returns the temba_client query for parameters, to be fetched
+            all at once or page by page.
+        '''
+        if "before" in  parameters or "after" in parameters:
+            before = parameters['before'] if "before" in parameters else ""
+            after = parameters['after'] if "after" in parameters else ""
+            print ("after=%s&before=%s" %(after,before))
+            return self.get_client_request(before =before, after = after)
+        else:
+            return self.get_client_request(parameters)
+
+    @metrics.timed('append_df', records=metrics.rows)
     def append_df(self, parameters = {}, partition=False):
         '''
             Extracts all elements in multiple pages in a looping fashion,
@@ -141,15 +381,7 @@ class Get(object):
             Returns the appended DataFrame.
         '''
         #No we use client temba
-
-        dfList = []
-        if "before" in  parameters or "after" in parameters:
-            before = parameters['before'] if "before" in parameters else ""
-            after = parameters['after'] if "after" in parameters else ""
-            print ("after=%s&before=%s" %(after,before))
-            result_list = self.get_client_request(before =before, after = after).all(retry_on_rate_exceed=True)
-        else:
-            result_list = self.get_client_request(parameters).all(retry_on_rate_exceed=True)
+        result_list = self.get_query(parameters).all(retry_on_rate_exceed=True)
 
         df = self.to_df(result_list)
         # Append dataframes in a single one
@@ -159,56 +391,230 @@ class Get(object):
         else:
             return df
 
+    def open_writer(self, path, fmt=EXPORT_FORMAT):
+        '''
+            Returns a writer (write(df), close(), abort()) for path in format
+            fmt. Columnar formats replace the extension of path.
+        '''
+        if fmt == 'csv':
+            return CsvStreamWriter(path)
+        return columnar.ColumnarWriter(columnar.output_path(path, fmt), fmt)
+
+    def save_df(self, df, path, fmt=EXPORT_FORMAT):
+        '''
+            Saves a whole DataFrame to path in format fmt.
+        '''
+        if fmt == 'csv':
+            with metrics.stage('write') as s:
+                df.to_csv(path, encoding='utf-8', index = False)
+                s.records = len(df.index)
+                s.bytes = os.path.getsize(path)
+        else:
+            writer = self.open_writer(path, fmt)
+            try:
+                writer.write(df)
+            except BaseException:
+                writer.abort()
+                raise
+            writer.close()
+
+    def stream_table(self, path, parameters = {}, fmt=EXPORT_FORMAT):
+        '''
+            Downloads page by page, flattening each page and appending it to
+            path as soon as it arrives, so memory is bounded by the page size
+            instead of the dataset size. The next page downloads while the
+            current one is flattened (see aio.py).
+            Returns the number of records written.
+        '''
+        import aio
+        return aio.run(aio.stream_table(self, path, parameters, fmt))[0]
+
+    def export_table(self, path, parameters = {}, stream=STREAM_EXPORTS,
+                     fmt=EXPORT_FORMAT):
+        '''
+            Downloads parameters' request and saves it to path in format fmt
+            ('csv', 'parquet' or 'feather'), page by page when stream is True.
+        '''
+        if stream:
+            return self.stream_table(path, parameters, fmt)
+        df = self.append_df(parameters)
+        self.save_df(df, path, fmt)
+        return len(df.index)
+
     def uuid_flow(self, flow):
         '''
             type(flow) = str
             Returns the UUID that corresponds with the name of the flow.
-            Notice: this dataset is generated by the Get_flows module.
+            Notice: names are resolved with the flows export generated by
+            the Get_flows module (see names.py).
         '''
+        uuid = names.uuid('flows', flow)
+        if uuid is None:
+            raise ValueError("Unknown flow %s" % flow)
+        return uuid
 
-        # Import dataset into dataframe
-        df = self.df_raw_flows
-        # Narrow on observations with desired flow name
-        rows = df.loc[df['name']==flow, 'uuid']
 
 
-        # Policy: if there are many rows, return first value
-        return rows.iloc[0]
+class FlowDefinitionCache(object):
+    '''
+        Persistent cache of flow definitions keyed by flow uuid. A definition
+        is valid while the flow's modified_on (from the flows export) does not
+        change. Flows without a definition are remembered for negative_ttl
+        seconds. Beyond max_flows the least recently used flows are evicted.
+    '''
+    def __init__(self, path, max_flows=FLOW_CACHE_SIZE,
+                 negative_ttl=FLOW_NEGATIVE_TTL):
+        self.max_flows = max_flows
+        self.negative_ttl = negative_ttl
+        # Callers serialize the access (see GetFlowDefinition.lock)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS flows (
+                               uuid TEXT PRIMARY KEY,
+                               modified_on TEXT,
+                               fetched_at REAL,
+                               used_at REAL,
+                               definition TEXT)''')
+        self.db.commit()
+
+    def get(self, uuid, modified_on=None):
+        '''
+            Returns the cached definition, {} for a flow known to have none,
+            or None when it has to be downloaded. modified_on=None accepts
+            any cached version.
+        '''
+        row = self.db.execute('SELECT modified_on, fetched_at, definition '
+                              'FROM flows WHERE uuid = ?', (uuid,)).fetchone()
+        if row is None:
+            return None
+        cached_modified_on, fetched_at, definition = row
+        if definition is None:
+            if time.time() - fetched_at > self.negative_ttl:
+                return None
+        elif modified_on is not None and cached_modified_on != modified_on:
+            return None
+        self.db.execute('UPDATE flows SET used_at = ? WHERE uuid = ?',
+                        (time.time(), uuid))
+        self.db.commit()
+        return {} if definition is None else json.loads(definition)
 
+    def put(self, uuid, modified_on, definition):
+        '''
+            definition=None records that the flow has no definition.
+        '''
+        now = time.time()
+        self.db.execute('INSERT OR REPLACE INTO flows VALUES (?, ?, ?, ?, ?)',
+                        (uuid, modified_on, now, now,
+                         None if definition is None else json.dumps(definition)))
+        self.db.execute('DELETE FROM flows WHERE uuid IN (SELECT uuid FROM flows '
+                        'ORDER BY used_at DESC LIMIT -1 OFFSET ?)', (self.max_flows,))
+        self.db.commit()
 
 
 class GetFlowDefinition():
-    def __init__(self, client_io):
+    def __init__(self, client_io, cache_path=None):
         self.flow_dict = {}
-        self.DEFINITION="https://app.rapidpro.io/api/v2/definitions.json"
-        self.token = rp_api.split(' ')[1]
+        self.DEFINITION = session.url('v2', 'definitions')
 
         self.client_io = client_io
+        # export_runs may look up definitions from several worker threads
+        self.lock = threading.Lock()
+        # flow uuid -> node uuid -> type and text of its first action
+        self.node_index = {}
+        self.cache = FlowDefinitionCache(cache_path or lazy.path('raw_runs') + FLOW_CACHE)
+        self.versions = self.flow_versions()
+        self.downloads = 0
+        # Holds the downloads while RapidPro asks to wait
+        self.limiter = dispatch.RateLimiter()
+
+    def flow_versions(self):
+        '''
+            modified_on of every flow in the flows export, by uuid.
+            Empty if flows were never exported.
+        '''
+        try:
+            df = flows_table()[['uuid', 'modified_on']]
+        except Exception:
+            return {}
+        dates = pd.to_datetime(df['modified_on'], utc=True, errors='coerce')
+        return dict((uuid, None if pd.isnull(date) else date.isoformat())
+                    for uuid, date in zip(df['uuid'], dates))
 
     def get_definition_flow(self, flow):
-        token = 'token %s' % self.token
-        url= self.DEFINITION + "?flow="+str(flow)+"&dependencies=none"
-        headers = {'content-type': 'application/json', 'Authorization': token}
-        r = requests.get(url, headers = headers)
-        return r.json()
+        '''
+            Definitions answered for flow. 429 and server errors are retried
+            (see dispatch.send); raises IOError when the API does not answer
+            200, so that a throttled request is never taken for a flow
+            without definition.
+        '''
+        result = dispatch.send('get', self.DEFINITION,
+                               {'flow': flow, 'dependencies': 'none'}, self.limiter)
+        if result['status'] != 'ok':
+            raise IOError("No se pudo descargar la definición del flujo %s: %s %s"
+                          % (flow, result['http_status'], result['error']))
+        return result['response'] or {}
+
+    def index_nodes(self, flow):
+        '''
+            Lookup table from node uuid to the type and text of the first
+            action of its action set, built once per flow. None for a flow
+            without definition. Rulesets are not indexed.
+        '''
+        if not flow:
+            return None
+        index = {}
+        for action_set in flow.get('action_sets', []):
+            if action_set['uuid'] in index or not action_set['actions']:
+                continue
+            action_def = action_set['actions'][0]
+            node = {'type': action_def['type']}
+            if "msg" in action_def:
+                if isinstance(action_def['msg'], dict) and 'spa' in action_def['msg']:
+                    #Spanish messages have different config
+                    node['text'] = action_def['msg']['spa']
+                else:
+                    node['text'] = action_def['msg']
+            index[action_set['uuid']] = node
+        return index
+
+    def add_flow(self, uuid, flow):
+        self.flow_dict[uuid] = flow
+        self.node_index[uuid] = self.index_nodes(flow)
 
     def search_flow(self, uuid):
+        with self.lock:
+            return self._search_flow(uuid)
+
+    def search_index(self, uuid):
+        '''
+            Node lookup table of the flow (see index_nodes).
+        '''
+        with self.lock:
+            self._search_flow(uuid)
+            return self.node_index[uuid]
+
+    @metrics.timed('flow_lookup')
+    def _search_flow(self, uuid):
         if uuid in self.flow_dict.keys():
             return self.flow_dict[uuid]
-        else:
-            #We have to ask for the definition of flow
-            definition = self.get_definition_flow(uuid)
-            #definition = self.client_io.get_definitions(flows=uuid, dependencies='none')
-            if definition["flows"]:
-                #Add all flows of metadata info#
-                for flow in definition["flows"]:
-                    self.flow_dict[flow['metadata']['uuid']] = flow
-                #If flow uuid exist
-                if uuid in self.flow_dict:
-                    return self.flow_dict[uuid]
-            else :
-                self.flow_dict[uuid] = {}
-            return {}
+        cached = self.cache.get(uuid, self.versions.get(uuid))
+        if cached is not None:
+            self.add_flow(uuid, cached)
+            return cached
+        #We have to ask for the definition of flow
+        definition = self.get_definition_flow(uuid)
+        self.downloads += 1
+        metrics.count('flow_definition_downloads')
+        #definition = self.client_io.get_definitions(flows=uuid, dependencies='none')
+        #Add all flows of metadata info#
+        #Only a 200 without the flow means that it has no definition
+        for flow in definition.get("flows") or []:
+            flow_uuid = flow['metadata']['uuid']
+            self.add_flow(flow_uuid, flow)
+            self.cache.put(flow_uuid, self.versions.get(flow_uuid), flow)
+        if uuid not in self.flow_dict:
+            self.add_flow(uuid, {})
+            self.cache.put(uuid, self.versions.get(uuid), None)
+        return self.flow_dict[uuid]
 
 
 class GetRuns(Get):
@@ -247,8 +653,13 @@ class GetRuns(Get):
             value_nodes[value_entry['node']]['label'] = key
             mistake_nodes[value_entry['node']] = 0
 
-        flow_def = flow_manager.search_flow(run['flow']['uuid'])
-        path_nodes = set([path['node'] for path in run['path']])
+        nodes_def = flow_manager.search_index(run['flow']['uuid'])
+        # First step of every node, in a single pass over the path
+        first_steps = {}
+        for path in run['path']:
+            first = first_steps.get(path['node'])
+            if first is None or path['time'] < first['time']:
+                first_steps[path['node']] = path
 
         #Check mistakes
         for idx in range(len(run['path'])-2):
@@ -257,37 +668,28 @@ class GetRuns(Get):
                     mistake_nodes[run['path'][idx]['node']] += 1
         # Add field 'origin' to steps and values
 
-        for node in path_nodes:
+        for node in first_steps:
             entry = {}
             #Now, check if entry exist in values
-            if node in value_nodes.keys():
+            if node in value_nodes:
                 entry = value_nodes[node]
                 entry['origin'] = 'values'
                 entry['type'] = None
                 entry['mistakes'] = mistake_nodes[node]
                 run_result['entries'].append(entry)
             else:
-                entry = sorted([path for path in run['path']if path["node"]== node],
-                key =lambda x : x['time'])[0]
+                entry = first_steps[node]
                 entry['origin'] = 'steps'
                 entry['category'] = None
                 entry['label'] = 0
                 entry['mistakes'] = 0
                 entry['value'] = None
-                if not flow_def:
+                if nodes_def is None:
                     entry['text'] = "unknown flow"
                     entry['type'] = "unknown flow"
                 else:
-                    action_def =[act['actions'] for act in flow_def['action_sets'] if act['uuid']== node]
-                    if action_def: #We are not working with ruleset
-                        action_def = action_def[0][0]
-                        if "msg" in action_def:
-                            if 'spa' in action_def['msg']:
-                                #Spanish messages have different config
-                                entry['text'] = action_def['msg']['spa']
-                            else:
-                                entry['text'] = action_def['msg']
-                        entry['type'] = action_def['type']
+                    if node in nodes_def: #We are not working with ruleset
+                        entry.update(nodes_def[node])
                     run_result['entries'].append(entry)
         return run_result
 
@@ -296,25 +698,17 @@ class ProcessRuns(Get):
     '''
         Inherited class that adds key information to runs data
     '''
-    def __init__(self):
-        super(ProcessRuns, self).__init__()
-        self.df_raw_flows = pd.read_csv(root + raw_flows)
-
-
-
     def tweaks(self, run):
         '''
             Executes multiple minor procedures:
-                Remove ugly characters
+                Empty missing values
                 Sort steps
                 Add chronological numbering to every step in 'steps_fdv'
                 Add flow name to run-level data
         '''
-        # Remove ugly chars
+        # Missing values
         for step in run['entries']:
-            if type(step['value']) == str:
-                step['value'] = str(step['value'].encode(sys.stdout.encoding, errors='replace'))
-            elif isinstance(step['value'], (str, type(None))):
+            if step['value'] is None:
                 step['value'] = ''
         # Sort steps chronologically
         run['entries'] = sorted(run['entries'],
@@ -331,29 +725,215 @@ class ProcessRuns(Get):
 
 
 
-class ExportRuns(Get):
+class RunPartitioner(object):
     '''
-        Inherited class that exports runs get requests to .csv
+        Chooses the bounds of the runs partitions downloaded by export_runs.
+        The size of the next partition is estimated from the density (runs and
+        bytes per second) of the last partitions, aiming at target_rows runs
+        and target_bytes of .csv per partition. Quiet periods are merged in a
+        single partition, growing at most four times per step.
     '''
-    def __init__(self):
-        super(ExportRuns, self).__init__()
-        self.flow_manager = GetFlowDefinition(self.client_io)
+    def __init__(self, target_rows=RUN_TARGET_ROWS, target_bytes=RUN_TARGET_BYTES,
+                 min_window=RUN_MIN_WINDOW, max_window=RUN_MAX_WINDOW,
+                 history=RUN_HISTORY):
+        self.target_rows = target_rows
+        self.target_bytes = target_bytes
+        self.min_window = min_window
+        self.max_window = max_window
+        self.window = timedelta(days=1)
+        # (seconds, rows, bytes) of the last partitions
+        self.recent = deque(maxlen=history)
+
+    def row_budget(self):
+        '''
+            Runs a partition should hold, taking bytes per run into account.
+        '''
+        rows = sum(r for seconds, r, nbytes in self.recent)
+        nbytes = sum(b for seconds, r, b in self.recent)
+        budget = self.target_rows
+        if rows and nbytes:
+            budget = min(budget, int(self.target_bytes * rows / nbytes))
+        return max(budget, 1)
+
+    def max_rows(self, after, before):
+        '''
+            Runs above which the partition [after, before) is split in half.
+            None when the partition is already too small to be split.
+        '''
+        if (before - after) / 2 < self.min_window:
+            return None
+        return 2 * self.row_budget()
 
-    ############ rapidpro client ############
-    def get_client_request(self,before = None, after = None):
+    def next_bound(self, after, end):
+        '''
+            Upper bound of the partition that starts at after, never past end.
+        '''
+        seconds = sum(s for s, rows, nbytes in self.recent)
+        rows = sum(r for s, r, nbytes in self.recent)
+        if rows:
+            window = timedelta(seconds=seconds * self.row_budget() / float(rows))
+        elif self.recent:
+            window = self.max_window
+        else:
+            window = self.window
+        window = min(window, 4 * self.window, self.max_window)
+        self.window = max(window, self.min_window)
+        before = after + self.window
+        # Do not leave a tail smaller than the minimum partition
+        if before + self.min_window >= end:
+            return end
+        return before
+
+    def observe(self, after, before, rows, nbytes):
+        self.recent.append(((before - after).total_seconds(), rows, nbytes))
+
+    def split(self, after, before, rows):
+        '''
+            Registers that [after, before) held more than rows runs and
+            returns the middle point to split it.
+        '''
+        nbytes = 0
+        known_rows = sum(r for s, r, b in self.recent)
+        if known_rows:
+            nbytes = rows * sum(b for s, r, b in self.recent) / known_rows
+        self.observe(after, before, rows, nbytes)
+        return after + (before - after) / 2
 
-        return self.client_io.get_runs(before = before, after=after)
 
+class RunsManifest(object):
+    '''
+        Sidecar of runs.csv that records every committed partition: its
+        bounds, number of runs, columns, byte offsets within runs.csv and a
+        sha1 of those bytes. It is rewritten atomically after each partition,
+        so a killed export resumes right after the last good partition.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.partitions = []
+        if os.path.isfile(path):
+            with open(path) as f:
+                self.partitions = json.load(f)['partitions']
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'partitions': self.partitions}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def reset(self):
+        '''
+            Forgets all partitions, e.g. after runs.csv was rewritten.
+        '''
+        self.partitions = []
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+    def end(self, file_run):
+        '''
+            Offset right after the last committed partition. runs.csv files
+            written before the manifest existed are trusted as a whole.
+        '''
+        if self.partitions:
+            return self.partitions[-1]['end']
+        if os.path.isfile(file_run):
+            return os.path.getsize(file_run)
+        return 0
+
+    def record(self, after, before, rows, columns, start, data):
+        self.partitions.append({'after': after.isoformat(),
+                                'before': before.isoformat(),
+                                'rows': rows,
+                                'columns': columns,
+                                'start': start,
+                                'end': start + len(data),
+                                'sha1': hashlib.sha1(data).hexdigest()})
+        self.save()
+
+    def checksum(self, file_run, start, end):
+        digest = hashlib.sha1()
+        with open(file_run, 'rb') as f:
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = f.read(min(remaining, 1 << 20))
+                if not chunk:
+                    return None
+                digest.update(chunk)
+                remaining -= len(chunk)
+        return digest.hexdigest()
+
+    def resume(self, file_run):
+        '''
+            Drops the partitions whose bytes in runs.csv are missing or do not
+            match their checksum, truncates whatever was written after the
+            last good one and returns the date to resume from (None if no
+            partition survived).
+        '''
+        size = os.path.getsize(file_run) if os.path.isfile(file_run) else 0
+        good_end = size
+        dropped = False
+        while self.partitions:
+            last = self.partitions[-1]
+            if (last['end'] <= size and
+                    self.checksum(file_run, last['start'], last['end']) == last['sha1']):
+                good_end = last['end']
+                break
+            print ("---> Division [%s, %s) incompleta, se descarga de nuevo"
+                   % (last['after'], last['before']))
+            good_end = last['start']
+            self.partitions.pop()
+            dropped = True
+        if dropped:
+            self.save()
+        if size > good_end:
+            if good_end == 0:
+                os.remove(file_run)
+            else:
+                with open(file_run, 'r+b') as f:
+                    f.truncate(good_end)
+        if not self.partitions:
+            return None
+        return segments.parse_date(self.partitions[-1]['before'])
+
+
+class StaticFlowIndex(object):
+    '''
+        Node indexes shipped to a transform process, with the search_index
+        of GetFlowDefinition that select_data uses.
+    '''
+    def __init__(self, indexes):
+        self.indexes = indexes
+
+    def search_index(self, uuid):
+        return self.indexes[uuid]
+
+
+class RunTransformer(object):
+    '''
+        Turns serialized runs into runs.csv entries: select_data, tweaks and
+        flattening of every entry with the run-level keys. One lives in the
+        exporting process and one in every transform process.
+    '''
+    # v2 runs have no id with temba_client 2.21: uuid identifies them
+    COMMON_KEYS = [u'exited_on', u'flow', u'responded', u'created_on', u'contact',
+                   u'modified_on', u'uuid', u'exit_type']
+
+    def __init__(self):
+        self.getter = GetRuns()
+        self.processer = ProcessRuns()
 
     def add_common_key_entry(self, run, entry_dict, common_keys):
         primitive = (string_types, bool,int, float, complex)
         for key in common_keys:
             #Entries was added in last step
-            if type(run[key]) is dict:
-                for key2 in run[key].keys():
-                    entry_dict[key+'_'+key2] = run[key][key2]
-            elif isinstance(run[key], primitive):
-                entry_dict[key] = run[key]
+            value = run.get(key)
+            if type(value) is dict:
+                for key2 in value.keys():
+                    entry_dict[key+'_'+key2] = value[key2]
+            elif isinstance(value, primitive):
+                entry_dict[key] = value
             else:
                 pass
         return entry_dict
@@ -364,144 +944,401 @@ class ExportRuns(Get):
             Also, it flattens the category, within 'steps_fdv'
         '''
         dic_entries = []
-        common_keys = [u'exited_on', u'flow', u'responded', u'created_on', u'contact', u'modified_on', u'id', u'exit_type']
-
         for run in runs:
             for entry in run['entries']:
-                dic_entries.append(self.add_common_key_entry(run, entry, common_keys))
+                dic_entries.append(self.add_common_key_entry(run, entry, self.COMMON_KEYS))
             if not run['entries']:
-                dic_entries.append(self.add_common_key_entry(run, {}, common_keys ))
+                dic_entries.append(self.add_common_key_entry(run, {}, self.COMMON_KEYS))
+        return dic_entries
+
+    def transform(self, raw_runs, flow_manager):
+        runs = []
+        for raw_run in raw_runs:
+            run = self.getter.select_data(raw_run, flow_manager)
+            run = self.processer.tweaks(run)
+            runs.append(run)
+        return self.flatten_runs(runs)
+
+
+# RunTransformer of a transform process
+_run_worker = None
+
+
+def run_processes():
+    '''
+        Transform processes of export_runs: RUN_PROCESSES, one per core by
+        default, and 1 (no pool) with a single core, where the pool is
+        only overhead.
+    '''
+    cores = os.cpu_count() or 1
+    if cores <= 1:
+        return 1
+    return RUN_PROCESSES or cores
 
 
-        entries_df = pd.DataFrame(dic_entries)
-        return entries_df
+def init_run_worker():
+    global _run_worker
+    _run_worker = RunTransformer()
+
+
+def transform_run_batch(raw_runs, indexes):
+    '''
+        Runs in a transform process: entries of raw_runs, whose flows have
+        the node indexes in indexes.
+    '''
+    return _run_worker.transform(raw_runs, StaticFlowIndex(indexes))
+
+
+class ExportRuns(Get):
+    '''
+        Inherited class that exports runs get requests to .csv
+    '''
+    # Only the messages of the flow are free text: answers (value), categories
+    # and uuids are exported as RapidPro returns them
+    TEXT_COLUMNS = ['text']
+
+    def __init__(self):
+        super(ExportRuns, self).__init__()
+        self.flow_manager = GetFlowDefinition(self.client_io)
+        self.manifest = RunsManifest(lazy.path('raw_runs') + RUNS_MANIFEST)
+        self.store = segments.SegmentStore(lazy.path('raw_runs') + RUNS_SEGMENTS)
+        self.transformer = RunTransformer()
+        # run_processes(), 1 turns the process pool off
+        self.processes = run_processes()
+        self.pool = None
+        self.pool_lock = threading.Lock()
+
+    ############ rapidpro client ############
+    def get_client_request(self,before = None, after = None):
+
+        return self.client_io.get_runs(before = before, after=after)
 
 
+    def run_pool(self):
+        '''
+            Pool of self.processes transform processes, shared by the
+            download threads. export_runs starts it before them: its
+            processes are forked at once on the first task, and forking
+            while other threads run can copy locks they hold.
+        '''
+        with self.pool_lock:
+            if self.pool is None:
+                from concurrent.futures import ProcessPoolExecutor
+                self.pool = ProcessPoolExecutor(max_workers=self.processes,
+                                                initializer=init_run_worker)
+                self.pool.submit(os.getpid).result()
+            return self.pool
+
+    def close(self):
+        with self.pool_lock:
+            if self.pool is not None:
+                self.pool.shutdown(wait=True)
+                self.pool = None
+
+    @metrics.timed('to_df', records=metrics.rows)
     def to_df(self, result_list):
         '''
             This function overrides the one in getMom.
             It is a wrapper: gets data, processes, flattens and returns
             a pandas df.
+            Partitions of RUN_PROCESS_MIN runs or more are transformed by
+            the process pool in batches of RUN_PROCESS_BATCH runs, shipped
+            with the node index of their flows and collected in order.
         '''
         # Get
-        getter = GetRuns()
-        processer = ProcessRuns()
-        raw_runs = []
-        runs = []
-        for dic in result_list:
-            raw_runs.append(dic.serialize())
-        for raw_run in raw_runs:
-            run = getter.select_data(raw_run,self.flow_manager)
-            run = processer.tweaks(run)
-            runs.append(run)
+        raw_runs = [dic.serialize() for dic in result_list]
+        if self.processes <= 1 or len(raw_runs) < RUN_PROCESS_MIN:
+            entries = self.transformer.transform(raw_runs, self.flow_manager)
+        else:
+            # Definitions are downloaded here, workers only get the indexes
+            flows = set(run['flow']['uuid'] for run in raw_runs)
+            indexes = dict((uuid, self.flow_manager.search_index(uuid)) for uuid in flows)
+            pool = self.run_pool()
+            futures = []
+            for start in range(0, len(raw_runs), RUN_PROCESS_BATCH):
+                batch = raw_runs[start:start + RUN_PROCESS_BATCH]
+                batch_indexes = dict((uuid, indexes[uuid]) for uuid in
+                                     set(run['flow']['uuid'] for run in batch))
+                futures.append(pool.submit(transform_run_batch, batch, batch_indexes))
+            entries = []
+            for future in futures:
+                entries += future.result()
         # Export
-        return self.flatten_runs(runs)
+        return self.clean(pd.DataFrame(entries))
 
-    def append_to_csv(self, df, header="False"):
-        file_run = root + raw_runs + 'runs.csv'
-        if not df is None:
-            with open(file_run, 'a') as f:
-                df.replace({'"':'', "'":'', ";":'', ",":'', '\u2013':'', '\u2026':'', '\r\n': '',u'\u23CE':'',u'☭':''}, regex=True)
-                try:
-                    df.to_csv(f, header=header,index=False, encoding='utf-8')
-                except UnicodeEncodeError:
-                    df.fillna(value="", inplace=True)
-                    for column in df:
-                        df[column] = df[column].apply(lambda x: ''.join([" " if ord(i) < 32 or ord(i) > 126 else i for i in str(x)]))
-                    df.to_csv(f, header=header,index=False, encoding='utf-8')
+    def to_csv_bytes(self, df, header):
+        '''
+            Renders df (already cleaned by to_df) as runs.csv lines.
+            Characters utf-8 cannot encode (lone surrogates) become '?'.
+        '''
+        return df.to_csv(header=header, index=False).encode('utf-8', errors='replace')
+
+    def append_to_csv(self, data, rows, columns, after, before):
+        '''
+            Writes the partition [after, before) (data is its .csv with
+            header) right after the last one committed in the manifest,
+            dropping anything a killed export left half written, and records
+            it in the manifest.
+        '''
+        file_run = lazy.path('raw_runs') + 'runs.csv'
+        start = self.manifest.end(file_run)
+        if start > 0 and data:
+            # runs.csv only has the header of its first partition
+            data = data[data.index(b'\n') + 1:]
+        with open(file_run, 'r+b' if os.path.isfile(file_run) else 'wb') as f:
+            f.seek(start)
+            f.truncate()
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self.manifest.record(after, before, rows, columns, start, data)
+
+    def commit_window(self, df, after, before):
+        '''
+            Adds the partition [after, before) to the runs segments and, with
+            RUNS_CSV, to runs.csv. Returns the number of bytes of its segment.
+        '''
+        data = b''
+        columns = []
+        rows = 0
+        if df is not None:
+            data = self.to_csv_bytes(df, header=True)
+            columns = [str(c) for c in df.columns]
+            rows = len(df.index)
+        with metrics.stage('write') as s:
+            self.store.add(after, before, data, rows, columns)
+            if RUNS_CSV:
+                self.append_to_csv(data, rows, columns, after, before)
+            s.records = rows
+            s.bytes = len(data)
+        return len(data)
+
+    def seed_segments(self, file_run):
+        '''
+            Turns a runs.csv exported before the segments existed into
+            segments: one per partition of its manifest or, without
+            manifest, a single one up to its last run.
+        '''
+        print ("---> Creando los segmentos de %s" % file_run)
+        if self.manifest.partitions:
+            with open(file_run, 'rb') as f:
+                for partition in self.manifest.partitions:
+                    f.seek(partition['start'])
+                    data = f.read(partition['end'] - partition['start'])
+                    if partition['start'] > 0 and partition['rows']:
+                        header = pd.DataFrame(columns=partition['columns']).to_csv(index=False)
+                        data = header.encode('utf-8') + data
+                    self.store.add(segments.parse_date(partition['after']),
+                                   segments.parse_date(partition['before']),
+                                   data, partition['rows'], partition['columns'])
+        else:
+            with open(file_run, 'rb') as f:
+                data = f.read()
+            df = pd.read_csv(BytesIO(data), dtype=str)
+            before = self.legacy_base_date(file_run)
+            columns = [str(c) for c in df.columns]
+            self.store.add(RUNS_EPOCH, before, data, len(df.index), columns)
+            self.manifest.record(RUNS_EPOCH, before, len(df.index), columns, 0, data)
+
+    def sync_csv(self, file_run):
+        '''
+            Rebuilds runs.csv from the segments when it does not end where
+            they do: a killed export committed a partition to the store but
+            not to runs.csv, or runs.csv was overwritten by
+            export_runs(parameters).
+        '''
+        end = None
+        if self.manifest.partitions:
+            end = segments.parse_date(self.manifest.partitions[-1]['before'])
+        if end == self.store.last_before():
+            return
+        print ("---> Reconstruyendo %s desde los segmentos" % file_run)
+        self.manifest.reset()
+        if os.path.isfile(file_run):
+            os.remove(file_run)
+        for segment in self.store.segments:
+            data = b''
+            if segment['name'] is not None:
+                with open(self.store.file(segment), 'rb') as f:
+                    data = f.read()
+            self.append_to_csv(data, segment['rows'], segment['columns'],
+                               segments.parse_date(segment['after']),
+                               segments.parse_date(segment['before']))
+
+    def legacy_base_date(self, file_run):
+        '''
+            Date of the last run of a runs.csv written before the manifest
+            existed.
+        '''
+        import tailer
+        tail_file = tailer.tail(open(file_run), 1)
+        #Try to obtain the correct index
+
+        df_tmp = pd.read_csv(StringIO(max(tail_file, key=len)),header=None)
+        base_date_str = df_tmp[11][0]
+        return segments.parse_date(base_date_str)
 
-    def export_runs(self, parameters = {}):
+    def fetch_window(self, after, before, max_rows=None):
+        '''
+            Downloads and processes the runs of the partition [after, before).
+            Raises PartitionTooLarge as soon as more than max_rows runs are
+            downloaded. Runs inside a worker thread of run_windows.
+        '''
+        print ("after=%s&before=%s" %(after.isoformat(), before.isoformat()))
+        query = self.get_client_request(before=before.isoformat(),
+                                        after=after.isoformat())
+        result_list = []
+        for page in query.iterfetches(retry_on_rate_exceed=True):
+            result_list += page
+            if max_rows is not None and len(result_list) > max_rows:
+                raise PartitionTooLarge(len(result_list))
+        if not result_list:
+            return None
+        return self.to_df(result_list)
+
+    def run_windows(self, start, end, workers=RUN_WORKERS, partitioner=None):
+        '''
+            Downloads all runs modified between start and end (datetimes) in
+            partitions sized by partitioner. Up to `workers` partitions are
+            downloaded at the same time, but they are committed in
+            chronological order, so a slow partition never lets a later one
+            be written before it. Partitions that turn out too large are split
+            in half and downloaded again.
+        '''
+        if partitioner is None:
+            partitioner = RunPartitioner()
+        period = max((end - start).total_seconds(), 1)
+        pending = deque()
+        pool = ThreadPoolExecutor(max_workers=workers)
+
+        def submit(after, before):
+            max_rows = partitioner.max_rows(after, before)
+            future = pool.submit(self.fetch_window, after, before, max_rows)
+            return (after, before, future)
+
+        cursor = start
+        counter = 0
+        try:
+            while True:
+                # Keep every worker busy plus one finished partition per
+                # worker waiting to be written
+                while len(pending) < 2 * workers and cursor < end:
+                    before = partitioner.next_bound(cursor, end)
+                    pending.append(submit(cursor, before))
+                    cursor = before
+                if not pending:
+                    break
+                after, before, future = pending.popleft()
+                try:
+                    df = future.result()
+                except PartitionTooLarge as e:
+                    middle = partitioner.split(after, before, e.args[0])
+                    print ("---> Division [%s, %s) demasiado grande, se divide en dos"
+                           % (after.isoformat(), before.isoformat()))
+                    pending.appendleft(submit(middle, before))
+                    pending.appendleft(submit(after, middle))
+                    continue
+                rows = 0 if df is None else len(df.index)
+                nbytes = self.commit_window(df, after, before)
+                partitioner.observe(after, before, rows, nbytes)
+                counter += 1
+                print ("---> Division %i [%s, %s): %i registros, %i bytes (%.1f%%)"
+                       % (counter, after.isoformat(), before.isoformat(), rows,
+                          nbytes, 100 * (before - start).total_seconds() / period))
+        except Exception:
+            for after, before, future in pending:
+                future.cancel()
+            raise
+        finally:
+            pool.shutdown(wait=True)
+
+    @metrics.export
+    def export_runs(self, parameters = {}, workers=RUN_WORKERS, partitioner=None,
+                    stream=STREAM_EXPORTS, fmt=EXPORT_FORMAT):
         '''
             (i)downloads all runs in paritions ,
             (ii)divide between values an runs and select relevant data,
             (iii)Sort by nodes by time
             (iv)saves DataFrame to a .csv
+            workers is the number of partitions downloaded at once; they are
+            still written to runs.csv in chronological order.
+            partitioner is a RunPartitioner that sizes the partitions.
+            stream writes a request with parameters page by page.
+            fmt 'parquet' or 'feather' also writes a columnar copy of runs.csv
         '''
         if parameters:
-            df = self.append_df(parameters=parameters, partition=True)
-            df.to_csv(root + raw_runs + 'runs.csv', index=False, encoding='utf-8')
+            self.export_table(lazy.path('raw_runs') + 'runs.csv', parameters, stream, fmt)
+            self.manifest.reset()
         else:
             #Divide flow by date
             #Check history to obtain last processed
 
-            file_run = root + raw_runs + 'runs.csv'
-            if (os.path.isfile(file_run)):
-                tail_file = tailer.tail(open(file_run), 1)
-                #Try to obtain the correct index
-
-                df_tmp = pd.read_csv(StringIO(max(tail_file, key=len)),header=None)
-                base_date_str = df_tmp[11][0]
-                base_date =dateutil.parser.parse(base_date_str).replace(tzinfo=None)
-
-            else :
-                #First partition, unknown size
-                base_date =  datetime(2015, 5, 1,23, 58, 24, 268244)
-                base_date_str = str(base_date.isoformat())
-                parameters = {'before': base_date_str}
-                df = self.append_df(parameters=parameters, partition=True)
-                self.append_to_csv(df, header =True)
-            global PARTITION_NUMBER
-            PARTITION_NUMBER = datetime.utcnow() - base_date
-            PARTITION_NUMBER = PARTITION_NUMBER.days
-            #delta = delta delta
-            delta = timedelta(days=1)
-            delta_time = base_date + delta
-            delta_time_str = ""
-
-            for counter in range(PARTITION_NUMBER):
-                delta_time_str = str(delta_time.isoformat())
-                base_date_str = str(base_date.isoformat())
-                parameters = {'after': base_date_str, 'before': delta_time_str}
-                df = self.append_df(parameters=parameters, partition=True)
-                self.append_to_csv(df, header =False)
-                base_date = delta_time
-                delta_time += delta
-                if counter % 10 == 0:
-                    print ("---> Procesados %i de %i divisiones" %(counter+1, PARTITION_NUMBER))
-                counter += 1
-            parameters = {'after': delta_time_str}
-            df = self.append_df(parameters=parameters, partition=True)
-            self.append_to_csv(df, header =False)
-
-
-    def append_runs(self, parameters = {}):
+            file_run = lazy.path('raw_runs') + 'runs.csv'
+            self.manifest.resume(file_run)
+            if not len(self.store) and os.path.isfile(file_run):
+                # runs.csv written before the segments existed
+                self.seed_segments(file_run)
+            base_date = self.store.resume()
+            if RUNS_CSV:
+                self.sync_csv(file_run)
+            if base_date is None:
+                #First partition, the partitioner finds its size
+                base_date = RUNS_EPOCH
+            try:
+                if self.processes > 1:
+                    self.run_pool()
+                self.run_windows(base_date, datetime.utcnow(), workers=workers,
+                                 partitioner=partitioner)
+            finally:
+                self.close()
+            print ("Definiciones de flujos descargadas: %i"
+                   % self.flow_manager.downloads)
+            print ("Segmentos fusionados: %i" % self.store.compact(RUN_TARGET_ROWS))
+            if fmt != 'csv':
+                self.runs_to_columnar(fmt)
+
+    def read_runs(self, after=None, before=None, columns=None):
         '''
-            Appends new runs data to runs information.
-            Gets last modified date and runs request
+            Runs modified in [after, before) (datetimes, None is unbounded),
+            read only from the segments that overlap that range.
         '''
+        return self.store.read(after, before, columns, date_column='modified_on')
 
-        # Get date of last run
-        df = pd.read_csv(root + raw_runs + 'runs.csv', dtype='unicode')
-        df = df.sort_values('time', na_position='first')
-        last_date = df['time'].iloc[-1]
-
-        # Get observations after this date
-        new_df = self.append_df({'after':last_date})
-        new_df = new_df.sort_values('time')
+    def compact_runs(self, min_rows=RUN_TARGET_ROWS):
+        '''
+            Merges consecutive small segments until they hold min_rows runs.
+            export_runs already does it after every export.
+        '''
+        return self.store.compact(min_rows)
 
-        # Blow first run (rapidpro's 'after' is inclusive)
+    def runs_to_columnar(self, fmt):
+        '''
+            Writes the columnar copy of the runs, segment by segment.
+        '''
+        writer = self.open_writer(lazy.path('raw_runs') + 'runs.csv', fmt)
         try:
-            index = 0
-            while new_df['time'].iloc[index] == last_date:
-                index += 1
-            new_df = new_df.iloc[index:]
-        except IndexError:
-            print('No new information available')
-            return None
+            for segment in self.store.select():
+                writer.write(pd.read_csv(self.store.file(segment)))
+        except BaseException:
+            writer.abort()
+            raise
+        return writer.close()
 
-        # Append to main df
-        df = df.append(new_df, ignore_index=True)
-
-        # Export
-        df.to_csv(root + raw_runs + 'runs.csv', index=False, encoding='utf-8')
 
-        # Check things went well
-        #size = len(new_df.index)
-        #print(df['modified_on'].tail(n=size+5))
+    def append_runs(self, parameters = {}):
+        '''
+            Appends new runs data to runs information.
+            Same as export_runs: only the runs modified after the last
+            committed partition are downloaded, and they are added as new
+            segments, without reading or rewriting the previous ones.
+        '''
+        self.export_runs()
         print('Runs Apendeados')
 
 
-    def export_flow(self, flow, parameters = {}):
+    @metrics.export
+    def export_flow(self, flow, parameters = {}, stream=STREAM_EXPORTS,
+                    fmt=EXPORT_FORMAT):
         '''
             type(flow) = str
             This function exports all runs of the specified flow.
@@ -519,13 +1356,8 @@ class ExportRuns(Get):
         params = {'flow_uuid':uuid}
         parameters.update(params)
 
-        # Assemble dataframe
-        appendedDf = self.append_df(parameters)
-
-        # Export as .csv
-        appendedDf.to_csv(root + raw_runs + flow + '.csv',
-                          index = False,
-                          encoding = 'utf-8')
+        # Assemble dataframe and export as .csv
+        self.export_table(lazy.path('raw_runs') + flow + '.csv', parameters, stream, fmt)
 
 
 
@@ -534,6 +1366,8 @@ class GetContacts(Get):
     '''
         Inherited Class that deals with contacts get requests.
     '''
+    # Header of a sync without contacts, so that the next one can read it
+    EMPTY_COLUMNS = ['uuid']
 
     ############ rapidpro client ############
     def get_client_request(self,before = None, after = None):
@@ -541,7 +1375,9 @@ class GetContacts(Get):
 
 
 
-    def export_contacts(self, parameters={}, path=root + raw_contacts):
+    @metrics.export
+    def export_contacts(self, parameters={}, path=None,
+                        stream=STREAM_EXPORTS, fmt=EXPORT_FORMAT):
         '''
             (i)downloads the contacts,
             (ii)flattens and assembles the dictionaries,
@@ -549,13 +1385,90 @@ class GetContacts(Get):
             (iv)removes a useless contact field (with varname so long that STATA
                 cannot handle
             (v)saves DataFrame to a .csv
-            path is the full path to new .csv, string
+            path is the full path to new .csv, string (default: raw_contacts)
+            stream writes page by page (see Get.stream_table)
+            fmt is the output format, 'csv', 'parquet' or 'feather'
+            A full export also rebuilds its phone index (see phone_index.py).
         '''
+        path = path or lazy.path('raw_contacts')
+        self.export_table(path, parameters, stream, fmt)
+        if not parameters:
+            index = phone_index.PhoneIndex(phone_index.index_path(path))
+            index.rebuild(phone_index.read_contacts(path))
 
-        df = self.append_df(parameters)
-        df.to_csv(path, encoding='utf-8', index = False)
+    def sync_path(self, path):
+        return os.path.splitext(path)[0] + '_sync.json'
+
+    def read_sync_cursor(self, path):
+        '''
+            Latest modified_on seen by the last sync of path, None if the
+            contacts in path were never synced.
+        '''
+        if not os.path.isfile(self.sync_path(path)):
+            return None
+        with open(self.sync_path(path)) as f:
+            return json.load(f)['modified_on']
 
+    def write_sync_cursor(self, path, modified_on):
+        tmp = self.sync_path(path) + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'modified_on': modified_on}, f)
+        os.replace(tmp, self.sync_path(path))
 
+    @metrics.export
+    def sync_contacts(self, path=None, fmt=EXPORT_FORMAT, full=False):
+        '''
+            Keeps the contacts in path up to date downloading only the
+            contacts modified (or deleted) since the last sync: they are
+            upserted by uuid and deleted contacts are removed. The first sync,
+            or full=True, downloads all contacts. The phone index of path is
+            updated the same way. path defaults to raw_contacts.
+            Returns the number of contacts downloaded.
+        '''
+        path = path or lazy.path('raw_contacts')
+        out = path if fmt == 'csv' else columnar.output_path(path, fmt)
+        cursor = None if full or not os.path.isfile(out) else self.read_sync_cursor(path)
+
+        import aio
+        queries = [aio.fetch_all(self.client_io.get_contacts(after=cursor))]
+        if cursor is not None:
+            queries.append(aio.fetch_all(self.client_io.get_contacts(deleted=True, after=cursor)))
+        # Modified and deleted contacts download at the same time
+        results = aio.run(*queries)
+        changed = results[0]
+        deleted = results[1] if cursor is not None else []
+        changed_df = self.to_df(changed)
+        print ("Contactos modificados: %d, borrados: %d" % (len(changed), len(deleted)))
+
+        index = phone_index.PhoneIndex(phone_index.index_path(path))
+        if cursor is None:
+            df = changed_df
+            index.rebuild(changed_df)
+        else:
+            # The file this sync writes, not a newer copy in another format,
+            # and the changes with its dtypes
+            if fmt == 'csv':
+                store = pd.read_csv(out, dtype=str)
+                new = changed_df
+            else:
+                store = columnar.read_table(out)
+                new = columnar.typed(changed_df)
+            removed = set(c.uuid for c in changed) | set(c.uuid for c in deleted)
+            store = store[~store['uuid'].isin(removed)]
+            df = pd.concat([store, new], ignore_index=True)
+            index.remove(c.uuid for c in deleted)
+            if len(changed_df.index):
+                index.upsert(changed_df)
+        if len(df.columns) == 0:
+            df = pd.DataFrame(columns=self.EMPTY_COLUMNS)
+        self.save_df(df, path, fmt)
+
+        dates = [c.modified_on for c in changed + deleted if c.modified_on]
+        if dates:
+            self.write_sync_cursor(path, max(dates).isoformat())
+        elif cursor is None:
+            self.write_sync_cursor(path, None)
+        return len(changed) + len(deleted)
 
 
 class GetFields(Get):
@@ -568,7 +1481,8 @@ class GetFields(Get):
         return self.client_io.get_fields(parameters)
 
 
-    def export_fields(self, parameters={}):
+    @metrics.export
+    def export_fields(self, parameters={}, stream=STREAM_EXPORTS, fmt=EXPORT_FORMAT):
         '''
             (i)downloads the fields,
             (ii)flattens and assembles the dictionaries,
@@ -576,8 +1490,8 @@ class GetFields(Get):
             (iv)saves DataFrame to a .csv
         '''
 
-        df = self.append_df(parameters)
-        df.to_csv(root + raw_fields, encoding='utf-8', index = False)
+        self.export_table(lazy.path('raw_fields'), parameters, stream, fmt)
+        names.warm('fields')
 
 
 
@@ -591,7 +1505,8 @@ class GetFlows(Get):
     def get_client_request(self, parameters = {}):
         return self.client_io.get_flows(parameters)
 
-    def export_flows(self, parameters = {}):
+    @metrics.export
+    def export_flows(self, parameters = {}, stream=STREAM_EXPORTS, fmt=EXPORT_FORMAT):
         '''
             (i)downloads the flows,
             (ii)flattens and assembles the dictionaries,
@@ -599,8 +1514,8 @@ class GetFlows(Get):
             (iv)saves DataFrame to a .csv
         '''
 
-        df = self.append_df(parameters)
-        df.to_csv(root + raw_flows, index=False, encoding = 'utf-8')
+        self.export_table(lazy.path('raw_flows'), parameters, stream, fmt)
+        names.warm('flows')
 
 
 
@@ -614,7 +1529,8 @@ class GetGroups(Get):
     def get_client_request(self, parameters = {}):
         return self.client_io.get_groups(parameters)
 
-    def export_groups(self, parameters={}):
+    @metrics.export
+    def export_groups(self, parameters={}, stream=STREAM_EXPORTS, fmt=EXPORT_FORMAT):
         '''
             (i)downloads the groups,
             (ii)flattens and assembles the dictionaries,
@@ -622,8 +1538,8 @@ class GetGroups(Get):
             (iv)saves DataFrame to a .csv
         '''
 
-        df = self.append_df(parameters)
-        df.to_csv(root + raw_groups, encoding='utf-8', index = False)
+        self.export_table(lazy.path('raw_groups'), parameters, stream, fmt)
+        names.warm('groups')
 
 
 
@@ -632,12 +1548,16 @@ class GetMessages(Get):
     '''
         Inherited Class that deals with messages get requests.
     '''
+    TEXT_COLUMNS = ['text']
+    # Columns the incremental cursor is read from (v2 messages have no id)
+    CURSOR_COLUMNS = ['uuid', 'created_on']
 
     ############ rapidpro client ############
     def get_client_request(self, parameters = {}):
         return self.client_io.get_messages(**parameters)
 
 
+    @metrics.timed('to_df', records=metrics.rows)
     def to_df(self, result_list):
         '''
             Runs a request, extracts messages and assembles them.
@@ -647,38 +1567,162 @@ class GetMessages(Get):
         # raw should be a list of dicts. Flatten them and append to new list
         flatDicts = []
         for item in result_list:
-            dic = item.serialize()
-            for char in ['"', "'", ";", ",", '\u2013', '\u2026', '\r\n']:
-                dic['text'] = dic['text'].replace(char, '')
-            flatDicts.append(self.flatten_dict(dic))
+            flatDicts.append(self.flatten_dict(item.serialize()))
+
+        return self.clean(pd.DataFrame.from_records(flatDicts))
+
 
-        return pd.DataFrame.from_records(flatDicts)
+    def messages_path(self, parameters={}):
+        '''
+            Output of the export filtered by parameters: raw_messages without
+            filters, e.g. messages_folder-inbox.csv for {'folder': 'inbox'}.
+        '''
+        path = lazy.path('raw_messages')
+        if not parameters:
+            return path
+        base, ext = os.path.splitext(path)
+        name = '_'.join('%s-%s' % (key, parameters[key]) for key in sorted(parameters))
+        return '%s_%s%s' % (base, re.sub(r'[^\w.-]+', '-', name), ext)
+
+    def cursor_path(self, path):
+        return os.path.splitext(path)[0] + '_cursor.json'
+
+    def read_cursor(self, path):
+        '''
+            (created_on, uuids) of the newest messages in the export in path,
+            None if there is none. uuids are the messages created at that
+            very date, which the next export downloads again.
+        '''
+        cursor_path = self.cursor_path(path)
+        if not os.path.isfile(cursor_path):
+            return None
+        with open(cursor_path) as f:
+            cursor = json.load(f)
+        return segments.parse_date(cursor['created_on']), set(cursor.get('uuids') or [])
+
+    def write_cursor(self, path, created_on, uuids):
+        cursor_path = self.cursor_path(path)
+        tmp = cursor_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'created_on': created_on, 'uuids': sorted(uuids)}, f)
+        os.replace(tmp, cursor_path)
+
+    def newest_message(self, out):
+        '''
+            (created_on, uuids) of the newest messages stored in out, None if
+            it has no messages.
+        '''
+        df = columnar.read_table(out, columns=self.CURSOR_COLUMNS)
+        if len(df.index) == 0:
+            return None
+        dates = pd.to_datetime(df['created_on'], utc=True)
+        newest = dates.max()
+        uuids = df.loc[dates == newest, 'uuid'].astype(str)
+        return newest.strftime('%Y-%m-%dT%H:%M:%S.%fZ'), set(uuids)
 
+    def append_messages(self, df, path, fmt=EXPORT_FORMAT):
+        '''
+            Appends df to the export in path. A .csv whose header already has
+            every column of df is appended in place, otherwise (new columns,
+            columnar formats) the export is rewritten with the union of the
+            columns.
+        '''
+        out = path if fmt == 'csv' else columnar.output_path(path, fmt)
+        if fmt == 'csv':
+            header = list(pd.read_csv(out, nrows=0).columns)
+            if set(df.columns) <= set(header):
+                with metrics.stage('write') as s:
+                    size = os.path.getsize(out)
+                    df.reindex(columns=header).to_csv(out, mode='a', header=False,
+                                                      encoding='utf-8', index=False)
+                    s.records = len(df.index)
+                    s.bytes = os.path.getsize(out) - size
+                return
+            previous = pd.read_csv(out, dtype=str)
+        else:
+            previous = columnar.read_table(out)
+            df = columnar.typed(df)
+        self.save_df(pd.concat([previous, df], ignore_index=True), path, fmt)
 
-    def export_messages(self, parameters={}):
+    @metrics.export
+    def export_messages(self, parameters={}, stream=STREAM_EXPORTS, fmt=EXPORT_FORMAT,
+                        incremental=True):
         '''
             (i)downloads the messages,
             (ii)flattens and assembles the dictionaries,
             (iii)sends data to DataFrame
             (iv)saves DataFrame to a .csv
+            Every filter (e.g. {'folder': 'inbox'}) has its own output, see
+            messages_path, and its own cursor with the newest message
+            exported. incremental only downloads the messages created since
+            then and appends them; the first export, or one filtered by
+            MESSAGES_RANGE, downloads everything. Messages already exported
+            keep the status they had then.
+            Returns the number of messages downloaded.
         '''
-
-        df = self.append_df(parameters)
-        df.to_csv(root + raw_messages, encoding='utf-8', index = False)
+        path = self.messages_path(parameters)
+        out = path if fmt == 'csv' else columnar.output_path(path, fmt)
+        incremental = incremental and not any(p in parameters for p in MESSAGES_RANGE)
+        cursor = self.read_cursor(path) if incremental and os.path.isfile(out) else None
+
+        if cursor is None:
+            self.export_table(path, parameters, stream, fmt)
+            if not os.path.isfile(out):
+                return 0
+            newest = self.newest_message(out)
+            if newest is not None:
+                self.write_cursor(path, *newest)
+            return len(columnar.read_table(out, columns=['uuid']).index)
+
+        # after is inclusive: the messages created at the cursor date that
+        # were already exported come again and are left out by uuid
+        created_on, uuids = cursor
+        query = self.client_io.get_messages(after=created_on, **parameters)
+        msgs = []
+        for page in query.iterfetches(retry_on_rate_exceed=True):
+            msgs += [msg for msg in page if msg.uuid not in uuids and
+                     msg.created_on.replace(tzinfo=None) >= created_on]
+        print ("Mensajes nuevos en %s: %d" % (path, len(msgs)))
+        if not msgs:
+            return 0
+
+        # The API returns the newest first
+        msgs.sort(key=lambda msg: msg.created_on)
+        self.append_messages(self.to_df(msgs), path, fmt)
+        newest = msgs[-1].created_on
+        if newest.replace(tzinfo=None) > created_on:
+            uuids = set()
+        uuids.update(msg.uuid for msg in msgs if msg.created_on == newest)
+        self.write_cursor(path, msgs[-1].serialize()['created_on'], uuids)
+        return len(msgs)
 
 class GetFailedMessages(Get):
+    '''
+        Failed and errored messages sent to the contacts of GROUPS.
+    '''
+    TEXT_COLUMNS = ['text']
+    # Header of an export without messages, so that the next one can read it
+    EMPTY_COLUMNS = ['uuid']
+    GROUPS = [ "PUERPERIUM","PREGNANT","ALTOPD","Muerte","AUXVO","SE-T Pregnancy","SE-T Baby","SE-C Pregnancy","SE-C Baby"]
 
     def __init__(self):
-        self.MSG_URL="https://app.rapidpro.io/api/v2/messages.json"
-        self.token = rp_api.split(' ')[1]
-        self.client_io = TembaClient('rapidpro.io',self.token)
-
-    def get_failed_msgs_by_contact(self, contact):
-        token = 'token %s' % self.token
-        url= self.MSG_URL + "?contact="+str(contact)+"&status=failed"
-        headers = {'content-type': 'application/json', 'Authorization': token}
-        r = requests.get(url, headers = headers)
-        return [f for f in r.json()['results'] if f['status'] in ['failed','errored']]
+        self.MSG_URL = session.url('v2', 'messages')
+        self.cursor_path = os.path.splitext(lazy.path('raw_failed_messages'))[0] + '_cursor.json'
+
+    def get_failed_msgs_by_contact(self, contact, after=None):
+        params = {'contact': contact, 'status': 'failed'}
+        if after is not None:
+            params['after'] = after.isoformat()
+        url = self.MSG_URL
+        msgs = []
+        while url:
+            r = session.get(url, params=params)
+            response = r.json()
+            msgs += [f for f in response['results'] if f['status'] in FAILED_STATUS]
+            # next already carries the query
+            url = response.get('next')
+            params = None
+        return msgs
 
     def get_contact_by_group(self, group):
         print("----- Comenzando a descargar de los contactos del grupo ", group,"----")
@@ -686,6 +1730,82 @@ class GetFailedMessages(Get):
         print("----                Finalizo la descarga del grupo               -----")
         return [c.serialize()['uuid']for c in contacts]
 
+    def get_contacts_in_groups(self, groups, workers=FAILED_WORKERS):
+        '''
+            Set of uuids of the contacts in any of groups, downloading the
+            groups at the same time.
+        '''
+        pool = ThreadPoolExecutor(max_workers=workers)
+        try:
+            contacts = set()
+            for uuids in pool.map(self.get_contact_by_group, groups):
+                contacts.update(uuids)
+            return contacts
+        finally:
+            pool.shutdown(wait=True)
+
+    def iter_failed_msgs(self, contacts, after=None):
+        '''
+            Yields, page by page, the failed and errored messages in
+            FAILED_FOLDERS created after `after` whose contact is in contacts.
+            A few bulk requests instead of one per contact.
+        '''
+        for folder in FAILED_FOLDERS:
+            query = self.client_io.get_messages(folder=folder, after=after)
+            for page in query.iterfetches(retry_on_rate_exceed=True):
+                msgs = [msg.serialize() for msg in page]
+                yield [m for m in msgs if m['status'] in FAILED_STATUS and
+                       m['contact'] and m['contact']['uuid'] in contacts]
+
+    def iter_failed_msgs_by_contact(self, contacts, after=None, workers=FAILED_WORKERS):
+        '''
+            Same as iter_failed_msgs with one request per contact, sent by
+            a pool of `workers` threads. Yields every PRINT_PAGE contacts.
+        '''
+        pool = ThreadPoolExecutor(max_workers=workers)
+        try:
+            total = len(contacts)
+            msgs = []
+            results = pool.map(lambda c: self.get_failed_msgs_by_contact(c, after), contacts)
+            for counter, contact_msgs in enumerate(results):
+                msgs += contact_msgs
+                if counter % PRINT_PAGE == 0:
+                    print ("De %d contactos %d procesados"% (total,counter))
+                    yield msgs
+                    msgs = []
+            yield msgs
+        finally:
+            pool.shutdown(wait=True)
+
+    def read_cursor(self):
+        '''
+            Date the last export started at, None if there is none.
+        '''
+        if not os.path.isfile(self.cursor_path):
+            return None
+        with open(self.cursor_path) as f:
+            return segments.parse_date(json.load(f)['started'])
+
+    def read_previous(self, out):
+        '''
+            The previous export, None when it is missing, empty or has no
+            header (e.g. written when there were no failed messages).
+        '''
+        if not os.path.isfile(out):
+            return None
+        try:
+            previous = columnar.read_table(out)
+        except pd.errors.EmptyDataError:
+            return None
+        return previous if 'uuid' in previous.columns else None
+
+    def write_cursor(self, started):
+        tmp = self.cursor_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'started': started.isoformat()}, f)
+        os.replace(tmp, self.cursor_path)
+
+    @metrics.timed('to_df', records=metrics.rows)
     def to_df(self, result_list):
         '''
             Runs a request, extracts messages and assembles them.
@@ -693,26 +1813,64 @@ class GetFailedMessages(Get):
         # raw should be a list of dicts. Flatten them and append to new list
         flatDicts = []
         for item in result_list:
-            dic = item
-            for char in ['"', "'", ";", ",", '\u2013', '\u2026', '\r\n']:
-                dic['text'] = dic['text'].replace(char, '')
-            flatDicts.append(self.flatten_dict(dic))
-
-        return pd.DataFrame.from_records(flatDicts)
-
-    def export_messages(self):
-        group_process = [ "PUERPERIUM","PREGNANT","ALTOPD","Muerte","AUXVO","SE-T Pregnancy","SE-T Baby","SE-C Pregnancy","SE-C Baby"]
-        all_contacts = []
-        for group in group_process:
-            all_contacts += self.get_contact_by_group(group)
-        all_failed_msgs = []
-        counter = 0
-        total = len(list(set(all_contacts)))
-        for c in list(set(all_contacts)):
-            if (counter %100 == 1):
-                print ("De %d contactos %d procesados"% (total,counter))
-            all_failed_msgs += self.get_failed_msgs_by_contact(c)
-            counter
-        all_failed_msgs
-        df = self.to_df(all_failed_msgs)
-        df.to_csv(root + raw_failed_messages, encoding='utf-8', index = False)
+            flatDicts.append(self.flatten_dict(item))
+
+        return self.clean(pd.DataFrame.from_records(flatDicts))
+
+    @metrics.export
+    def export_messages(self, stream=STREAM_EXPORTS, fmt=EXPORT_FORMAT, bulk=True,
+                        incremental=True, workers=FAILED_WORKERS):
+        '''
+            Downloads the failed messages of the contacts in GROUPS.
+            bulk downloads all failed messages and keeps those of the groups'
+            contacts, otherwise there is one request per contact, sent by
+            `workers` threads.
+            incremental only downloads messages created since the last
+            export (minus FAILED_OVERLAP) and merges them with it.
+            stream writes them page by page instead of keeping all of them
+            in memory. fmt is the output format.
+        '''
+        path = lazy.path('raw_failed_messages')
+        out = path if fmt == 'csv' else columnar.output_path(path, fmt)
+        started = datetime.utcnow()
+        contacts = self.get_contacts_in_groups(self.GROUPS, workers)
+        cursor = self.read_cursor() if incremental and os.path.isfile(out) else None
+        after = None if cursor is None else cursor - FAILED_OVERLAP
+        if bulk:
+            pages = self.iter_failed_msgs(contacts, after)
+        else:
+            pages = self.iter_failed_msgs_by_contact(list(contacts), after, workers)
+
+        writer = self.open_writer(path, fmt) if stream else None
+        try:
+            seen = set()
+            all_failed_msgs = []
+            for page in pages:
+                page = [m for m in page if m['uuid'] not in seen]
+                seen.update(m['uuid'] for m in page)
+                if writer and page:
+                    writer.write(self.to_df(page))
+                elif not writer:
+                    all_failed_msgs += page
+            print ("Mensajes fallidos nuevos: %d" % len(seen))
+
+            # Keep the previous export, except the messages downloaded again
+            previous = self.read_previous(out) if cursor is not None else None
+            if previous is not None:
+                previous = previous[~previous['uuid'].isin(seen)]
+            if writer:
+                writer.write(previous)
+        except BaseException:
+            if writer:
+                writer.abort()
+            raise
+        if writer and writer.records:
+            writer.close()
+        else:
+            if writer:
+                writer.abort()
+            df = pd.concat([self.to_df(all_failed_msgs), previous], ignore_index=True)
+            if len(df.columns) == 0:
+                df = pd.DataFrame(columns=self.EMPTY_COLUMNS)
+            self.save_df(df, path, fmt)
+        self.write_cursor(started)
@@ -0,0 +1,151 @@
+# coding=utf-8
+'''
+Group membership reconciler, used by utils.add_groups, remove_groups and
+reconcile_groups.
+
+Takes the groups every contact should be in ({contact uuid: groups}) and,
+for the groups it manages, the ones it should not be in. Current
+memberships come from the contacts export (its groups_<i>_name columns), so
+only the adds and removes that change something are sent: contact_actions
+requests of up to 100 contacts per group and action, deduplicated and
+dispatched concurrently (see dispatch.py). Groups are sent by uuid when
+names.py knows them, by name otherwise.
+
+     In [1]: import groups
+     In [2]: desired = groups.by_contact({'T3': uuids})
+     In [3]: groups.reconcile(desired, managed=['T3', 'NOT3', 'T2', 'T1'],
+                              contacts_path=root + last_contacts)
+
+'''
+
+import re
+from collections import OrderedDict
+import pandas as pd
+from six import string_types
+import dispatch
+import names
+import phone_index
+import session
+
+# RapidPro takes at most 100 contacts per contact_actions request
+BATCH_SIZE = 100
+RESULT_COLUMNS = ['group', 'action', 'contacts', 'status', 'http_status', 'attempts', 'error']
+
+
+def by_contact(members):
+    '''
+        {contact uuid: set of groups} from {group: contact uuids}.
+    '''
+    desired = OrderedDict()
+    for group in members:
+        for uuid in members[group]:
+            desired.setdefault(uuid, set()).add(group)
+    return desired
+
+
+def is_group_column(name):
+    return re.match(r'^groups_\d+_name$', str(name)) is not None
+
+
+def read_memberships(contacts_path):
+    '''
+        {contact uuid: set of group names} of the contacts export in
+        contacts_path.
+    '''
+    df = phone_index.read_contacts(contacts_path, is_group_column)
+    names = df[[c for c in df.columns if is_group_column(c)]].to_numpy(dtype=object)
+    return dict((uuid, set(n for n in row if isinstance(n, string_types) and n))
+                for uuid, row in zip(df['uuid'].values, names))
+
+
+def plan(desired, managed=(), current=None):
+    '''
+        {(group, action): contact uuids} that bring every contact of desired
+        to its groups: 'add' to the groups it should be in and 'remove' from
+        the managed groups it should not be in. Actions that current (see
+        read_memberships) shows are not needed are left out; contacts
+        missing in it get every action. Empty uuids are skipped.
+        Returns the actions and the number of actions avoided.
+    '''
+    actions = OrderedDict()
+    avoided = 0
+    managed = set(managed)
+    for uuid, groups in desired.items():
+        if not uuid:
+            continue
+        groups = set(groups)
+        known = None if current is None else current.get(uuid)
+        for group in sorted(groups):
+            if known is not None and group in known:
+                avoided += 1
+            else:
+                actions.setdefault((group, 'add'), []).append(uuid)
+        for group in sorted(managed - groups):
+            if known is not None and group not in known:
+                avoided += 1
+            else:
+                actions.setdefault((group, 'remove'), []).append(uuid)
+    return actions, avoided
+
+
+def group_actions(group, action, uuids):
+    '''
+        Actions (see plan) adding or removing uuids, without duplicates nor
+        empty uuids, to or from group.
+    '''
+    uuids = list(OrderedDict.fromkeys(uuid for uuid in uuids if uuid))
+    return OrderedDict([((group, action), uuids)]) if uuids else OrderedDict()
+
+
+def batches(actions, size=BATCH_SIZE):
+    '''
+        (group, action, contact uuids) of every request, size contacts at
+        most.
+    '''
+    for (group, action), uuids in actions.items():
+        for start in range(0, len(uuids), size):
+            yield group, action, uuids[start:start + size]
+
+
+def target(group):
+    '''
+        The group of a contact_actions request: its uuid when it is known,
+        its name otherwise.
+    '''
+    uuid = names.uuid('groups', group)
+    return {'group_uuid': uuid} if uuid else {'group': group}
+
+
+def send_actions(actions, workers=dispatch.WORKERS, rate=dispatch.RATE):
+    '''
+        Sends actions (see plan) to the v1 contact_actions endpoint and
+        returns a table with the group, action, contacts, status, http
+        status, attempts and error of every request.
+    '''
+    url = session.url('v1', 'contact_actions')
+    requests = list(batches(actions))
+    jobs = [('post', url, dict(target(group), contacts=uuids, action=action))
+            for group, action, uuids in requests]
+    table = pd.DataFrame(dispatch.dispatch(jobs, workers, rate),
+                         columns=['status', 'http_status', 'attempts', 'error'])
+    table.insert(0, 'group', [group for group, action, uuids in requests])
+    table.insert(1, 'action', [action for group, action, uuids in requests])
+    table.insert(2, 'contacts', [len(uuids) for group, action, uuids in requests])
+    return table[RESULT_COLUMNS]
+
+
+def reconcile(desired, managed=(), contacts_path=None, workers=dispatch.WORKERS,
+              rate=dispatch.RATE):
+    '''
+        Brings the contacts of desired to their groups (see plan), diffing
+        against the memberships of the contacts export in contacts_path,
+        which should be synced first. Without contacts_path every action is
+        sent. Returns the table of send_actions.
+    '''
+    current = read_memberships(contacts_path) if contacts_path else None
+    actions, avoided = plan(desired, managed, current)
+    table = send_actions(actions, workers, rate)
+    failed = table.loc[table['status'] != 'ok', 'contacts'].sum()
+    print("Cambios de grupo: %d en %d solicitudes, con error: %d, evitados: %d"
+          % (table['contacts'].sum(), len(table.index), failed, avoided))
+    return table
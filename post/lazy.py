@@ -0,0 +1,87 @@
+# coding=utf-8
+'''
+What the modules of post/ load on first use instead of at import: keys.ini
+and heavy modules (pandas and the modules built on it). Importing get.py,
+utils.py or session.py neither reads keys.ini nor loads pandas, so a single
+post request or a run transform process only pays for what it uses.
+
+     In [1]: import lazy
+     In [2]: lazy.path('raw_contacts')           # root + raw_contacts
+     In [3]: lazy.setting('http', 'pool_size', 16)
+     In [4]: pd = lazy.module('pandas')          # imported on pd.<anything>
+
+override changes a setting for the process, e.g. bench.py exporting to a
+temporary root.
+'''
+
+import sys
+import threading
+import importlib.util
+import configparser
+
+# Read from the working directory, like every script of the repo
+KEYS = 'keys.ini'
+
+_config = []
+_overrides = {}
+_lock = threading.Lock()
+# Marks a setting without fallback, missing ones raise KeyError
+_REQUIRED = object()
+
+
+def config():
+    '''
+        keys.ini, read once.
+    '''
+    with _lock:
+        if not _config:
+            parser = configparser.ConfigParser()
+            parser.read(KEYS)
+            _config.append(parser)
+        return _config[0]
+
+
+def setting(section, key, fallback=_REQUIRED):
+    '''
+        Value of key in section of keys.ini (a string), fallback when it is
+        missing; without fallback a missing key raises KeyError.
+    '''
+    if (section, key) in _overrides:
+        return _overrides[(section, key)]
+    parser = config()
+    if fallback is _REQUIRED:
+        return parser[section][key]
+    return parser.get(section, key, fallback=fallback)
+
+
+def path(key):
+    '''
+        Full path of a dataset in the [paths] section, e.g. path('raw_flows').
+    '''
+    return setting('paths', 'root') + setting('paths', key)
+
+
+def override(section, key, value):
+    '''
+        Replaces a setting for the process; value None restores keys.ini.
+    '''
+    if value is None:
+        _overrides.pop((section, key), None)
+    else:
+        _overrides[(section, key)] = value
+
+
+def module(name):
+    '''
+        Module name, imported when one of its attributes is first used
+        (see importlib.util.LazyLoader).
+    '''
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    lazy_module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = lazy_module
+    loader.exec_module(lazy_module)
+    return lazy_module
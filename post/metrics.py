@@ -0,0 +1,245 @@
+# coding=utf-8
+'''
+Per-stage metrics of the export pipeline.
+
+Every stage (request, append_df, to_df, flow_lookup, write) counts its calls,
+records, bytes and wall and CPU time; besides, the process counts requests,
+retries and rate limit waits. Each export_* method of get.py (and
+report_master.wrap_full) is a metrics run: when it ends, what changed during
+it is written as a JSON summary and in the Prometheus text format (for the
+node_exporter textfile collector) to the metrics directory:
+
+     datasets/metrics/ExportRuns.export_runs.json
+     datasets/metrics/ExportRuns.export_runs.prom
+
+Stages are inclusive (to_df runs inside append_df) and CPU time is the one of
+the calling thread, so work done by the run processes of ExportRuns is only
+seen as wall time. Exports running at the same time see each other's work.
+
+Optional keys.ini section:
+
+     [metrics]
+     directory = /var/lib/node_exporter/
+
+'''
+
+import os
+import json
+import time
+import threading
+import functools
+from contextlib import contextmanager
+from datetime import datetime
+import lazy
+
+# Directory of the reports, None: the one of keys.ini (see report_directory)
+DIRECTORY = None
+# Prefix of the Prometheus metric names
+PREFIX = 'rapidpro_export'
+# Counted for every stage
+STAGE_FIELDS = ['calls', 'records', 'bytes', 'wall_seconds', 'cpu_seconds']
+
+_lock = threading.Lock()
+_stages = {}
+_counters = {}
+
+
+class Stage(object):
+    '''
+        Measurement of one call to a stage; the caller sets records and
+        bytes when it knows them.
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.records = 0
+        self.bytes = 0
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+
+    def finish(self):
+        wall = time.perf_counter() - self.wall
+        cpu = time.thread_time() - self.cpu
+        with _lock:
+            totals = _stages.setdefault(self.name, dict((f, 0) for f in STAGE_FIELDS))
+            totals['calls'] += 1
+            totals['records'] += self.records
+            totals['bytes'] += self.bytes
+            totals['wall_seconds'] += wall
+            totals['cpu_seconds'] += cpu
+
+
+@contextmanager
+def stage(name):
+    '''
+        with stage('write') as s:
+            ...
+            s.records = len(df.index)
+    '''
+    s = Stage(name)
+    try:
+        yield s
+    finally:
+        s.finish()
+
+
+def timed(name, records=None):
+    '''
+        Decorator timing every call of the function as stage name.
+        records(result) gives the records of the call.
+    '''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name) as s:
+                result = function(*args, **kwargs)
+                if records is not None:
+                    s.records = records(result)
+                return result
+        return wrapper
+    return decorator
+
+
+def rows(df):
+    return 0 if df is None else len(df.index)
+
+
+def count(name, value=1):
+    '''
+        Adds value to the process counter name (requests, retries...).
+    '''
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def snapshot():
+    with _lock:
+        return {'stages': dict((name, dict(totals)) for name, totals in _stages.items()),
+                'counters': dict(_counters),
+                'wall': time.perf_counter(),
+                'cpu': time.process_time()}
+
+
+def difference(before, after):
+    '''
+        What was counted between two snapshots.
+    '''
+    stages = {}
+    for name, totals in after['stages'].items():
+        previous = before['stages'].get(name, {})
+        delta = dict((f, totals[f] - previous.get(f, 0)) for f in STAGE_FIELDS)
+        if delta['calls']:
+            stages[name] = delta
+    counters = dict((name, value - before['counters'].get(name, 0))
+                    for name, value in after['counters'].items())
+    return {'wall_seconds': after['wall'] - before['wall'],
+            'cpu_seconds': after['cpu'] - before['cpu'],
+            'counters': dict((k, v) for k, v in counters.items() if v),
+            'stages': stages}
+
+
+def prometheus(summary):
+    '''
+        summary (see run) in the Prometheus text exposition format.
+    '''
+    export = summary['export'].replace('\\', '\\\\').replace('"', '\\"')
+    label = 'export="%s"' % export
+    lines = []
+
+    def metric(name, kind, description, samples):
+        lines.append('# HELP %s_%s %s' % (PREFIX, name, description))
+        lines.append('# TYPE %s_%s %s' % (PREFIX, name, kind))
+        for labels, value in samples:
+            lines.append('%s_%s{%s} %s' % (PREFIX, name, labels, repr(float(value))))
+
+    metric('success', 'gauge', 'Whether the last export finished without errors.',
+           [(label, summary['status'] == 'ok')])
+    metric('last_run_timestamp_seconds', 'gauge', 'End of the last export.',
+           [(label, summary['finished'])])
+    metric('duration_seconds', 'gauge', 'Wall time of the last export.',
+           [(label, summary['wall_seconds'])])
+    metric('cpu_seconds', 'gauge', 'CPU time of the process during the last export.',
+           [(label, summary['cpu_seconds'])])
+    for name in sorted(summary['counters']):
+        metric(name, 'gauge', '%s during the last export.' % name.replace('_', ' '),
+               [(label, summary['counters'][name])])
+    for field in STAGE_FIELDS:
+        metric('stage_' + field, 'gauge', 'Stage %s during the last export.' % field.replace('_', ' '),
+               [('%s,stage="%s"' % (label, name), summary['stages'][name][field])
+                for name in sorted(summary['stages'])])
+    return '\n'.join(lines) + '\n'
+
+
+def write_file(path, text):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+def report_directory():
+    '''
+        DIRECTORY, or [metrics] directory of keys.ini, or root/metrics.
+    '''
+    return DIRECTORY or lazy.setting('metrics', 'directory', os.path.join(
+        lazy.setting('paths', 'root', '.'), 'metrics'))
+
+
+def report(summary, directory=None):
+    '''
+        Writes summary as <export>.json and <export>.prom in directory
+        (report_directory() by default).
+    '''
+    directory = directory or report_directory()
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    base = os.path.join(directory, summary['export'])
+    write_file(base + '.json', json.dumps(summary, indent=2, sort_keys=True))
+    write_file(base + '.prom', prometheus(summary))
+
+
+@contextmanager
+def run(name, directory=None):
+    '''
+        Measures the block as the export name and reports it when it ends,
+        also when it fails.
+    '''
+    started = datetime.utcnow()
+    before = snapshot()
+    status = 'error'
+    try:
+        yield
+        status = 'ok'
+    finally:
+        summary = difference(before, snapshot())
+        summary.update({'export': name, 'status': status,
+                        'started': started.isoformat(), 'finished': time.time()})
+        try:
+            report(summary, directory)
+        except (IOError, OSError) as ex:
+            print ("---> No se pudieron guardar las métricas de %s: %s" % (name, ex))
+
+
+def export(function):
+    '''
+        Decorator of the export_* methods: every call is a run named
+        <class>.<method>.
+    '''
+    @functools.wraps(function)
+    def wrapper(self, *args, **kwargs):
+        with run('%s.%s' % (type(self).__name__, function.__name__)):
+            return function(self, *args, **kwargs)
+    return wrapper
+
+
+def measured(name):
+    '''
+        Decorator making every call of a function a run named name, e.g.
+        report_master.wrap_full.
+    '''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with run(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
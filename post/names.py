@@ -0,0 +1,204 @@
+# coding=utf-8
+'''
+Name <-> uuid resolver of flows, groups, contact fields and channels, used by
+utils.start_run, Get.uuid_flow and the group actions of groups.py.
+
+Names are kept in memory and in an SQLite file next to the exports
+(root + names.sqlite), so they survive the process. Each kind is refreshed
+when it is older than TTL seconds or when a name is missing (at most every
+MISS_REFRESH seconds): from its export when the file is newer than the cache,
+from the v2 API otherwise. export_flows, export_groups and export_fields warm
+the cache with the file they just wrote, so lookups never parse it again:
+
+     In [1]: import names
+     In [2]: names.uuid('flows', 'incentivesCollect5')
+     In [3]: names.name('groups', '0f7a4c1e-...')
+
+Fields have no uuid: their key stands for it.
+Channels have no export and always come from the API.
+'''
+
+import os
+import time
+import sqlite3
+import threading
+import lazy
+import columnar
+import metrics
+import session
+
+# kind -> export (keys.ini path), v2 endpoint, name column, uuid column
+KINDS = {'flows': ('raw_flows', 'flows', 'name', 'uuid'),
+         'groups': ('raw_groups', 'groups', 'name', 'uuid'),
+         'fields': ('raw_fields', 'fields', 'name', 'key'),
+         'channels': (None, 'channels', 'name', 'uuid')}
+# Persistent cache, in root
+NAMES_CACHE = 'names.sqlite'
+# Seconds a kind is trusted before it is refreshed
+TTL = 6 * 60 * 60
+# Seconds between two attempts to refresh a kind that expired or misses a
+# name, so that unknown names or API errors do not cause a request each
+MISS_REFRESH = 5 * 60
+
+# (cache path, Resolver) shared by every module
+_resolver = None
+_resolver_lock = threading.Lock()
+
+
+def export_path(kind):
+    '''
+        Export of kind (the .csv or its columnar copy), None if it has none.
+    '''
+    key = KINDS[kind][0]
+    if key is None or lazy.setting('paths', key, None) is None:
+        return None
+    return columnar.locate(lazy.path(key))
+
+
+class Resolver(object):
+    '''
+        {name: uuid} and {uuid: name} of every kind, loaded from the SQLite
+        file in path on first use. When a name repeats, the first one found
+        in the export or the API wins.
+    '''
+    def __init__(self, path, ttl=TTL, miss_refresh=MISS_REFRESH):
+        self.ttl = ttl
+        self.miss_refresh = miss_refresh
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS names '
+                        '(kind TEXT, name TEXT, uuid TEXT, PRIMARY KEY (kind, name))')
+        self.db.execute('CREATE INDEX IF NOT EXISTS names_uuid ON names (kind, uuid)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS kinds '
+                        '(kind TEXT PRIMARY KEY, refreshed_at REAL, source TEXT)')
+        self.db.commit()
+        # kind -> (refreshed_at, {name: uuid}, {uuid: name})
+        self.kinds = {}
+        # kind -> time of the last attempt to refresh it on lookup
+        self.attempts = {}
+
+    def load(self, kind):
+        if kind not in self.kinds:
+            row = self.db.execute('SELECT refreshed_at FROM kinds WHERE kind = ?',
+                                  (kind,)).fetchone()
+            pairs = self.db.execute('SELECT name, uuid FROM names WHERE kind = ?',
+                                    (kind,)).fetchall()
+            self.kinds[kind] = (row[0] if row else 0.0, dict(pairs),
+                                dict((uuid, name) for name, uuid in pairs))
+        return self.kinds[kind]
+
+    def store(self, kind, pairs, source):
+        '''
+            Replaces the names of kind by pairs, (name, uuid) in order.
+        '''
+        names = {}
+        for name, uuid in pairs:
+            if name and uuid and name not in names:
+                names[name] = uuid
+        now = time.time()
+        with self.db:
+            self.db.execute('DELETE FROM names WHERE kind = ?', (kind,))
+            self.db.executemany('INSERT INTO names VALUES (?, ?, ?)',
+                                [(kind, name, uuid) for name, uuid in names.items()])
+            self.db.execute('INSERT OR REPLACE INTO kinds VALUES (?, ?, ?)',
+                            (kind, now, source))
+        self.kinds[kind] = (now, names, dict((uuid, name) for name, uuid in names.items()))
+        metrics.count('name_refreshes')
+
+    def from_export(self, kind, path):
+        name_col, uuid_col = KINDS[kind][2:]
+        df = columnar.read_table(path, [name_col, uuid_col])
+        return zip(df[name_col].values, df[uuid_col].values)
+
+    def from_api(self, kind):
+        endpoint, name_col, uuid_col = KINDS[kind][1:]
+        pairs = []
+        url = session.url('v2', endpoint)
+        while url:
+            r = session.get(url)
+            r.raise_for_status()
+            page = r.json()
+            pairs.extend((item.get(name_col), item.get(uuid_col)) for item in page['results'])
+            url = page.get('next')
+        return pairs
+
+    def refresh(self, kind):
+        '''
+            Reloads kind from its export when it changed after the last
+            refresh, from the API otherwise.
+        '''
+        refreshed_at = self.load(kind)[0]
+        path = export_path(kind)
+        if path and os.path.isfile(path) and os.path.getmtime(path) > refreshed_at:
+            self.store(kind, self.from_export(kind, path), path)
+        else:
+            self.store(kind, self.from_api(kind), 'api')
+
+    def warm(self, kind, path=None):
+        '''
+            Loads kind from its export (path, by default the one in
+            keys.ini), e.g. right after exporting it.
+        '''
+        path = path or export_path(kind)
+        with self.lock:
+            self.store(kind, self.from_export(kind, path), path)
+
+    def current(self, kind, key, index):
+        '''
+            index 1 of the kind looks names up, 2 uuids. Refreshes the kind
+            when it expired or key is missing; if that fails, the names
+            already known are used.
+        '''
+        with self.lock:
+            entry = self.load(kind)
+            now = time.time()
+            stale = now - entry[0] > self.ttl or key not in entry[index]
+            if stale and now - self.attempts.get(kind, 0) > self.miss_refresh:
+                self.attempts[kind] = now
+                try:
+                    self.refresh(kind)
+                except (IOError, ValueError) as ex:
+                    print("---> No se pudieron actualizar los nombres de %s: %s" % (kind, ex))
+            return self.kinds[kind][index].get(key)
+
+    def uuid(self, kind, name):
+        return self.current(kind, name, 1)
+
+    def name(self, kind, uuid):
+        return self.current(kind, uuid, 2)
+
+
+def resolver():
+    '''
+        The Resolver every module shares, of the cache in the current root
+        (a new one if the root was overridden, e.g. by bench.py).
+    '''
+    global _resolver
+    path = lazy.setting('paths', 'root') + NAMES_CACHE
+    with _resolver_lock:
+        if _resolver is None or _resolver[0] != path:
+            _resolver = (path, Resolver(path))
+        return _resolver[1]
+
+
+def uuid(kind, name):
+    '''
+        uuid (key for fields) of the kind called name, None if there is none.
+    '''
+    return resolver().uuid(kind, name)
+
+
+def name(kind, uuid):
+    return resolver().name(kind, uuid)
+
+
+def warm(kind, path=None):
+    '''
+        Loads kind from its export into the cache. A failure is only
+        reported: the export was written, and lookups refresh the kind
+        on their own.
+    '''
+    try:
+        resolver().warm(kind, path)
+    except (IOError, ValueError, KeyError, sqlite3.Error) as ex:
+        print("---> No se pudo actualizar la caché de nombres de %s: %s" % (kind, ex))
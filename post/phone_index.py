@@ -0,0 +1,133 @@
+# coding=utf-8
+'''
+Persistent phone -> contact uuid index, so that spreadsheet rows can be
+matched with RapidPro contacts without reading the whole contacts export.
+
+The index is an SQLite file next to the contacts export it comes from
+(contacts.csv -> contacts_phones.sqlite). get.py keeps it up to date when
+contacts are exported or synced; utils.lookup_uuids queries it in bulk.
+Phones are normalized to '+' followed by their digits, so 'tel:+52 55 1234',
+'+52551234' and '52551234' are the same key.
+'''
+
+import os
+import sqlite3
+import pandas as pd
+import columnar
+
+# Placeholders per SELECT ... IN (...), below SQLite's limit
+LOOKUP_CHUNK = 900
+
+
+def normalize(phones):
+    '''
+        phones is a pd.Series of phone numbers or tel: urns.
+    '''
+    digits = (phones.fillna('').astype(str)
+              .str.replace(r'^tel:', '', regex=True)
+              .str.replace(r'\D', '', regex=True))
+    return ('+' + digits).where(digits != '', '')
+
+
+def contact_phones(df):
+    '''
+        (phone, uuid) pairs of a contacts DataFrame, from its phone column
+        (v1 exports) and its tel: urns_* columns (v2 exports).
+    '''
+    columns = [c for c in df.columns if c == 'phone' or str(c).startswith('urns_')]
+    pairs = []
+    for col in columns:
+        values = df[col].fillna('').astype(str)
+        if col != 'phone':
+            values = values.where(values.str.startswith('tel:'), '')
+        pairs.append(pd.DataFrame({'phone': normalize(values), 'uuid': df['uuid']}))
+    if not pairs:
+        return pd.DataFrame(columns=['phone', 'uuid'])
+    pairs = pd.concat(pairs, ignore_index=True)
+    return pairs[(pairs['phone'] != '') & pairs['uuid'].notnull()]
+
+
+class PhoneIndex(object):
+    '''
+        SQLite table phone -> uuid. A phone belongs to a single contact:
+        the contact upserted last wins.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS phones '
+                        '(phone TEXT PRIMARY KEY, uuid TEXT NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS phones_uuid ON phones (uuid)')
+        self.db.commit()
+
+    def remove(self, uuids):
+        with self.db:
+            self.db.executemany('DELETE FROM phones WHERE uuid = ?',
+                                [(u,) for u in set(uuids)])
+
+    def upsert(self, df):
+        '''
+            Replaces the phones of the contacts in df (a contacts export).
+        '''
+        if 'uuid' not in df.columns:
+            return
+        pairs = contact_phones(df)
+        with self.db:
+            self.db.executemany('DELETE FROM phones WHERE uuid = ?',
+                                [(u,) for u in set(df['uuid'].dropna())])
+            self.db.executemany('INSERT OR REPLACE INTO phones VALUES (?, ?)',
+                                pairs[['phone', 'uuid']].itertuples(index=False))
+
+    def rebuild(self, df):
+        with self.db:
+            self.db.execute('DELETE FROM phones')
+        self.upsert(df)
+
+    def lookup(self, phones):
+        '''
+            uuids of phones (a pd.Series, any format), '' when unknown.
+        '''
+        keys = normalize(phones)
+        wanted = [k for k in set(keys) if k]
+        found = {}
+        for start in range(0, len(wanted), LOOKUP_CHUNK):
+            chunk = wanted[start:start + LOOKUP_CHUNK]
+            query = ('SELECT phone, uuid FROM phones WHERE phone IN (%s)'
+                     % ','.join('?' * len(chunk)))
+            found.update(self.db.execute(query, chunk).fetchall())
+        return keys.map(lambda k: found.get(k, ''))
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM phones').fetchone()[0]
+
+
+def index_path(contacts_path):
+    return os.path.splitext(contacts_path)[0] + '_phones.sqlite'
+
+
+def read_contacts(contacts_path, columns=()):
+    '''
+        Only the columns the index needs, plus columns (a list, those
+        missing in the export are skipped, or a function of the column
+        name), from the .csv or its columnar copy.
+    '''
+    path = columnar.locate(contacts_path)
+    extra = columns if callable(columns) else lambda c: c in columns
+    wanted = lambda c: c in ('uuid', 'phone') or c.startswith('urns_') or extra(c)
+    if path.endswith(columnar.FORMATS['csv']):
+        return pd.read_csv(path, usecols=wanted, dtype=str)
+    df = columnar.read_table(path)
+    return df[[c for c in df.columns if wanted(c)]]
+
+
+def open_index(contacts_path):
+    '''
+        PhoneIndex of the contacts export in contacts_path, built from the
+        export the first time.
+    '''
+    path = index_path(contacts_path)
+    exists = os.path.isfile(path)
+    index = PhoneIndex(path)
+    if not exists and os.path.isfile(columnar.locate(contacts_path)):
+        index.rebuild(read_contacts(contacts_path))
+    return index
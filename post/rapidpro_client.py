@@ -0,0 +1,74 @@
+# coding=utf-8
+'''
+TembaClient whose requests go through the shared session of session.py.
+Imported by session.temba_client() on first use, so that importing get.py or
+utils.py does not load temba_client.
+'''
+
+import json
+import time
+import requests
+from temba_client.v2 import TembaClient
+from temba_client.exceptions import (TembaBadRequestError, TembaConnectionError,
+                                     TembaHttpError, TembaNoSuchObjectError,
+                                     TembaRateExceededError, TembaTokenError)
+import metrics
+import session
+
+# Same as temba_client: retries of a request answered with 429
+MAX_RATE_RETRIES = 5
+
+
+class RapidProClient(TembaClient):
+    '''
+        TembaClient whose requests go through the shared session, with the
+        same errors and retry-on-rate-limit behavior as temba_client.
+    '''
+    def __init__(self, host, token):
+        super(RapidProClient, self).__init__(host, token)
+        # Auth headers are sent by the session
+        self.headers = {'Accept': 'application/json',
+                        'User-Agent': self.headers.get('User-Agent', '')}
+
+    def _request(self, method, url, params=None, body=None, retry_on_rate_exceed=False):
+        retries = 0
+        while True:
+            try:
+                return self._send(method, url, params, body)
+            except TembaRateExceededError as ex:
+                retries += 1
+                if retry_on_rate_exceed and retries < MAX_RATE_RETRIES and ex.retry_after:
+                    metrics.count('retries')
+                    metrics.count('rate_limit_waits')
+                    metrics.count('rate_limit_wait_seconds', ex.retry_after)
+                    time.sleep(ex.retry_after)
+                else:
+                    raise
+
+    def _send(self, method, url, params, body):
+        kwargs = {'headers': self.headers}
+        if body:
+            kwargs['data'] = json.dumps(body)
+        if params:
+            kwargs['params'] = params
+        try:
+            response = session.request(method, url, **kwargs)
+            if response.status_code == 400:
+                try:
+                    errors = response.json()
+                except ValueError:
+                    errors = {'details': [response.content]}
+                raise TembaBadRequestError(errors)
+            elif response.status_code == 403:
+                raise TembaTokenError()
+            elif response.status_code == 404:
+                raise TembaNoSuchObjectError()
+            elif response.status_code == 429:
+                retry_after = response.headers.get('retry-after')
+                raise TembaRateExceededError(int(retry_after) if retry_after else 0)
+            response.raise_for_status()
+            return response.json() if response.content else None
+        except requests.HTTPError as ex:
+            raise TembaHttpError(ex)
+        except requests.exceptions.ConnectionError:
+            raise TembaConnectionError()
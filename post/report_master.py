@@ -14,6 +14,8 @@ import numpy as np
 import pandas as pd
 import datetime as dt
 import get
+import sanitize
+import metrics
 
 #user= "/Users/Ana1/Dropbox/DropboxQFPD"
 #user = "c: /users/francisco del villar/Dropbox (qfpd)/"
@@ -72,21 +74,10 @@ def fetch_report(date):
     df = df.loc[df['fecha'] == date, :]
 
     # Remove unwanted characters
-    chars = {
-                'á': 'a',
-                'é': 'e',
-                'í': 'i',
-                'ó': 'o',
-                'ú': 'u',
-                'ñ': 'n',
-                '$': '',
-                'ª': ''
-            }
-    for ugly in chars.keys():
-        for col in ['observaciones',
-                    'Nombre de clínica',
-                    'connect_pbs_nRes_action']:
-            df[col] = df[col].str.replace(ugly, chars[ugly], case=False)
+    sanitize.clean_frame(df, ['observaciones',
+                              'Nombre de clínica',
+                              'connect_pbs_nRes_action'],
+                         table=sanitize.ACCENTS)
 
     df.to_csv(report_dir + "/current_day.csv", index=False)
 
@@ -220,6 +211,7 @@ def wrap(date):
 
     return None
 
+@metrics.measured('wrap_full')
 def wrap_full(date, isUpdate=None):
     '''
         Executes procedures to generate report using R scripts instead of do-files (except for
@@ -232,17 +224,18 @@ def wrap_full(date, isUpdate=None):
         # Import get.py, instantiate ExportRuns and run export_runs(date)
         #os.chdir(download)
 
+        # Import flows first: their modified_on tells export_runs which
+        # cached flow definitions are still valid
+        print('In flows...')
+        flows = get.GetFlows()
+        flows.export_flows()
+        print('Out flows')
         # Now get those runs
         print('In runs...')
         runs = get.ExportRuns()
         runs.export_runs()
         #runs.append_runs()
         print('Out runs')
-        # Import flows
-        print('In flows...')
-        flows = get.GetFlows()
-        flows.export_flows()
-        print('Out flows')
         # Now get those messages
         print('In external messages')
         messages = get.GetMessages()
@@ -255,7 +248,7 @@ def wrap_full(date, isUpdate=None):
         # Now run export_contacts(date)
         print('In contacts...')
         contacts = get.GetContacts()
-        contacts.export_contacts()
+        contacts.sync_contacts()
         print('Out contacts')
     else:
         print('Data already updated proceed with data manipulation')
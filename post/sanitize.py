@@ -0,0 +1,92 @@
+# coding=utf-8
+'''
+Text cleaning of the datasets before they are exported, a whole column at a
+time with replacement tables compiled once, instead of one str.replace per
+character and value.
+
+     TEXT     characters that break the .csv imports of our Stata/R scripts
+              (quotes, separators, dashes, ellipsis, line breaks)
+     ACCENTS  accents and symbols of the field reports, replaced by plain
+              ascii letters
+
+Exported text repeats a lot (broadcasts, flow messages, short answers), so a
+column is factorized first and only its distinct values are cleaned.
+'''
+
+import numpy as np
+import pandas as pd
+
+# Removed from exported text
+TEXT_CHARS = ['\r\n', '"', "'", ";", ",", u'\u2013', u'\u2026', u'\u23CE', u'☭']
+ACCENT_CHARS = {u'á': u'a', u'é': u'e', u'í': u'i', u'ó': u'o', u'ú': u'u',
+                u'ñ': u'n', u'$': u'', u'ª': u''}
+
+
+def compile_table(chars, case=True):
+    '''
+        Replacement table, a tuple of (old, new), from {old: new} or a list
+        of strings to remove. case=False also replaces the upper case of
+        every old string.
+    '''
+    if not isinstance(chars, dict):
+        chars = [(old, u'') for old in chars]
+    else:
+        chars = list(chars.items())
+    table = []
+    for old, new in chars:
+        table.append((old, new))
+        if not case and old.upper() != old:
+            table.append((old.upper(), new))
+    return tuple(table)
+
+
+TEXT = compile_table(TEXT_CHARS)
+ACCENTS = compile_table(ACCENT_CHARS, case=False)
+
+
+def clean_values(values, table=TEXT):
+    '''
+        List with every string of values (any iterable) cleaned with table,
+        other values are returned as they are.
+    '''
+    cleaned = []
+    for value in values:
+        if isinstance(value, str):
+            for old, new in table:
+                value = value.replace(old, new)
+        cleaned.append(value)
+    return cleaned
+
+
+def clean_column(series, table=TEXT):
+    '''
+        series with its strings cleaned, same index and name. Each distinct
+        value is cleaned once.
+    '''
+    codes, uniques = pd.factorize(series)
+    cleaned = np.empty(len(uniques) + 1, dtype=object)
+    cleaned[:-1] = clean_values(uniques, table)
+    values = cleaned.take(codes)
+    # Missing values (code -1) are kept as they are
+    missing = codes == -1
+    if missing.any():
+        values[missing] = series.values[missing]
+    return pd.Series(values, index=series.index, name=series.name, dtype=object)
+
+
+def text_columns(df):
+    return [col for col in df.columns if
+            pd.api.types.is_object_dtype(df[col]) or pd.api.types.is_string_dtype(df[col])]
+
+
+def clean_frame(df, columns=None, table=TEXT):
+    '''
+        Cleans columns of df in place (every text column when None) and
+        returns it. Missing columns are skipped.
+    '''
+    if columns is None:
+        columns = text_columns(df)
+    for col in columns:
+        if col in df.columns:
+            df[col] = clean_column(df[col], table)
+    return df
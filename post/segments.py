@@ -0,0 +1,235 @@
+# coding=utf-8
+'''
+Append-only store of a dataset split in time windows, used for runs.
+
+Every window [after, before) downloaded by get.ExportRuns is written once as
+its own .csv segment and never modified; segments.json lists them in
+chronological order with their bounds, rows, columns and sha1. New data only
+adds segments, compact merges runs of small neighbouring segments into new
+ones, and read loads a date range touching only the segments that overlap it.
+
+     datasets/runs_segments/segments.json
+     datasets/runs_segments/20170101T000000_20170102T000000.csv
+     ...
+
+'''
+
+import os
+import json
+import hashlib
+import pandas as pd
+
+MANIFEST = 'segments.json'
+DATE_FORMAT = '%Y%m%dT%H%M%S'
+
+
+def parse_date(value):
+    '''
+        Naive datetime of an ISO date; dateutil is imported on first use.
+    '''
+    import dateutil.parser
+    return dateutil.parser.parse(value).replace(tzinfo=None)
+
+
+class SegmentStore(object):
+    '''
+        Directory of immutable .csv segments plus their manifest. The
+        manifest is rewritten atomically after the segment files it points
+        to are on disk, so a killed process never leaves it pointing to a
+        partial segment.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, MANIFEST)
+        self.segments = []
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                self.segments = json.load(f)['segments']
+
+    def save(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'segments': self.segments}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def file(self, segment):
+        return os.path.join(self.directory, segment['name'])
+
+    def write_file(self, name, data):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = os.path.join(self.directory, name)
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def entry(self, after, before, data, rows, columns):
+        '''
+            Writes the segment file of [after, before) (data is a .csv with
+            header) and returns its manifest entry. Empty windows have no
+            file, they only record that the window was downloaded.
+        '''
+        name = None
+        if rows:
+            name = '%s_%s.csv' % (after.strftime(DATE_FORMAT), before.strftime(DATE_FORMAT))
+            self.write_file(name, data)
+        return {'name': name,
+                'after': after.isoformat(),
+                'before': before.isoformat(),
+                'rows': rows,
+                'columns': columns,
+                'sha1': hashlib.sha1(data).hexdigest() if rows else None}
+
+    def add(self, after, before, data, rows, columns):
+        '''
+            Adds the segment [after, before), which must start where the last
+            one ends or later.
+        '''
+        if self.segments and after < parse_date(self.segments[-1]['before']):
+            raise ValueError("Segment [%s, %s) overlaps the store, it ends at %s"
+                             % (after, before, self.segments[-1]['before']))
+        self.segments.append(self.entry(after, before, data, rows, columns))
+        self.save()
+
+    def last_before(self):
+        '''
+            End of the last segment, None if the store is empty.
+        '''
+        if not self.segments:
+            return None
+        return parse_date(self.segments[-1]['before'])
+
+    def resume(self):
+        '''
+            Drops the last segments whose file is missing or does not match
+            its checksum and returns the end of the last good one.
+        '''
+        dropped = False
+        while self.segments:
+            last = self.segments[-1]
+            if last['name'] is None or self.checksum(last) == last['sha1']:
+                break
+            print ("---> Segmento %s incompleto, se descarga de nuevo" % last['name'])
+            self.segments.pop()
+            dropped = True
+        if dropped:
+            self.save()
+        return self.last_before()
+
+    def checksum(self, segment):
+        path = self.file(segment)
+        if not os.path.isfile(path):
+            return None
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def select(self, after=None, before=None):
+        '''
+            Segments with data that overlap [after, before), None is unbounded.
+        '''
+        return [s for s in self.segments if s['name'] is not None and
+                (after is None or parse_date(s['before']) > after) and
+                (before is None or parse_date(s['after']) < before)]
+
+    def read_segment(self, segment, columns=None):
+        usecols = None
+        if columns is not None:
+            usecols = [c for c in columns if c in segment['columns']]
+        return pd.read_csv(self.file(segment), usecols=usecols, dtype=str)
+
+    def read(self, after=None, before=None, columns=None, date_column=None):
+        '''
+            DataFrame with the rows of the segments that overlap [after,
+            before), keeping only columns. date_column (e.g. 'modified_on')
+            also trims the rows of the first and last segments to the range.
+        '''
+        wanted = columns
+        if columns is not None and date_column is not None and date_column not in columns:
+            wanted = list(columns) + [date_column]
+        frames = [self.read_segment(s, wanted) for s in self.select(after, before)]
+        if not frames:
+            return pd.DataFrame(columns=columns or [])
+        df = pd.concat(frames, ignore_index=True, sort=False)
+        if date_column is not None and date_column in df:
+            dates = pd.to_datetime(df[date_column], utc=True, errors='coerce').dt.tz_localize(None)
+            keep = dates.notnull()
+            if after is not None:
+                keep &= dates >= after
+            if before is not None:
+                keep &= dates < before
+            df = df[keep.values].reset_index(drop=True)
+        if columns is not None:
+            df = df.reindex(columns=columns)
+        return df
+
+    def merge(self, group):
+        '''
+            Entry of one new segment holding the rows of the consecutive
+            segments of group.
+        '''
+        with_data = [s for s in group if s['name'] is not None]
+        after = parse_date(group[0]['after'])
+        before = parse_date(group[-1]['before'])
+        if not with_data:
+            return self.entry(after, before, b'', 0, [])
+        if len(with_data) == 1:
+            # Only empty windows around it: same file, wider bounds
+            segment = dict(with_data[0])
+            segment.update({'after': after.isoformat(), 'before': before.isoformat()})
+            return segment
+        frames = [self.read_segment(s) for s in with_data]
+        df = pd.concat(frames, ignore_index=True, sort=False)
+        data = df.to_csv(index=False).encode('utf-8')
+        return self.entry(after, before, data, len(df.index), [str(c) for c in df.columns])
+
+    def compact(self, min_rows):
+        '''
+            Merges every run of consecutive segments with fewer than min_rows
+            rows in total into a single segment. Big segments are left
+            untouched, so the work done is bounded by the small ones.
+            Returns the number of segments removed.
+        '''
+        groups = []
+        group = []
+        for segment in self.segments:
+            if segment['rows'] >= min_rows:
+                groups += [group, [segment]]
+                group = []
+                continue
+            group.append(segment)
+            if sum(s['rows'] for s in group) >= min_rows:
+                groups.append(group)
+                group = []
+        groups.append(group)
+
+        segments = []
+        replaced = []
+        for group in groups:
+            if len(group) == 1:
+                segments.append(group[0])
+            elif group:
+                segments.append(self.merge(group))
+                replaced += [s for s in group if s['name'] is not None]
+        removed = len(self.segments) - len(segments)
+        if removed:
+            self.segments = segments
+            self.save()
+            # Merged segments may reuse the name of one they replace
+            kept = set(s['name'] for s in segments)
+            for segment in replaced:
+                if segment['name'] not in kept and os.path.isfile(self.file(segment)):
+                    os.remove(self.file(segment))
+        return removed
+
+    def __len__(self):
+        return len(self.segments)
@@ -0,0 +1,127 @@
+# coding=utf-8
+'''
+Process-wide HTTP layer for every RapidPro call made by get.py and utils.py.
+
+A single requests.Session keeps TLS connections alive in a pool shared by all
+threads, carries the RapidPro auth headers and applies default timeouts.
+rapidpro_client.RapidProClient is a TembaClient that sends its requests
+through it, and temba_client() returns the one instance every Get subclass
+shares. requests and temba_client are only imported, and keys.ini only read,
+when the first request is made.
+
+Optional keys.ini section:
+
+     [http]
+     pool_size = 16
+     connect_timeout = 10
+     read_timeout = 120
+
+'''
+
+import threading
+import lazy
+import metrics
+
+# Set by configure, the rest come from keys.ini (see option)
+_options = {}
+_session = None
+_client = None
+_lock = threading.Lock()
+
+
+def option(name):
+    '''
+        'host', 'pool_size' (connections per host) or 'timeout' ((connect,
+        read) seconds), as given to configure or else from keys.ini.
+    '''
+    if name in _options:
+        return _options[name]
+    if name == 'host':
+        return lazy.setting('rapidpro', 'host', 'https://rapidpro.io')
+    if name == 'pool_size':
+        return int(lazy.setting('http', 'pool_size', 16))
+    if name == 'timeout':
+        return (float(lazy.setting('http', 'connect_timeout', 10)),
+                float(lazy.setting('http', 'read_timeout', 120)))
+    raise KeyError(name)
+
+
+def url(version, endpoint):
+    '''
+        e.g. url('v1', 'contacts') -> https://rapidpro.io/api/v1/contacts.json
+    '''
+    return '%s/api/%s/%s.json' % (option('host').rstrip('/'), version, endpoint)
+
+
+def configure(pool_size=None, timeout=None, rapidpro_host=None):
+    '''
+        Changes the pool size (connections per host), the default
+        (connect, read) timeout and/or the RapidPro host, e.g. a stand-in
+        server (see standin.py). The session and the client are rebuilt on
+        next use.
+    '''
+    global _session, _client
+    with _lock:
+        if pool_size is not None:
+            _options['pool_size'] = pool_size
+        if timeout is not None:
+            _options['timeout'] = timeout
+        if rapidpro_host is not None:
+            _options['host'] = rapidpro_host
+            _client = None
+        if _session is not None:
+            _session.close()
+        _session = None
+
+
+def get_session():
+    '''
+        The process-wide requests.Session, with keep-alive connection pooling
+        and the RapidPro auth headers.
+    '''
+    global _session
+    with _lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            s = requests.Session()
+            pool_size = option('pool_size')
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            s.mount('https://', adapter)
+            s.mount('http://', adapter)
+            s.headers.update({'content-type': 'application/json',
+                              'Authorization': lazy.setting('rapidpro', 'rp_api')})
+            _session = s
+        return _session
+
+
+def request(method, url, **kwargs):
+    kwargs.setdefault('timeout', option('timeout'))
+    with metrics.stage('request') as s:
+        response = get_session().request(method, url, **kwargs)
+        s.bytes = len(response.content)
+    metrics.count('requests')
+    if response.status_code == 429:
+        metrics.count('rate_limited')
+    return response
+
+
+def get(url, **kwargs):
+    return request('get', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('post', url, **kwargs)
+
+
+def temba_client():
+    '''
+        The RapidProClient shared by every Get instance of the process.
+    '''
+    global _client
+    if _client is None:
+        from rapidpro_client import RapidProClient
+        # rp_api format: 'Token value', TembaClient use value
+        _client = RapidProClient(option('host'),
+                                 lazy.setting('rapidpro', 'rp_api').split(' ')[1])
+    return _client
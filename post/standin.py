@@ -0,0 +1,520 @@
+# coding=utf-8
+'''
+Local stand-in for the RapidPro v2 API, to measure get.py without touching
+production. It serves a synthetic workspace with the JSON shapes get.py
+uses: paginated contacts, runs (path and values), messages, flows, groups,
+fields and definitions.json, and can answer 429 like RapidPro does when a
+request rate is exceeded. Writes (POST to any v1/v2 endpoint) are accepted
+and recorded in StandIn.posts, a share of them can fail with 500; flow
+starts get a uuid and are complete start_delay seconds later.
+
+     In [1]: import standin, session
+     In [2]: server = standin.StandIn(standin.Workspace(contacts=5000, runs=20000))
+     In [3]: server.start()
+     In [4]: session.configure(rapidpro_host=server.url)
+
+Records are generated from their position, so large workspaces take no
+memory: record i of every endpoint is always the same, and its dates grow
+with i, which is what the after/before filters and the pagination rely on.
+'''
+
+import json
+import math
+import random
+import threading
+import time
+import uuid
+import zlib
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, urlencode
+
+import dateutil.parser
+
+# Same as RapidPro
+PAGE_SIZE = 250
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+# Groups of get.GetFailedMessages plus the treatment arms
+GROUP_NAMES = ["PUERPERIUM", "PREGNANT", "ALTOPD", "Muerte", "AUXVO", "SE-T Pregnancy",
+               "SE-T Baby", "SE-C Pregnancy", "SE-C Baby", "T1", "T2", "T3"]
+ANSWERS = ['1', '2', 'si', 'no', 'Si, gracias', 'no se', '15/03/2017', 'ok "bien"']
+
+
+def iso(date):
+    return date.strftime(DATE_FORMAT)
+
+
+def parse_date(value):
+    return dateutil.parser.parse(value).replace(tzinfo=None)
+
+
+def make_uuid(kind, i):
+    return str(uuid.UUID(int=zlib.crc32(kind.encode('utf-8')) << 96 | i))
+
+
+def uuid_index(value):
+    '''
+        i of make_uuid(kind, i).
+    '''
+    return uuid.UUID(value).int & ((1 << 96) - 1)
+
+
+class Timeline(object):
+    '''
+        n records whose dates are spread evenly over [start, end), record i
+        being the i-th oldest.
+    '''
+    def __init__(self, n, start, end):
+        self.n = n
+        self.start = start
+        self.step = (end - start).total_seconds() / max(n, 1)
+
+    def date(self, i):
+        return self.start + timedelta(seconds=(i + 0.5) * self.step)
+
+    def bounds(self, after=None, before=None):
+        '''
+            range of the records with after <= date < before.
+        '''
+        lo, hi = 0, self.n
+        if after is not None:
+            lo = int(math.ceil((after - self.start).total_seconds() / self.step - 0.5))
+        if before is not None:
+            hi = int(math.ceil((before - self.start).total_seconds() / self.step - 0.5))
+        return range(max(lo, 0), max(min(hi, self.n), 0))
+
+
+class Workspace(object):
+    '''
+        Synthetic workspace. run_length is the number of steps of a run,
+        failed_ratio and deleted_ratio the share of failed (or errored)
+        messages and of deleted contacts.
+    '''
+    def __init__(self, contacts=1000, runs=5000, run_length=20, messages=5000,
+                 flows=10, nodes=60, fields=25, failed_ratio=0.05,
+                 deleted_ratio=0.01, start=datetime(2016, 1, 1),
+                 end=datetime(2017, 1, 1), seed=0):
+        self.seed = seed
+        self.n_contacts = contacts
+        self.n_deleted = int(contacts * deleted_ratio)
+        self.n_flows = flows
+        self.n_nodes = nodes
+        self.n_fields = fields
+        self.run_length = run_length
+        self.failed_ratio = failed_ratio
+        self.contacts = Timeline(contacts, start, end)
+        self.deleted = Timeline(self.n_deleted, start, end)
+        self.runs = Timeline(runs, start, end)
+        self.messages = Timeline(messages, start, end)
+        self.flow_list = [self.flow(f) for f in range(flows)]
+        self.groups = [{'uuid': make_uuid('group', g), 'name': name, 'query': None,
+                        'count': 0, 'status': 'ready', 'system': False}
+                       for g, name in enumerate(GROUP_NAMES)]
+        self.queries = {}
+        self.lock = threading.Lock()
+
+    def rng(self, kind, i):
+        return random.Random('%s-%s-%d' % (self.seed, kind, i))
+
+    # Records #
+
+    def contact_groups(self, i):
+        rng = self.rng('groups', i)
+        return rng.sample(range(len(self.groups)), rng.randint(1, 3))
+
+    def contact(self, i):
+        rng = self.rng('contact', i)
+        modified = self.contacts.date(i)
+        return {'uuid': make_uuid('contact', i),
+                'name': 'Contacto %d' % i,
+                'language': rng.choice([None, 'spa']),
+                'urns': ['tel:+5255%08d' % i],
+                'groups': [{'uuid': self.groups[g]['uuid'], 'name': self.groups[g]['name']}
+                           for g in self.contact_groups(i)],
+                'fields': dict(('rp_field%02d' % f, rng.choice([None, 'valor %d' % f, str(i)]))
+                               for f in range(self.n_fields)),
+                'blocked': False,
+                'stopped': rng.random() < 0.05,
+                'status': 'active',
+                'flow': None,
+                'created_on': iso(modified - timedelta(days=30)),
+                'modified_on': iso(modified),
+                'last_seen_on': iso(modified)}
+
+    def deleted_contact(self, i):
+        modified = self.deleted.date(i)
+        return {'uuid': make_uuid('deleted', i), 'name': None, 'language': None,
+                'urns': [], 'groups': [], 'fields': {}, 'blocked': None,
+                'stopped': None, 'status': None, 'flow': None,
+                'created_on': iso(modified - timedelta(days=30)),
+                'modified_on': iso(modified), 'last_seen_on': None}
+
+    def flow(self, f):
+        return {'uuid': make_uuid('flow', f),
+                'name': 'flujo %d' % f,
+                'type': 'message',
+                'archived': False,
+                'labels': [],
+                'expires': 10080,
+                'runs': {'active': 0, 'waiting': 0, 'completed': 0, 'interrupted': 0,
+                         'expired': 0, 'failed': 0},
+                'results': [],
+                'created_on': iso(self.runs.start),
+                'modified_on': iso(self.runs.start)}
+
+    def node(self, f, n):
+        return make_uuid('node-%d' % f, n)
+
+    def definition(self, f):
+        '''
+            Legacy (action_sets / rule_sets) definition: even nodes send a
+            message, odd nodes wait for an answer.
+        '''
+        return {'metadata': {'uuid': self.flow_list[f]['uuid'],
+                             'name': self.flow_list[f]['name']},
+                'action_sets': [{'uuid': self.node(f, n),
+                                 'actions': [{'type': 'reply',
+                                              'msg': {'spa': 'Mensaje %d del flujo %d' % (n, f)}}]}
+                                for n in range(0, self.n_nodes, 2)],
+                'rule_sets': [{'uuid': self.node(f, n)} for n in range(1, self.n_nodes, 2)]}
+
+    def run(self, i):
+        '''
+            Run whose path walks the nodes of its flow, repeating an answer
+            node now and then like contacts who answer wrong do.
+        '''
+        rng = self.rng('run', i)
+        f = rng.randrange(self.n_flows)
+        c = rng.randrange(self.n_contacts)
+        modified = self.runs.date(i)
+        created = modified - timedelta(seconds=60 * self.run_length)
+        path = []
+        values = {}
+        n = 0
+        for step in range(self.run_length):
+            time_step = created + timedelta(seconds=60 * step)
+            node = self.node(f, n % self.n_nodes)
+            path.append({'node': node, 'time': iso(time_step)})
+            if n % 2:
+                values['result_%d' % (n % self.n_nodes)] = {
+                    'name': 'Result %d' % n, 'value': rng.choice(ANSWERS),
+                    'category': rng.choice(['Si', 'No', 'Other']), 'node': node,
+                    'time': iso(time_step)}
+                if rng.random() < 0.2:
+                    n -= 1
+                    continue
+            n += 1
+        return {'uuid': make_uuid('run', i),
+                'flow': {'uuid': self.flow_list[f]['uuid'], 'name': self.flow_list[f]['name']},
+                'contact': {'uuid': make_uuid('contact', c), 'name': 'Contacto %d' % c},
+                'start': None,
+                'responded': bool(values),
+                'path': path,
+                'values': values,
+                'created_on': iso(created),
+                'modified_on': iso(modified),
+                'exited_on': iso(modified),
+                'exit_type': 'completed'}
+
+    def message_status(self, i):
+        rng = self.rng('status', i)
+        if rng.random() < self.failed_ratio:
+            return rng.choice(['failed', 'errored'])
+        return 'delivered'
+
+    def message_contact(self, i):
+        return i % self.n_contacts
+
+    def message_folder(self, i):
+        if i % 2 == 0:
+            return 'inbox'
+        return {'failed': 'failed', 'errored': 'outbox'}.get(self.message_status(i), 'sent')
+
+    def message(self, i):
+        rng = self.rng('message', i)
+        c = self.message_contact(i)
+        created = self.messages.date(i)
+        incoming = i % 2 == 0
+        return {'uuid': make_uuid('message', i),
+                'contact': {'uuid': make_uuid('contact', c), 'name': 'Contacto %d' % c},
+                'urn': 'tel:+5255%08d' % c,
+                'channel': {'uuid': make_uuid('channel', 0), 'name': 'Canal'},
+                'direction': 'in' if incoming else 'out',
+                'type': 'inbox' if incoming else 'flow',
+                'status': 'handled' if incoming else self.message_status(i),
+                'visibility': 'visible',
+                'text': rng.choice(ANSWERS) if incoming else 'Mensaje, "recordatorio" %d' % (i % 50),
+                'labels': [],
+                'attachments': [],
+                'quick_replies': [],
+                'flow': None,
+                'created_on': iso(created),
+                'sent_on': None if incoming else iso(created),
+                'modified_on': iso(created)}
+
+    # Queries: (number of results, result i) newest first, like RapidPro #
+
+    def query(self, endpoint, params):
+        '''
+            The filtered records of every query are kept while its pages
+            are requested.
+        '''
+        key = (endpoint, tuple(sorted((k, v) for k, v in params.items() if k != 'cursor')))
+        with self.lock:
+            if key not in self.queries:
+                if len(self.queries) > 100:
+                    self.queries.clear()
+                self.queries[key] = self.filter(endpoint, params)
+            return self.queries[key]
+
+    def filter(self, endpoint, params):
+        after = parse_date(params['after']) if params.get('after') else None
+        before = parse_date(params['before']) if params.get('before') else None
+        if endpoint == 'contacts':
+            if params.get('deleted') in ('true', 'True', '1'):
+                indexes = self.deleted.bounds(after, before)
+                return self.newest_first(indexes, self.deleted_contact)
+            indexes = self.contacts.bounds(after, before)
+            if params.get('uuid'):
+                indexes = [i for i in indexes if make_uuid('contact', i) == params['uuid']]
+            if params.get('group'):
+                wanted = [g for g, group in enumerate(self.groups)
+                          if params['group'] in (group['uuid'], group['name'])]
+                indexes = [i for i in indexes if set(wanted) & set(self.contact_groups(i))]
+            return self.newest_first(indexes, self.contact)
+        if endpoint == 'runs':
+            indexes = self.runs.bounds(after, before)
+            if params.get('flow'):
+                indexes = [i for i in indexes if self.run(i)['flow']['uuid'] == params['flow']]
+            return self.newest_first(indexes, self.run)
+        if endpoint == 'messages':
+            indexes = self.messages.bounds(after, before)
+            if params.get('contact'):
+                c = uuid_index(params['contact'])
+                first = indexes.start + (c - indexes.start) % self.n_contacts
+                indexes = range(first, indexes.stop, self.n_contacts)
+            if params.get('folder'):
+                indexes = [i for i in indexes if self.message_folder(i) == params['folder']]
+            if params.get('status'):
+                indexes = [i for i in indexes if i % 2 and self.message_status(i) == params['status']]
+            return self.newest_first(indexes, self.message)
+        if endpoint == 'flows':
+            flows = [f for f in self.flow_list if params.get('uuid') in (None, f['uuid'])]
+            return len(flows), flows.__getitem__
+        if endpoint == 'groups':
+            return len(self.groups), self.groups.__getitem__
+        if endpoint == 'fields':
+            fields = [{'key': 'rp_field%02d' % f, 'label': 'Rp Field %d' % f,
+                       'name': 'Rp Field %d' % f, 'value_type': 'text', 'type': 'text'}
+                      for f in range(self.n_fields)]
+            return len(fields), fields.__getitem__
+        if endpoint == 'channels':
+            channels = [{'uuid': make_uuid('channel', 0), 'name': 'Canal'}]
+            return len(channels), channels.__getitem__
+        return None
+
+    def newest_first(self, indexes, record):
+        indexes = list(indexes)[::-1] if not isinstance(indexes, range) else indexes[::-1]
+        return len(indexes), lambda k: record(indexes[k])
+
+    def definitions(self, params):
+        wanted = params.get('flow', '').split(',')
+        return {'version': '11.12',
+                'flows': [self.definition(f) for f, flow in enumerate(self.flow_list)
+                          if flow['uuid'] in wanted]}
+
+
+class RateLimiter(object):
+    '''
+        Token bucket of rate requests per second. take returns 0 when the
+        request can go on, otherwise the seconds to wait.
+    '''
+    def __init__(self, rate, retry_after=1):
+        self.rate = rate
+        self.retry_after = retry_after
+        self.tokens = rate
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return self.retry_after
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def throttled(self):
+        '''
+            Answers 429 and returns True when the rate limit is exceeded.
+        '''
+        server = self.server.standin
+        if server.limiter is not None:
+            wait = server.limiter.take()
+            if wait:
+                server.count('rate_limited')
+                self.reply(429, {'detail': 'Request was throttled.'},
+                           {'Retry-After': str(int(math.ceil(wait)))})
+                return True
+        return False
+
+    def do_GET(self):
+        server = self.server.standin
+        url = urlparse(self.path)
+        params = dict((key, values[-1]) for key, values in parse_qs(url.query).items())
+        parts = url.path.strip('/').split('/')
+        server.count('requests')
+        if len(parts) != 3 or parts[:2] != ['api', 'v2'] or not parts[2].endswith('.json'):
+            return self.reply(404, {'detail': 'Not found.'})
+        if self.throttled():
+            return
+        endpoint = parts[2][:-len('.json')]
+        if endpoint == 'flow_starts':
+            return self.reply(200, server.flow_starts(params))
+        if endpoint == 'definitions':
+            return self.reply(200, server.workspace.definitions(params))
+        query = server.workspace.query(endpoint, params)
+        if query is None:
+            return self.reply(404, {'detail': 'Not found.'})
+        total, record = query
+        start = int(params.get('cursor') or 0)
+        end = min(start + server.page_size, total)
+        next_url = None
+        if end < total:
+            params['cursor'] = str(end)
+            next_url = '%s%s?%s' % (server.url, url.path, urlencode(params))
+        server.count('records', end - start)
+        self.reply(200, {'next': next_url, 'previous': None,
+                         'results': [record(k) for k in range(start, end)]})
+
+    def do_POST(self):
+        server = self.server.standin
+        parts = urlparse(self.path).path.strip('/').split('/')
+        length = int(self.headers.get('Content-Length') or 0)
+        data = self.rfile.read(length)
+        server.count('requests')
+        if (len(parts) != 3 or parts[0] != 'api' or parts[1] not in ('v1', 'v2') or
+                not parts[2].endswith('.json')):
+            return self.reply(404, {'detail': 'Not found.'})
+        if self.throttled():
+            return
+        if server.post_errors and server.random() < server.post_errors:
+            server.count('post_errors')
+            return self.reply(500, {'detail': 'Server error.'})
+        try:
+            body = json.loads(data.decode('utf-8')) if data else {}
+        except ValueError:
+            return self.reply(400, {'detail': 'JSON parse error.'})
+        answer = server.record(parts[1], parts[2][:-len('.json')], body)
+        if server.lost_replies and server.random() < server.lost_replies:
+            server.count('post_errors')
+            return self.reply(500, {'detail': 'Server error.'})
+        self.reply(201, answer)
+
+    def reply(self, status, body, headers={}):
+        data = json.dumps(body).encode('utf-8')
+        self.server.standin.count('bytes', len(data))
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for key in headers:
+            self.send_header(key, headers[key])
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class StandIn(object):
+    '''
+        HTTP server of workspace on host:port (port 0 picks a free one),
+        run in a background thread. rate_limit (requests per second, None
+        for no limit) makes it answer 429 with Retry-After: retry_after.
+        post_errors is the share of writes answered with 500, lost_replies
+        the share of writes that are kept but answered with 500 anyway (as
+        when the answer is lost), flow starts take start_delay seconds to
+        complete. stats counts
+        requests, rate_limited answers, records, bytes and post_errors;
+        posts keeps the (version, endpoint, body) of every accepted write.
+    '''
+    def __init__(self, workspace=None, host='127.0.0.1', port=0, page_size=PAGE_SIZE,
+                 rate_limit=None, retry_after=1, post_errors=0.0, lost_replies=0.0,
+                 start_delay=1, seed=0):
+        self.workspace = workspace or Workspace()
+        self.page_size = page_size
+        self.limiter = RateLimiter(rate_limit, retry_after) if rate_limit else None
+        self.post_errors = post_errors
+        self.lost_replies = lost_replies
+        self.posts = []
+        self.start_delay = start_delay
+        # flow start uuid -> (time it was created, start)
+        self.starts = {}
+        self.rng = random.Random(seed)
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.standin = self
+        self.url = 'http://%s:%d' % self.httpd.server_address[:2]
+        self.stats = {'requests': 0, 'rate_limited': 0, 'records': 0, 'bytes': 0,
+                      'post_errors': 0}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.stats[key] += n
+
+    def random(self):
+        with self.lock:
+            return self.rng.random()
+
+    def record(self, version, endpoint, body):
+        '''
+            Keeps an accepted write and returns the answer to it.
+        '''
+        with self.lock:
+            self.posts.append((version, endpoint, body))
+            if (version, endpoint) == ('v1', 'contacts'):
+                # The same urn is always the same contact
+                urn = ','.join(body.get('urns') or [])
+                return dict(body, uuid=str(uuid.uuid5(uuid.NAMESPACE_URL, urn)))
+            if (version, endpoint) != ('v2', 'flow_starts'):
+                return body
+            start = {'uuid': str(uuid.uuid4()), 'flow': {'uuid': body.get('flow')},
+                     'contacts': [{'uuid': c} for c in body.get('contacts', [])],
+                     'restart_participants': body.get('restart_participants', True),
+                     'status': 'pending', 'created_on': iso(datetime.utcnow())}
+            self.starts[start['uuid']] = (time.time(), start)
+            return start
+
+    def flow_starts(self, params):
+        '''
+            Page of flow starts (all of them, or the one of params['uuid']).
+        '''
+        with self.lock:
+            uuids = [params['uuid']] if 'uuid' in params else list(self.starts)
+            results = []
+            for key in uuids:
+                if key not in self.starts:
+                    continue
+                created, start = self.starts[key]
+                status = 'complete' if time.time() - created >= self.start_delay else 'starting'
+                results.append(dict(start, status=status, modified_on=iso(datetime.utcnow())))
+        return {'next': None, 'previous': None, 'results': results}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
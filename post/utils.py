@@ -5,33 +5,31 @@
 # API with a focus on interaction with external datasets.
 # There is also a function to deal with input of Google spreadsheets
 
+# Heavy modules (pandas, gspread, oauth2client) and keys.ini are loaded on first
+# use, so that a single post request does not pay for them.
+
 import json
-import requests
-import csv
-import datetime
-import configparser
-import gspread
-from oauth2client.client import SignedJwtAssertionCredentials
-import numpy as np
-import pandas as pd
+import lazy
+
+
+def setting(section, key):
+    '''
+        Value of key in section of keys.ini, read once on first use, e.g.
+        setting('paths', 'root') (see lazy.py).
+    '''
+    return lazy.setting(section, key)
 
 
-# configuration
-config = configparser.ConfigParser()
-config.read('keys.ini')
-## RapidPro API token
-rp_api = config['rapidpro']['rp_api']
-## Paths
-root = config['paths']['root']
-contacts = config['paths']['contacts']
-flows = config['paths']['flows']
-## Google credentials
-gCredentials = config['google']['credentials']
+def path(key):
+    '''
+        Full path of a dataset in the [paths] section, e.g. path('contacts').
+    '''
+    return lazy.path(key)
 
 
 
 
-def io(dbPath, subset=None):
+def io(dbPath, subset=None, typed=False):
     '''
         Reads a .csv into dataframe, all string, np.nan set to ''.
         subset is a list of varnames to import.
@@ -41,7 +39,23 @@ def io(dbPath, subset=None):
         dbPath is the full path to the dataset (starting at root, see beginning of file.)
         It's important to get everything as string: some integer cols are otherwise assigned
             a float type and when converted to string are displayed as floats...
+        If the dataset was exported as .parquet/.feather (see get.py) that copy is read
+            instead, loading only subset. typed=True keeps its dates, ints and booleans.
     '''
+    import pandas as pd
+    import columnar
+
+    located = columnar.locate(dbPath)
+    if located != dbPath:
+        df = columnar.read_table(located, subset)
+        if typed:
+            return df
+        for col in df:
+            if pd.api.types.is_datetime64_any_dtype(df[col]):
+                df[col] = df[col].dt.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+            df[col] = df[col].astype(object).where(df[col].notnull(), '')
+            df[col] = df[col].astype(str).str.strip()
+        return df
 
     df = pd.read_csv(dbPath,
                      encoding= 'latin-1',
@@ -65,22 +79,35 @@ def io(dbPath, subset=None):
     return df
 
 
+_gspread_client = []
+
+
+def gspread_client():
+    '''
+        Authorized gspread client, signed in once per process so that every
+        sheet reuses its token and connections.
+    '''
+    if not _gspread_client:
+        import gspread
+        from oauth2client.client import SignedJwtAssertionCredentials
+        # Construct credentials. You should have a .json file with credentials for GSheet get requests.
+        json_key = json.load(open(setting('paths', 'root') + setting('google', 'credentials')))
+        scope = ['https://spreadsheets.google.com/feeds']
+        credentials = SignedJwtAssertionCredentials(json_key['client_email'],
+                                                    json_key['private_key'].encode(),
+                                                    scope)
+        # Sign in
+        _gspread_client.append(gspread.authorize(credentials))
+    return _gspread_client[0]
+
+
 def load_gspread(url, id_sheet=0):
     '''
         returns the first instance of class gspread.Worksheet() in spreadsheet located in url.
     '''
 
-    # Construct credentials. You should have a .json file with credentials for GSheet get requests.
-    json_key = json.load(open(root + gCredentials))
-    scope = ['https://spreadsheets.google.com/feeds']
-    credentials = SignedJwtAssertionCredentials(json_key['client_email'],
-                                                json_key['private_key'].encode(),
-                                                scope)
-    # Sign in
-    gc = gspread.authorize(credentials)
-
     # Open spreadsheet. The url leads to the dataset
-    book = gc.open_by_url(url)
+    book = gspread_client().open_by_url(url)
     return book.get_worksheet(id_sheet)
 
 
@@ -89,6 +116,7 @@ def read_gspread(url, id_sheet=0):
         returns a pandas dataframe of the google spreadsheet specified in url.
         The spreadsheet has to be shared with the corresponding Google service account
     '''
+    import pandas as pd
 
     # Load gspread
     sheet = load_gspread(url, id_sheet)
@@ -141,7 +169,7 @@ def rowAppend_gspread(url, values):
 
 
 
-def update_fields(df, variables, date=None):
+def update_fields(df, variables, date=None, diff=False, contacts_path=None):
     '''
         Runs post requests to update contact fields associated in variables.
         Missing data are ignored and requests are executed with all available information.
@@ -153,59 +181,45 @@ def update_fields(df, variables, date=None):
             }
         If it is a list, then varnames and contact fields must match.
         date is today's date (to keep track of when things happened in RP) in format DD/MM/YYYYY
+        Contacts are updated concurrently with retries (see contact_fields.py).
+        diff=True only sends the fields whose value differs from the contacts export in
+        contacts_path (default: contacts), skipping unchanged contacts; sync it first.
+        Returns a table with the phone, uuid, number of fields sent and left unchanged,
+        status, http status, attempts and error of every contact.
     '''
+    import contact_fields
 
-    for row in range(len(df.index)):
-        # Assemble contact fields to update
-        to_update = {}
-
-        if type(variables) == dict:
-            for field in variables.keys():
-                if df[field].iloc[row] != '' :
-                    to_update[variables[field]] = df[field].iloc[row]
-                else:
-                    pass
-
-        elif type(variables) == list:
-            for field in variables:
-                if df[field].iloc[row] and not pd.isnull(df[field].iloc[row]):
-                    to_update[field] = df[field].iloc[row]
-                else:
-                    pass
-
-
-        if to_update != {}:
-            if date:
-                to_update['rp_datemodified'] = date
-            else:
-                pass
-            # Proceed with request
-            response = requests.post(
-            'https://api.rapidpro.io/api/v1/contacts.json',
-            headers = { 'content-type': 'application/json',
-                        'Authorization': rp_api },
-            data = json.dumps( { 'urns': [df['phone'].iloc[row]],
-                                 'fields': to_update } )
-            )
-            if response.ok:
-                print "Se termino de actualizar -> %s" %(df['phone'].iloc[row])
-                print "Con los campos: %s" %(to_update)
-            else:
-                print "Hubo un error al actualizar el contacto"
-    return None
+    return contact_fields.update_fields(df, variables, date, diff,
+                                        contacts_path or path('contacts'))
+
+
+def lookup_uuids(phones, contacts_path=None, updated=None):
+    '''
+        Returns the contact uuids of phones (a pd.Series, 'tel:+52...', '+52...' or
+        with spaces), '' for unknown phones.
+        Uses the phone index of the contacts export in contacts_path (default: contacts)
+        instead of reading the export (see phone_index.py).
+        updated is the table returned by update_fields: the uuids RapidPro answered
+        complete the phones the export does not know yet, e.g. contacts the update created.
+    '''
+    import phone_index
+
+    index = phone_index.open_index(contacts_path or path('contacts'))
+    uuids = index.lookup(phones)
+    if updated is not None:
+        import contact_fields
+        uuids = contact_fields.fill_uuids(uuids, phones, updated)
+    return uuids
 
 
 def get_uuids(df):
     '''
-        retrieves the contacts' uuids. The merge is on phone number
+        retrieves the contacts' uuids. The match is on phone number
         TODO: should it return list of uuids?
     '''
 
-    # Call contacts with io function
-    contact_uuids = io(root + contacts, ['urns_0', 'uuid'])
-    contact_uuids = contact_uuids.rename( columns = {'urns_0': 'phone'} )
-
-    df = df.merge(contact_uuids, how = 'left', on = 'phone')
+    df = df.copy()
+    df['uuid'] = lookup_uuids(df['phone']).values
 
     df.fillna('', inplace = True)
 
@@ -217,25 +231,13 @@ def add_groups(contact_uuids, group, action = 'add'):
         contact_uuids is a list of contact UUIDS to add.
         group is a string, the name of the group.
         Notice that RP has a 100 limit on number of contact_uuids to add to a group in each request.
+        Duplicated and empty uuids are dropped and the batches are sent concurrently (see groups.py).
+        Returns a table with the status of every batch.
     '''
+    import groups
 
-    batch = []
-    while len(contact_uuids) > 100:
-        batch.append(contact_uuids[:100])
-        contact_uuids = contact_uuids[100:]
-    batch.append(contact_uuids[:])
-    print "Se agregan al grupo : %s \n%d contactos" %(group, len(contact_uuids))
-
-    for l in batch:
-        requests.post(
-                'https://rapidpro.io/api/v1/contact_actions.json',
-                headers = { 'content-type': 'application/json',
-                            'Authorization': rp_api },
-                data = json.dumps( { 'contacts': l,
-                                     'action': action,
-                                     'group': group } )
-                     )
-    return None
+    print("Se agregan al grupo : %s \n%d contactos" %(group, len(contact_uuids)))
+    return groups.send_actions(groups.group_actions(group, action, contact_uuids))
 
 
 def remove_groups(contact_uuids, group):
@@ -245,48 +247,34 @@ def remove_groups(contact_uuids, group):
         Notice that RP has a 100 limit on number of contact_uuids to add to a group in each request.
     '''
 
-    add_groups(contact_uuids, group, action = 'remove')
+    return add_groups(contact_uuids, group, action = 'remove')
 
-    return None
+
+def reconcile_groups(desired, managed=(), contacts_path=None):
+    '''
+        desired is a dict {contact uuid: groups it must be in} (groups.by_contact builds it
+        from {group: contact uuids}). Contacts are also removed from the groups in managed
+        they must not be in. Only the adds and removes needed according to the memberships
+        of the contacts export in contacts_path are sent (every one without contacts_path).
+        Returns a table with the status of every batch.
+    '''
+    import groups
+
+    return groups.reconcile(desired, managed, contacts_path)
 
 
 def start_run(contact_uuids, flow):
     '''
         flow is a string e.g. 'miAlta_init'. It's the name of the flow to start the contact_uuids in.
+        Starts them in concurrent batches (see flow_starts.py) and returns the
+        FlowStart tracking their status, None if the flow does not exist.
     '''
+    import flow_starts
+    import names
 
-    # Load flows dataset
-    flows_df = io(root + flows)
-
-    # Get flow uuid
-    flow_value = flows_df.loc[ (flows_df['name'] == flow), 'uuid']
-    if len(flow_value) ==0: ##Not in the dataframe then search
-         r = requests.get('https://api.rapidpro.io/api/v1/flows.json',
-                             headers = {'Authorization': rp_api},
-                             params = {'name': flow})
-         result =  r.json()['results']
-         if not result:
-             flow_uuid = 'Missing'
-             print "Missing %s" %(flow)
-         else :
-            flow_uuid = result[0]['name']
-            print "No missing %s " %(flow_uuid)
-    else:
-        flow_uuid = flow_value.values[0]
+    flow_uuid = names.uuid('flows', flow)
+    if flow_uuid is None:
+        print("Missing %s" %(flow))
+        return None
     print('Flow UUID is: ' + str(flow_uuid))
-
-
-    batch = []
-    while len(contact_uuids) > 100:
-        batch.append(contact_uuids[:100])
-        contact_uuids = contact_uuids[100:]
-    batch.append(contact_uuids[:])
-
-    for l in batch:
-        print(len(l))
-        requests.post( 'https://api.rapidpro.io/api/v1/runs.json',
-              headers = {'content-type': 'application/json',
-                         'Authorization': rp_api},
-              data = json.dumps( { 'flow_uuid': flow_uuid,
-                                   'contacts': l,
-                                   'restart_participants': True } ) )
+    return flow_starts.start(flow_uuid, contact_uuids)